@@ -0,0 +1,2391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+tg-keyword-react-bot v5 基准测试
+用法: python3 benchmark.py <项目> [参数]
+suite / compare: 固定的测试套件，结果按版本保存在 benchmarks/<版本>.json，compare 和基线比较，变慢超过阈值时返回 1
+"""
+
+import gc
+import re
+import sys
+import json
+import time
+import logging
+import random
+import os
+import asyncio
+import argparse
+import tempfile
+import importlib.util
+import platform
+import statistics
+import subprocess
+from pathlib import Path
+from types import SimpleNamespace
+from datetime import datetime, timezone
+
+BOT_FILE = Path(__file__).resolve().parent / "tg-keyword-react-bot-v5.py"
+# suite --save 保存的基线: benchmarks/<版本>.json
+BASELINE_DIR = Path(__file__).resolve().parent / "benchmarks"
+
+
+def load_bot():
+    """按文件路径加载 v5 脚本 (文件名带连字符，无法直接 import)"""
+    spec = importlib.util.spec_from_file_location("tg_keyword_react_bot_v5", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    module.logger.setLevel(logging.WARNING)
+    return module
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+# ---------------- 合成数据 ----------------
+WORDS = [
+    "proxy", "naive", "clash", "trojan", "vless", "reality", "sing", "box", "warp",
+    "cloudflare", "vps", "bbr", "hysteria", "tuic", "shadow", "socks", "route",
+    "三色图", "翻墙", "机场", "节点", "梯子", "订阅", "测速", "延迟", "免费",
+]
+
+
+def random_word(rng):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 9)))
+
+
+def make_keyword_actions(n, rng):
+    """生成 n 个混合类型的关键词: 70% 子串, 15% 整词, 10% 前缀, 5% 正则"""
+    actions = {}
+    while len(actions) < n:
+        r = rng.random()
+        if r < 0.05:
+            # 部分正则以 \b 开头，提取不出字面量前缀
+            kw = rf"{random_word(rng)}\d{{2,4}}" if r < 0.04 else rf"\b{random_word(rng)}s?\b"
+            kind = "regex"
+        else:
+            kw = random_word(rng) if rng.random() < 0.8 else rng.choice(WORDS) + random_word(rng)[:2]
+            kind = "substring" if r < 0.75 else "word" if r < 0.9 else "prefix"
+        actions[kw] = {"action": "reply", "match": kind}
+    for w in WORDS:
+        actions.setdefault(w, {"action": "reply", "match": "word"})
+    return actions
+
+
+def make_messages(n, rng, length=60):
+    msgs = []
+    for _ in range(n):
+        parts = [rng.choice(WORDS) if rng.random() < 0.3 else random_word(rng) for _ in range(length)]
+        msgs.append(
+            f'#FOUND (https://t.me/c/1958152252/{rng.randint(1, 10**6)}) "{parts[0]}" '
+            f"IN group(1958152252) FROM user({rng.randint(10**9, 8 * 10**9)})\n" + " ".join(parts)
+        )
+    return msgs
+
+
+def reference_match(keyword_actions, text, fold=str.lower, fold_regex=None):
+    """逐个关键词独立匹配的参考实现 (用于校验结果和对比耗时)；fold_regex 为正则的归一化"""
+    lower = fold(text)
+    out = []
+    for kw, cfg in keyword_actions.items():
+        kind = cfg.get("match", "substring")
+        if kind == "substring":
+            hit = fold(kw) in lower
+        elif kind == "word":
+            hit = re.search(r"(?<!\w)" + re.escape(fold(kw)) + r"(?!\w)", lower) is not None
+        elif kind == "prefix":
+            hit = re.search(r"(?<!\w)" + re.escape(fold(kw)), lower) is not None
+        else:
+            hit = re.search(fold_regex(kw) if fold_regex else kw, lower, re.IGNORECASE) is not None
+        if hit:
+            out.append(kw)
+    return out
+
+
+# ---------------- 假客户端 ----------------
+class FakeClient:
+    """
+    模拟 TelegramClient 的最小子集，每次 RPC 等待 latency 秒
+    monitor_messages 为监控频道里的历史消息 (按 id 升序)
+    """
+
+    def __init__(self, latency=0.0, monitor_messages=(), page_size=100, participants=None):
+        self.latency = latency
+        self.monitor_messages = list(monitor_messages)
+        self.page_size = page_size
+        self.participants = participants or {}  # 群组 -> [User]
+        self.rpc_count = 0
+        self.participant_rpcs = 0
+        self.sent = []  # [(entity, kind, payload)]
+        self.disconnected = False
+
+    async def _rpc(self):
+        self.rpc_count += 1
+        await asyncio.sleep(self.latency)
+
+    async def iter_messages(self, entity, min_id=0, max_id=0, reverse=False, limit=None):
+        selected = [
+            m for m in self.monitor_messages if m.id > min_id and (not max_id or m.id < max_id)
+        ]
+        if not reverse:
+            selected.reverse()
+        for i in range(0, len(selected), self.page_size):
+            await self._rpc()
+            for m in selected[i:i + self.page_size]:
+                yield m
+
+    def iter_participants(self, entity, limit=None):
+        return FakeParticipants(self, self.participants.get(entity, [])[:limit])
+
+    async def get_input_entity(self, peer):
+        await self._rpc()
+        return SimpleNamespace(user_id=abs(hash(peer)) % (6 * 10**9) + 2 * 10**9)
+
+    async def get_entity(self, peer):
+        await self._rpc()
+        return SimpleNamespace(bot=False, first_name="user", last_name=None)
+
+    async def get_messages(self, entity, ids=None):
+        await self._rpc()
+        return SimpleNamespace(from_id=SimpleNamespace(user_id=2 * 10**9 + (ids or 0)))
+
+    async def send_file(self, entity, file, reply_to=None):
+        await self._rpc()
+        self.sent.append((entity, "file", reply_to, time.perf_counter()))
+
+    async def send_message(self, entity, text, reply_to=None):
+        await self._rpc()
+        self.sent.append((entity, "message", reply_to, time.perf_counter()))
+
+    async def __call__(self, request):
+        await self._rpc()
+        return SimpleNamespace(documents=[object()] * 8, full_user=SimpleNamespace(about=""))
+
+    async def disconnect(self):
+        self.disconnected = True
+
+
+class FakeParticipants:
+    """iter_participants 的返回值: 按每页 200 人请求，遍历后带有 total 属性"""
+
+    def __init__(self, client, users):
+        self.client = client
+        self.users = users
+        self.total = None
+
+    async def __aiter__(self):
+        for i in range(0, max(len(self.users), 1), 200):
+            await self.client._rpc()
+            self.client.participant_rpcs += 1
+            self.total = len(self.users)
+            for user in self.users[i:i + 200]:
+                yield user
+
+
+def make_notification(message_id, text, date=None):
+    return SimpleNamespace(
+        id=message_id,
+        message=text,
+        entities=None,
+        date=date or datetime.now(timezone.utc),
+    )
+
+
+class FakeClock:
+    """可手动推进的模拟时钟"""
+
+    def __init__(self, now=None):
+        self.now = time.time() if now is None else now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def make_bot(bot, client, **kwargs):
+    """在临时目录里创建 KeywordMonitorBot，避免读写当前目录的状态文件"""
+    os.chdir(tempfile.mkdtemp())
+    return bot.KeywordMonitorBot(client=client, **kwargs)
+
+
+def rss_mb():
+    """当前进程的常驻内存 (MB)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# ---------------- 各项基准 ----------------
+def bench_matcher(args):
+    bot = load_bot()
+    rng = random.Random(args.seed)
+    actions = make_keyword_actions(args.patterns, rng)
+    messages = make_messages(args.messages, rng)
+
+    t0 = time.perf_counter()
+    matcher = bot.KeywordMatcher(actions)
+    build = time.perf_counter() - t0
+
+    for msg in messages:
+        assert matcher.match(msg) == reference_match(actions, msg, matcher.normalizer.fold), msg
+
+    # 不能合并进前瞻正则的合法正则: 全局标志、重复的组名、编号反向引用
+    special = {
+        r"(?i)\bfoo": {"match": "regex"},
+        r"(?P<n>ba)r\d": {"match": "regex"},
+        r"(?P<n>qu)x": {"match": "regex"},
+        r"(\w)\1z": {"match": "regex"},
+        r"\d{3}z": {"match": "regex"},
+    }
+    # 含形近字、ß、全角字符的正则: 正则里的字面量与消息做同样的归一化
+    special.update({
+        r"привет\d+": {"match": "regex"},
+        "straße": {"match": "regex"},
+        r"ＢＵＹ\s*now": {"match": "regex"},
+    })
+    special_matcher = bot.KeywordMatcher(special)
+    fold = special_matcher.normalizer.fold
+    fold_regex = lambda kw: bot._fold_regex(kw, fold)
+    for msg, hits in (("привет123", [r"привет\d+"]), ("Straße", ["straße"]), ("buy  NOW", [r"ＢＵＹ\s*now"])):
+        assert special_matcher.match(msg) == hits, (msg, special_matcher.match(msg))
+    for msg in ["FOO bar1", "xx quux", "aaz 123z", "foobar", "nothing", "ПРИВЕТ 7 strasse"] + messages[:20]:
+        expected = reference_match(special, msg, fold, fold_regex)
+        assert special_matcher.match(msg) == expected, (msg, expected)
+
+    ref = timeit(lambda: [reference_match(actions, m) for m in messages], args.repeat)
+    combined = timeit(lambda: [matcher.match(m) for m in messages], args.repeat)
+    n = len(messages)
+    print(f"patterns={len(actions)} messages={n} build={build * 1000:.1f}ms")
+    print(f"  逐个匹配: {ref / n * 1e6:9.1f} us/msg")
+    print(f"  组合匹配: {combined / n * 1e6:9.1f} us/msg  (x{ref / combined:.1f})")
+
+
+def evade(text, rng):
+    """模拟广告的规避写法: 全角、零宽字符、形近字、逐字符插空格"""
+    out = []
+    spaced = False
+    for word in text.split(" "):
+        r = rng.random()
+        # 相邻两个词都逐字符插空格时无法区分词界，跳过
+        if spaced and r >= 0.3:
+            r = 1
+        spaced = 0.3 <= r < 0.35
+        if r < 0.1:
+            word = "".join(chr(ord(c) + 0xFEE0) if "!" <= c <= "~" else c for c in word)
+        elif r < 0.2:
+            word = "\u200d".join(word)
+        elif r < 0.3:
+            word = word.replace("a", "а").replace("o", "о").replace("e", "е")
+        elif r < 0.35:
+            word = " ".join(word)
+        out.append(word)
+    return " ".join(out)
+
+
+def bench_normalize(args):
+    bot = load_bot()
+    rng = random.Random(args.seed)
+    clean = make_messages(args.messages, rng)
+    # 只对正文做规避处理，通知首行保持原样
+    evasive = []
+    for m in clean:
+        head, body = m.split("\n", 1)
+        evasive.append(head + "\n" + evade(body, rng))
+    normalizer = bot.TextNormalizer()
+
+    # 规避写法归一化后应当与原文一致
+    for c, e in zip(clean, evasive):
+        assert normalizer.fold(e) == normalizer.fold(c), (c, e)
+        norm, offsets = normalizer.normalize(e)
+        assert norm == normalizer.fold(e) and len(offsets) == len(norm)
+
+    for name, msgs in (("普通文本", clean), ("规避文本", evasive)):
+        size = sum(len(m) for m in msgs)
+        for label, func in (
+            ("str.lower", str.lower),
+            ("fold", normalizer.fold),
+            ("normalize+offsets", normalizer.normalize),
+        ):
+            t = timeit(lambda: [func(m) for m in msgs], args.repeat)
+            print(f"{name} {label:18s} {size / t / 1e6:7.2f} M字符/s  {t / len(msgs) * 1e6:7.1f} us/msg")
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def measure_loop_stall(workload, tick=0.001):
+    """运行 workload 的同时，用一个定时探针记录事件循环的调度延迟 (秒)"""
+    lags = []
+    done = False
+
+    async def probe():
+        loop = asyncio.get_running_loop()
+        while not done:
+            start = loop.time()
+            await asyncio.sleep(tick)
+            lags.append(loop.time() - start - tick)
+
+    task = asyncio.ensure_future(probe())
+    await asyncio.sleep(0)
+    await workload()
+    done = True
+    await task
+    return lags
+
+
+def bench_persist(args):
+    bot = load_bot()
+    rng = random.Random(args.seed)
+    users = {rng.randint(10**9, 8 * 10**9): True for _ in range(args.users)}
+    path = str(Path(tempfile.mkdtemp()) / "interacted_users.json")
+
+    def sync_save():
+        # v4 的做法: 每次私信后在事件循环里同步写整个文件
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({str(k): True for k in users}, f, ensure_ascii=False, indent=2)
+
+    writer = bot.WriteBehindFile(path, lambda: {str(k): True for k in list(users)})
+
+    def make_burst(save):
+        async def burst():
+            for _ in range(args.dms):
+                users[rng.randint(10**9, 8 * 10**9)] = True
+                save()
+                await asyncio.sleep(args.gap)
+        return burst
+
+    print(f"users={args.users} dms={args.dms}")
+    for name, save in (("同步写盘", sync_save), ("后台合并写盘", writer.mark_dirty)):
+        start = time.perf_counter()
+        lags = asyncio.run(measure_loop_stall(make_burst(save)))
+        elapsed = time.perf_counter() - start
+        print(
+            f"  {name:8s} 总耗时 {elapsed:6.2f}s  循环延迟 p50={percentile(lags, 50) * 1000:6.2f}ms "
+            f"p99={percentile(lags, 99) * 1000:7.2f}ms max={max(lags) * 1000:7.2f}ms"
+        )
+    writer.close()
+    print(f"  后台写盘次数: {writer.writes} (修改 {args.dms} 次)")
+
+
+def bench_catchup(args):
+    bot = load_bot()
+    bot.REPLY_COALESCE_WINDOW = 0  # 这里测量的是逐条动作，不合并群回复
+    rng = random.Random(args.seed)
+    now = time.time()
+    texts = make_messages(args.messages, rng)
+    # 前 stale 条是过期的通知
+    history = [
+        make_notification(
+            i + 1,
+            text,
+            datetime.fromtimestamp(
+                now - (bot.CATCHUP_MAX_AGE * 2 if i < args.stale else 60), timezone.utc
+            ),
+        )
+        for i, text in enumerate(texts)
+    ]
+    client = FakeClient(latency=args.latency, monitor_messages=history)
+    instance = make_bot(bot, client)
+    instance.last_monitor_id = 1
+
+    async def run():
+        async with instance.monitor_lock:
+            await instance.catch_up()
+        for lane in instance.lanes.values():
+            await lane.drain()
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    instance.shutdown()
+
+    assert instance.last_monitor_id == args.messages
+    total = args.messages - 1
+    print(
+        f"补处理 {total} 条 (过期 {args.stale}) 耗时 {elapsed:.2f}s，"
+        f"{total / elapsed:.0f} 条/秒，GetHistory 等 RPC {client.rpc_count} 次"
+    )
+
+    # 保存的进度只到动作都已执行完的通知: 动作还在合并窗口或执行通道里时退出，重启后这些通知会重新补处理
+    bot.REPLY_COALESCE_WINDOW = 0.2
+    bot.COOLDOWN_MESSAGE_SENT = 0
+    bot.KEYWORD_ACTIONS = {
+        "replykw": {"action": "reply", "text": "reply"},
+        "dmkw": {"action": "dm", "text": "dm"},
+    }
+    instance = make_bot(bot, FakeClient(latency=0.05))
+    instance.last_monitor_id = instance.checkpoint.done = 10
+
+    async def crash():
+        for i, kw in enumerate(["dmkw", "replykw", "nothing", "replykw", "dmkw"], 11):
+            text = f'#FOUND (https://t.me/c/1958152252/{i}) "{kw}" IN group(1958152252) FROM user({2 * 10**9 + i})\n{kw}'
+            await instance.process_notification(make_notification(i, text))
+        saved = instance.checkpoint.done
+        await instance.drain()
+        return saved
+
+    saved = asyncio.run(crash())
+    instance.shutdown()
+    assert saved == 10, saved
+    assert instance.checkpoint.done == 15 and not instance.checkpoint.holds, instance.checkpoint.holds
+    assert instance.load_state()["last_monitor_id"] == 15
+    print(f"  动作执行前的进度: {saved}，执行完后: {instance.checkpoint.done}")
+
+
+def bench_lanes(args):
+    bot = load_bot()
+    bot.REPLY_COALESCE_WINDOW = 0  # 这里测量的是逐条动作，不合并群回复
+    bot.COOLDOWN_MESSAGE_SENT = 0
+    bot.COOLDOWN_USER_FETCH_FAILED = 0
+    bot.KEYWORD_ACTIONS = {
+        "replykw": {"action": "reply", "text": "reply"},
+        "dmkw": {"action": "dm", "text": "dm"},
+    }
+    rng = random.Random(args.seed)
+    kinds = ["dmkw" if rng.random() < args.dm_ratio else "replykw" for _ in range(args.notifications)]
+
+    def run(mode):
+        client = FakeClient(latency=args.latency)
+        instance = make_bot(bot, client)
+        if mode == "sequential":
+            # 改动前: 所有动作按顺序逐个执行
+            shared = bot.ActionLane("shared", 1)
+            instance.lanes = {"reply": shared, "dm": shared}
+        created = {}
+
+        async def feed():
+            for i, kw in enumerate(kinds, 1):
+                text = (
+                    f'#FOUND (https://t.me/c/1958152252/{i}) "{kw}" IN group(1958152252) '
+                    f"FROM user({2 * 10**9 + i})\n{kw}"
+                )
+                created[i] = time.perf_counter()
+                await instance.process_notification(make_notification(i, text))
+                await asyncio.sleep(args.interval)
+            for lane in set(instance.lanes.values()):
+                await lane.drain()
+
+        asyncio.run(feed())
+        instance.shutdown()
+
+        latency = {"reply": [], "dm": []}
+        for entity, _, reply_to, sent_at in client.sent:
+            if reply_to is not None:
+                latency["reply"].append(sent_at - created[reply_to])
+            else:
+                latency["dm"].append(sent_at - created[entity.user_id - 2 * 10**9])
+        dropped = sum(lane.dropped for lane in set(instance.lanes.values()))
+        print(f"  {mode}: 丢弃过时回复 {dropped}")
+        for name, values in latency.items():
+            print(
+                f"    {name:5s} n={len(values):4d} p50={percentile(values, 50) * 1000:7.0f}ms "
+                f"p90={percentile(values, 90) * 1000:7.0f}ms p99={percentile(values, 99) * 1000:7.0f}ms"
+            )
+
+    print(f"notifications={args.notifications} rpc_latency={args.latency * 1000:.0f}ms")
+    run("sequential")
+    run("lanes")
+
+    # 动作抛出的异常在通道里记录并计数，不留给事件循环的 "Task exception was never retrieved"
+    unhandled = []
+
+    async def failing():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, ctx: unhandled.append(ctx))
+        lane = bot.ActionLane("reply", 2)
+
+        async def boom():
+            raise RuntimeError("boom")
+
+        async def ok():
+            return "ok"
+
+        tasks = [lane.submit(boom), lane.submit(ok)]
+        await lane.drain()
+        del tasks
+        gc.collect()
+        return lane.stats()
+
+    st = asyncio.run(failing())
+    assert st["failed"] == 1 and st["done"] == 2 and st["pending"] == 0, st
+    assert not unhandled, unhandled
+    print(f"  动作异常: 失败 {st['failed']}，完成 {st['done']}")
+
+
+def bench_soak(args):
+    bot = load_bot()
+    bot.REPLY_COALESCE_WINDOW = 0  # 这里测量的是逐条动作，不合并群回复
+    if args.no_cooldown:
+        bot.COOLDOWN_MESSAGE_SENT = 0
+        bot.COOLDOWN_USER_FETCH_FAILED = 0
+    rng = random.Random(args.seed)
+    clock = FakeClock()
+    client = FakeClient()
+    instance = make_bot(bot, client, clock=clock)
+    keywords = list(bot.KEYWORD_ACTIONS)
+    step = 3600 / args.rate
+
+    def notification(i):
+        words = [random_word(rng) for _ in range(rng.randint(5, 40))]
+        if rng.random() < args.match_ratio:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(keywords))
+        if rng.random() < 0.3:
+            words.append(chr(rng.randint(0x4E00, 0x9FFF)))
+        sender = rng.randint(bot.MIN_USER_ID, 8 * 10**9)
+        text = (
+            f'#FOUND (https://t.me/c/{rng.randint(10**9, 2 * 10**9)}/{i}) "{words[0]}" '
+            f"IN group FROM user({sender})\n" + " ".join(words)
+        )
+        return make_notification(i, text, datetime.fromtimestamp(clock(), timezone.utc))
+
+    async def run():
+        latencies = []
+        per_day = int(86400 / step)
+        print(f"{'天':>4} {'RSS(MB)':>8} {'已互动':>7} {'贴纸缓存':>8} {'归一化表':>8} {'发送':>6} {'p50(ms)':>8} {'p99(ms)':>8}")
+        for i in range(1, args.days * per_day + 1):
+            clock.advance(step)
+            start = time.perf_counter()
+            await instance.process_notification(notification(i))
+            for lane in instance.lanes.values():
+                await lane.drain()
+            latencies.append(time.perf_counter() - start)
+            if i % per_day == 0:
+                print(
+                    f"{i // per_day:4d} {rss_mb():8.1f} {len(instance.interacted_users):7d} "
+                    f"{len(instance.sticker_cache):8d} {len(instance.matcher.normalizer.table):8d} "
+                    f"{len(client.sent):6d} {percentile(latencies, 50) * 1000:8.2f} "
+                    f"{percentile(latencies, 99) * 1000:8.2f}"
+                )
+                latencies = []
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    instance.shutdown()
+    print(f"模拟 {args.days} 天，实际耗时 {time.perf_counter() - start:.1f}s")
+
+
+def replay_workload(bot, rng, count, keyword_ratio=0.5):
+    """离线回放用的通知: 一部分包含配置里的关键词"""
+    keywords = list(bot.KEYWORD_ACTIONS)
+    texts = make_messages(count, rng, length=30)
+    out = []
+    for i, text in enumerate(texts, 1):
+        if rng.random() < keyword_ratio:
+            text += " " + rng.choice(keywords)
+        out.append(make_notification(i, text))
+    return out
+
+
+def bench_loop(args):
+    bot = load_bot()
+    bot.REPLY_COALESCE_WINDOW = 0  # 这里测量的是逐条动作，不合并群回复
+    bot.COOLDOWN_MESSAGE_SENT = 0
+    bot.COOLDOWN_USER_FETCH_FAILED = 0
+    rng = random.Random(args.seed)
+    notifications = replay_workload(bot, rng, args.notifications)
+
+    loops = [("asyncio", None)]
+    try:
+        import uvloop
+        loops.append(("uvloop", uvloop.EventLoopPolicy))
+    except ImportError:
+        print("未安装 uvloop，只测默认事件循环")
+
+    for name, policy in loops:
+        asyncio.set_event_loop_policy(policy() if policy else None)
+        instance = make_bot(bot, FakeClient(latency=args.latency))
+        monitor = bot.LoopLagMonitor(interval=0.005)
+        latencies = []
+
+        async def run():
+            monitor.start()
+            start = time.perf_counter()
+            for message in notifications:
+                t = time.perf_counter()
+                await instance.process_notification(message)
+                latencies.append(time.perf_counter() - t)
+            for lane in instance.lanes.values():
+                await lane.drain()
+            monitor.stop()
+            return time.perf_counter() - start
+
+        elapsed = asyncio.run(run())
+        instance.shutdown()
+        print(
+            f"  {name:8s} {len(notifications) / elapsed:8.0f} 条/秒  处理 p50={percentile(latencies, 50) * 1e6:6.0f}us "
+            f"p99={percentile(latencies, 99) * 1e6:6.0f}us | {monitor.report()}"
+        )
+    asyncio.set_event_loop_policy(None)
+
+
+def bench_coordination(args):
+    bot = load_bot()
+    bot.REPLY_COALESCE_WINDOW = 0  # 这里测量的是逐条动作，不合并群回复
+    bot.KEYWORD_ACTIONS = {
+        "replykw": {"action": "reply", "text": "reply"},
+        "dmkw": {"action": "dm", "text": "dm"},
+    }
+    workdir = tempfile.mkdtemp()
+    db = os.path.join(workdir, "coordination.db")
+
+    def notifications(kw):
+        return [
+            make_notification(
+                i,
+                f'#FOUND (https://t.me/c/1958152252/{i}) "{kw}" IN group(1958152252) '
+                f"FROM user({2 * 10**9 + i})\n{kw}",
+            )
+            for i in range(1, args.notifications + 1)
+        ]
+
+    def run(kw, cooldown):
+        bot.COOLDOWN_MESSAGE_SENT = cooldown
+        clients = [FakeClient(latency=args.latency) for _ in range(args.instances)]
+        instances = []
+        for n, client in enumerate(clients):
+            instance = make_bot(bot, client, coordination=bot.SQLiteCoordinationStore(db))
+            instance.instance_id = f"host{n}"
+            instances.append(instance)
+        msgs = notifications(kw)
+
+        async def feed(instance):
+            for message in msgs:
+                await instance.process_notification(message)
+                await asyncio.sleep(0)
+            for lane in instance.lanes.values():
+                await lane.drain()
+
+        async def main():
+            await asyncio.gather(*(feed(i) for i in instances))
+
+        start = time.perf_counter()
+        asyncio.run(main())
+        elapsed = time.perf_counter() - start
+        for instance in instances:
+            instance.shutdown()
+        os.remove(db)
+        return sum(len(c.sent) for c in clients), elapsed
+
+    print(f"instances={args.instances} notifications={args.notifications}")
+    sent, elapsed = run("dmkw", 0)
+    print(f"  私信 (无冷却): 发送 {sent} 条 (期望 {args.notifications})，耗时 {elapsed:.2f}s")
+    assert sent == args.notifications
+    sent, elapsed = run("replykw", 0)
+    print(f"  群回复 (无冷却): 发送 {sent} 条 (期望 {args.notifications}，每条群消息只回复一次)，耗时 {elapsed:.2f}s")
+    assert sent == args.notifications
+    sent, elapsed = run("replykw", 86400)
+    print(f"  群回复 (全局冷却): 发送 {sent} 条 (期望 1)，耗时 {elapsed:.2f}s")
+    assert sent == 1
+
+    # 设置了再次联系间隔时，内存存储在抢占时删除过期的用户
+    store = bot.MemoryCoordinationStore(user_ttl=100)
+
+    async def expiring():
+        for i in range(args.notifications):
+            assert (await store.claim(f"t{i}", i, user_id=i))[0]
+        assert not (await store.claim("again", args.notifications, user_id=args.notifications - 1))[0]
+        assert (await store.claim("later", args.notifications + 100, user_id=0))[0]
+
+    asyncio.run(expiring())
+    assert len(store.users) <= 101, len(store.users)
+    print(f"  内存存储: 抢占 {args.notifications} 个用户后只保留未过期的 {len(store.users)} 个")
+
+    # 发送成功的通知只有抢占这一次协调往返
+    calls = []
+    store = bot.MemoryCoordinationStore()
+    for name in ("claim", "release_user", "extend_cooldown", "release_cooldown"):
+        method = getattr(store, name)
+        setattr(store, name, lambda *a, name=name, method=method, **k: calls.append(name) or method(*a, **k))
+    for kw in ("dmkw", "replykw"):
+        calls.clear()
+        instance = make_bot(bot, FakeClient(), coordination=store)
+        store.cooldowns.clear()
+
+        async def one():
+            await instance.process_notification(notifications(kw)[0])
+            for lane in instance.lanes.values():
+                await lane.drain()
+
+        asyncio.run(one())
+        instance.shutdown()
+        print(f"  {kw} 成功一条的协调调用: {calls}")
+        assert calls == ["claim"], calls
+
+    # 单次抢占的往返耗时
+    store = bot.SQLiteCoordinationStore(db)
+    latencies = []
+
+    async def claims():
+        for i in range(args.notifications):
+            t = time.perf_counter()
+            await store.claim(f"t{i}", time.time(), user_id=i, cooldown_key="global", cooldown_seconds=0)
+            latencies.append(time.perf_counter() - t)
+
+    asyncio.run(claims())
+    store.close()
+    print(
+        f"  claim 往返: p50={percentile(latencies, 50) * 1e6:.0f}us "
+        f"p99={percentile(latencies, 99) * 1e6:.0f}us"
+    )
+
+
+def bench_filter(args):
+    bot = load_bot()
+    rng = random.Random(args.seed)
+    users = []
+    for _ in range(args.users):
+        if rng.random() < args.old_ratio:
+            uid = rng.randint(10**8, bot.MIN_USER_ID - 1)
+        else:
+            uid = rng.randint(bot.MIN_USER_ID, 8 * 10**9)
+        user = SimpleNamespace(
+            bot=rng.random() < 0.1,
+            first_name="news bot" if rng.random() < 0.05 else random_word(rng),
+            last_name=None,
+            username=None,
+        )
+        users.append((uid, user, "I am a bot" if rng.random() < 0.02 else ""))
+
+    def v4_rpcs(uid, user, about):
+        # v4 should_filter_user 的顺序: user_id -> get_entity -> GetFullUserRequest
+        if uid < bot.MIN_USER_ID:
+            return 0
+        return 1 if user.bot else 2
+
+    # 对比基准是 v4 的判断顺序；report() 里的 "先取全部数据" 只是上限，不代表比 v4 节省的 RPC
+    v4 = sum(v4_rpcs(*u) for u in users)
+    allowlist = [uid for uid, _, _ in users if rng.random() < 0.2]
+    for name, rules in (
+        ("默认规则", bot.USER_FILTER_RULES),
+        (
+            "默认规则 + 20% 用户 ID 白名单",
+            [{"type": "id_in", "ids": allowlist, "action": "allow"}] + bot.USER_FILTER_RULES,
+        ),
+    ):
+        flt = bot.UserFilter(rules)
+
+        async def run():
+            filtered = 0
+            for uid, user, about in users:
+                async def fetch_user(user=user):
+                    return user
+
+                async def fetch_about(about=about):
+                    return about
+
+                result, _, _ = await flt.decide(uid, fetch_user, fetch_about)
+                filtered += result
+            return filtered
+
+        start = time.perf_counter()
+        filtered = asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        print(f"{name}: 用户 {len(users)}，过滤 {filtered}，{elapsed / len(users) * 1e6:.1f} us/次")
+        print(f"  {flt.report()}")
+        print(
+            f"  对比 v4 顺序 (RPC {v4} 次，v4 没有白名单): 少 {v4 - flt.rpcs} 次 "
+            f"(平均每次 {(v4 - flt.rpcs) / len(users):.2f})"
+        )
+
+
+def bench_ingest(args):
+    bot = load_bot()
+    from telethon import TelegramClient, events
+    from telethon.sessions import MemorySession
+    from telethon.client.updates import EventBuilderDict
+    from telethon.tl import types
+
+    rng = random.Random(args.seed)
+    monitor_id = 1958152252
+    client = TelegramClient(MemorySession(), 1, "0" * 32)
+    texts = make_messages(200, rng, length=20)
+    updates = []
+    for i in range(args.updates):
+        cid = monitor_id if rng.random() < args.monitor_ratio else rng.randint(10**9, 2 * 10**9)
+        text = texts[i % len(texts)]
+        update = types.UpdateNewChannelMessage(
+            message=types.Message(
+                id=i + 1,
+                peer_id=types.PeerChannel(cid),
+                date=datetime.now(timezone.utc),
+                message=text,
+                entities=[types.MessageEntityBold(0, 6), types.MessageEntityTextUrl(8, 10, "https://t.me/c/1/2")],
+            ),
+            pts=i + 1,
+            pts_count=1,
+        )
+        # TelegramClient 在分发前会把更新附带的用户/频道挂到 _entities 上
+        update._entities = {}
+        updates.append(update)
+
+    # events.NewMessage(chats=...) 路径: 与 TelegramClient._dispatch_update 相同的构建和过滤
+    new_message = events.NewMessage(chats=-1000000000000 - monitor_id)
+    new_message.chats = {-1000000000000 - monitor_id}
+    new_message.resolved = True
+
+    def via_new_message(update):
+        event = EventBuilderDict(client, update, None)[events.NewMessage]
+        if event and new_message.filter(event):
+            return event.message
+        return None
+
+    raw = events.Raw(types.UpdateNewChannelMessage)
+    raw.resolved = True
+
+    def via_raw(update):
+        event = EventBuilderDict(client, update, None)[events.Raw]
+        if raw.filter(event):
+            return bot.monitor_message_from_update(event, monitor_id)
+        return None
+
+    a = [m.id for m in map(via_new_message, updates) if m is not None]
+    b = [m.id for m in map(via_raw, updates) if m is not None]
+    assert a == b, "两条路径交给处理函数的消息不一致"
+
+    print(f"updates={len(updates)} 监控频道占比={args.monitor_ratio:.0%} 命中 {len(a)} 条")
+    for name, func in (("events.NewMessage", via_new_message), ("events.Raw", via_raw)):
+        t = timeit(lambda: [func(u) for u in updates], args.repeat)
+        print(f"  {name:18s} {t / len(updates) * 1e6:7.2f} us/update")
+
+
+def io_counters():
+    """当前进程累计的写系统调用次数和写入字节数 (/proc/self/io，包括后台线程)"""
+    counters = {}
+    with open("/proc/self/io") as f:
+        for line in f:
+            key, value = line.split(":")
+            counters[key] = int(value)
+    return counters["syscw"], counters["wchar"]
+
+
+def bench_session(args):
+    bot = load_bot()
+    from telethon.sessions import SQLiteSession
+    from telethon.tl import types
+
+    rng = random.Random(args.seed)
+    os.chdir(tempfile.mkdtemp())
+    ids = rng.sample(range(10**9, 8 * 10**9), args.entities)
+
+    def user(uid):
+        return types.User(
+            id=uid, access_hash=uid * 7, first_name=f"u{uid}", username=f"user{uid}" if uid % 3 else None
+        )
+
+    def workload(session):
+        # 与 TelegramClient 相同的调用: 每批更新 process_entities，每隔 save_interval 秒保存更新状态并 save()
+        session.process_entities(types.contacts.ResolvedPeer(None, [], [user(uid) for uid in ids]))
+        session.save()
+        calls = []
+        syscw, wchar = io_counters()
+        last_save = time.perf_counter()
+        for i in range(args.updates):
+            start = time.perf_counter()
+            session.process_entities(
+                types.contacts.ResolvedPeer(None, [], [user(rng.choice(ids)) for _ in range(args.users_per_update)])
+            )
+            session.get_entity_rows_by_id(rng.choice(ids))
+            if start - last_save >= args.save_interval:
+                session.set_update_state(
+                    0, types.updates.State(i, 0, datetime.now(timezone.utc), i, unread_count=0)
+                )
+                session.save()
+                last_save = start
+            calls.append(time.perf_counter() - start)
+            time.sleep(1 / args.rate)
+        session.close()
+        end_syscw, end_wchar = io_counters()
+        return calls, end_syscw - syscw, end_wchar - wchar
+
+    print(
+        f"entities={args.entities} updates={args.updates} rate={args.rate:.0f}/s "
+        f"保存间隔={args.save_interval}s"
+    )
+    sessions = (
+        ("SQLite .session", lambda: SQLiteSession("bench")),
+        ("内存 + 快照", lambda: bot.SnapshotSession("bench.snapshot.json", interval=args.save_interval)),
+    )
+    for name, make in sessions:
+        session = make()
+        calls, syscw, wchar = workload(session)
+        if isinstance(session, bot.SnapshotSession):
+            session.writer.close()
+            restored = bot.SnapshotSession("bench.snapshot.json")
+            assert len(restored._entities) == args.entities, "快照恢复的实体数不一致"
+            restored.writer.close()
+        per_k = 1000 / args.updates
+        print(
+            f"  {name:16s} 写系统调用 {syscw * per_k:7.0f} 次/千条更新  写入 {wchar * per_k / 1024:8.0f} KB/千条更新  "
+            f"事件循环内耗时 p99={percentile(calls, 99) * 1e6:7.1f}us max={max(calls) * 1000:6.2f}ms"
+        )
+
+
+def bench_prewarm(args):
+    bot = load_bot()
+    from telethon.tl import types
+
+    bot.COOLDOWN_MESSAGE_SENT = 0
+    bot.COOLDOWN_USER_FETCH_FAILED = 0
+    bot.PREWARM_MEMBERS = True
+    bot.KEYWORD_ACTIONS = {"dmkw": {"action": "dm", "text": "dm"}}
+    rng = random.Random(args.seed)
+    groups = [1000000000 + g for g in range(args.groups)]
+    participants = {
+        int(f"-100{g}"): [
+            types.User(id=uid, access_hash=uid * 7, first_name="user", bot=False)
+            for uid in rng.sample(range(2 * 10**9, 8 * 10**9), args.members)
+        ]
+        for g in groups
+    }
+    notifications = []
+    for i in range(1, args.notifications + 1):
+        group = rng.choice(groups)
+        if rng.random() < args.member_ratio:
+            uid = rng.choice(participants[int(f"-100{group}")]).id
+        else:
+            uid = rng.randint(8 * 10**9, 9 * 10**9)
+        notifications.append(
+            f'#FOUND (https://t.me/c/{group}/{i}) "dmkw" IN group({group}) FROM user({uid})\ndmkw'
+        )
+
+    rules = bot.USER_FILTER_RULES
+
+    def run(prewarm, about=True):
+        bot.USER_FILTER_RULES = rules if about else [r for r in rules if r["type"] != "about"]
+        client = FakeClient(latency=args.latency, participants=participants)
+        instance = make_bot(bot, client)
+        instance.prewarmer.page_delay = args.page_delay
+        instance.prewarmer.busy_page_delay = args.busy_page_delay
+
+        async def feed():
+            if prewarm:
+                instance.prewarmer.start()
+            for i, text in enumerate(notifications, 1):
+                await instance.process_notification(make_notification(i, text))
+                await asyncio.sleep(args.interval)
+            await instance.lanes["dm"].drain()
+            instance.prewarmer.stop()
+
+        asyncio.run(feed())
+        instance.shutdown()
+        action_rpcs = client.rpc_count - client.participant_rpcs - len(client.sent)
+        label = ("预热" if prewarm else "不预热") + ("" if about else " (无 about 规则)")
+        print(
+            f"  {label} 私信 {len(client.sent)}，"
+            f"动作时解析/过滤 RPC {action_rpcs} 次 ({action_rpcs / len(notifications):.2f} 次/通知)，"
+            f"预热 RPC {client.participant_rpcs} 次"
+        )
+        if prewarm:
+            print(f"    {instance.prewarmer.report()}")
+
+    print(
+        f"groups={args.groups} members={args.members} notifications={args.notifications} "
+        f"发送者是群成员的比例={args.member_ratio:.0%}"
+    )
+    run(False)
+    run(True)
+    # 成员列表不带简介，about 规则对每个私信对象仍需要一次 GetFullUserRequest
+    run(True, about=False)
+
+
+class FlakyClient(FakeClient):
+    """第一次给 fail_users 中的用户发私信时失败"""
+
+    def __init__(self, fail_users=(), **kwargs):
+        super().__init__(**kwargs)
+        self.fail_users = set(fail_users)
+
+    async def send_message(self, entity, text, reply_to=None):
+        if reply_to is None and entity.user_id in self.fail_users:
+            await self._rpc()
+            self.fail_users.discard(entity.user_id)
+            raise ConnectionError("模拟发送失败")
+        await super().send_message(entity, text, reply_to)
+
+
+def bench_singleflight(args):
+    bot = load_bot()
+    bot.logger.setLevel(logging.CRITICAL)  # 模拟的发送失败不打印
+    bot.COOLDOWN_MESSAGE_SENT = 0
+    bot.COOLDOWN_USER_FETCH_FAILED = 0
+    bot.LANE_CONCURRENCY = {"reply": 4, "dm": args.concurrency}
+    bot.KEYWORD_ACTIONS = {"dmkw": {"action": "dm", "text": "dm"}}
+    rng = random.Random(args.seed)
+    senders = [f"{random_word(rng)}{i}" for i in range(args.users)]
+    # 每个发送者在不同群组里几乎同时触发 dup 条通知 (相邻到达)
+    rng.shuffle(senders)
+    burst = [(name, g) for name in senders for g in range(args.dup)]
+
+    def feed_texts(items, first_id):
+        return [
+            make_notification(
+                first_id + i,
+                f'#FOUND (https://t.me/c/{1000000000 + g}/{first_id + i}) "dmkw" IN group({g}) '
+                f"FROM user(@{name})\ndmkw",
+            )
+            for i, (name, g) in enumerate(items)
+        ]
+
+    def run(single_flight):
+        probe = FakeClient()
+        uid = {name: asyncio.run(probe.get_input_entity(name)).user_id for name in senders}
+        failing = {uid[name] for name in rng.sample(senders, args.failures)}
+        client = FlakyClient(fail_users=failing, latency=args.latency)
+        instance = make_bot(bot, client)
+        if not single_flight:
+            # 改动前: 每个动作独立获取和过滤
+            async def no_single_flight(key, factory):
+                return await factory()
+            instance.single_flight = no_single_flight
+
+        async def feed():
+            for message in feed_texts(burst, 1):
+                await instance.process_notification(message)
+            await instance.lanes["dm"].drain()
+            rpcs = client.rpc_count
+            # 发送失败的用户再来一条通知，应该能私信成功 (预留已释放)
+            retry = [(name, 0) for name in senders if uid[name] in failing]
+            for message in feed_texts(retry, len(burst) + 1):
+                await instance.process_notification(message)
+            await instance.lanes["dm"].drain()
+            return rpcs
+
+        rpcs = asyncio.run(feed())
+        instance.shutdown()
+
+        per_user = {}
+        for entity, _, _, _ in client.sent:
+            per_user[entity.user_id] = per_user.get(entity.user_id, 0) + 1
+        assert max(per_user.values()) == 1, "同一用户收到了多条私信"
+        assert len(per_user) == args.users, "发送失败的用户重试后没有收到私信"
+        print(
+            f"  {'单飞' if single_flight else '各自执行':4s} 通知 {len(burst)}，私信用户 {len(per_user)} "
+            f"(每人 1 条，其中 {len(failing)} 人首次发送失败)，"
+            f"获取/过滤/发送 RPC {rpcs} 次 ({rpcs / len(burst):.2f} 次/通知)"
+        )
+
+    print(
+        f"users={args.users} 每人通知={args.dup} 私信并发={args.concurrency} "
+        f"rpc_latency={args.latency * 1000:.0f}ms"
+    )
+    run(False)
+    run(True)
+
+
+def bench_coalesce(args):
+    bot = load_bot()
+    bot.COOLDOWN_MESSAGE_SENT = 0
+    bot.KEYWORD_ACTIONS = {
+        "hi": {"action": "reply", "text": "hi"},
+        "hello there": {"action": "reply", "text": "hello", "sticker_pack": "pack", "sticker_index": 0},
+    }
+    rng = random.Random(args.seed)
+    # 繁忙群组: 通知集中在少数几个群组，其中一部分同时命中两个回复关键词
+    stream = [
+        (rng.randint(1, args.groups), "hello there hi" if rng.random() < 0.3 else "hi")
+        for _ in range(args.notifications)
+    ]
+
+    def run(window):
+        bot.REPLY_COALESCE_WINDOW = window
+        client = FakeClient(latency=args.latency)
+        instance = make_bot(bot, client)
+        instance.sticker_cache[("pack", 0)] = object()
+
+        async def feed():
+            for i, (group, body) in enumerate(stream, 1):
+                text = f'#FOUND (https://t.me/c/{1000000000 + group}/{i}) "{body}" IN group({group}) FROM user(@u{i})\n{body}'
+                await instance.process_notification(make_notification(i, text))
+                await asyncio.sleep(args.interval)
+            instance.reply_coalescer.flush_all()
+            await instance.lanes["reply"].drain()
+
+        asyncio.run(feed())
+        instance.shutdown()
+        print(f"  窗口 {window:4.1f}s: 发送 RPC {len(client.sent):4d} 次 | {instance.reply_coalescer.report()}")
+
+    print(
+        f"notifications={args.notifications} groups={args.groups} "
+        f"间隔={args.interval * 1000:.0f}ms"
+    )
+    run(0)
+    run(args.window)
+
+
+def bench_admin(args):
+    bot = load_bot()
+    rng = random.Random(args.seed)
+    bot.KEYWORD_ACTIONS = make_keyword_actions(args.patterns, rng)
+    messages = make_messages(200, rng)
+    instance = make_bot(bot, FakeClient())
+
+    t0 = time.perf_counter()
+    bot.KeywordMatcher(bot.KEYWORD_ACTIONS)
+    rebuild = time.perf_counter() - t0
+
+    def command():
+        r = rng.random()
+        existing = rng.choice(list(bot.KEYWORD_ACTIONS))
+        if r < 0.35:
+            return "add(新字面量)", f"/kw add {random_word(rng)}{rng.randint(0, 999)} dm\n你好"
+        if r < 0.4:
+            return "add(正则)", f"/kw add '\\b{random_word(rng)}\\d+' reply regex"
+        if r < 0.7:
+            return "remove", f"/kw remove '{existing}'"
+        if r < 0.85:
+            return "action", f"/kw action '{existing}' {rng.choice(['reply', 'dm'])}"
+        return "text", f"/kw text '{existing}'\n新的文本"
+
+    latency = {}
+
+    async def run():
+        for _ in range(args.commands):
+            kind, text = command()
+            start = time.perf_counter()
+            reply = await instance.handle_admin_command(text)
+            latency.setdefault(kind, []).append(time.perf_counter() - start)
+            assert reply.startswith("已"), reply
+        # 无法合并进前瞻正则的正则和无效的正则: 前者照常生效，后者被拒绝且不影响已有的关键词
+        for text in ("/kw add '(?i)\\bbar' reply regex", "/kw add '(?P<n>ba)z' reply regex"):
+            assert (await instance.handle_admin_command(text)).startswith("已"), text
+        reply = await instance.handle_admin_command("/kw add '(unclosed' reply regex")
+        assert not reply.startswith("已"), reply
+        assert "(unclosed" not in instance.matcher.order
+        # 增量修改后的匹配结果与按当前配置逐个匹配一致
+        for msg in messages + ["BAR baz", "123z bar"]:
+            expected = reference_match(bot.KEYWORD_ACTIONS, msg, instance.matcher.normalizer.fold)
+            assert instance.matcher.match(msg) == expected, msg
+
+    asyncio.run(run())
+    instance.shutdown()
+    with open(bot.KEYWORDS_FILE, encoding="utf-8") as f:
+        assert json.load(f) == bot.KEYWORD_ACTIONS, "保存的关键词与内存中的不一致"
+
+    print(
+        f"keywords={args.patterns} commands={args.commands} 整体重建匹配器 {rebuild * 1000:.1f}ms "
+        f"(增量自动机 {instance.matcher.delta_size} 个字面量)"
+    )
+    for kind, values in sorted(latency.items()):
+        print(
+            f"  {kind:14s} n={len(values):4d} p50={percentile(values, 50) * 1e6:7.0f}us "
+            f"p99={percentile(values, 99) * 1e6:7.0f}us"
+        )
+
+    # /kw list 分页，每页不超过 Telegram 单条消息的长度
+    pages = 1
+    while True:
+        reply = asyncio.run(instance.handle_admin_command(f"/kw list {pages}"))
+        assert len(reply) <= 4096, len(reply)
+        if "下一页" not in reply:
+            break
+        pages += 1
+    print(f"  /kw list: {len(bot.KEYWORD_ACTIONS)} 个关键词分 {pages} 页")
+
+    # 动作还在合并窗口/通道里排队时删除关键词: 跳过，不抛出异常
+    bot.KEYWORD_ACTIONS = {"replykw": {"action": "reply", "text": "reply"}, "dmkw": {"action": "dm", "text": "dm"}}
+    bot.REPLY_COALESCE_WINDOW = 0.05
+    bot.COOLDOWN_MESSAGE_SENT = 0
+    errors = []
+    queued = make_bot(bot, FakeClient(latency=0.01))
+
+    async def remove_queued():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        await queued.process_notification(make_notification(
+            1, '#FOUND (https://t.me/c/1958152252/1) "replykw" IN group(1958152252) FROM user(2000000001)\n'
+            "replykw dmkw dmkw",
+        ))
+        for kw in ("replykw", "dmkw"):
+            await queued.handle_admin_command(f"/kw remove {kw}")
+        await queued.drain()
+
+    asyncio.run(remove_queued())
+    queued.shutdown()
+    gc.collect()
+    assert not errors, errors
+    print(f"  删除排队中的关键词: 发送 {len(queued.client.sent)} 条，没有异常")
+
+
+def _coldstart_child(load, probes, conn):
+    """在 fork 出的子进程中加载，测量耗时、内存增长和查询速度"""
+    rss = rss_mb()
+    start = time.perf_counter()
+    users = load()
+    elapsed = time.perf_counter() - start
+    grown = rss_mb() - rss
+    start = time.perf_counter()
+    hits = sum(1 for uid in probes if uid in users)
+    lookup = (time.perf_counter() - start) / len(probes)
+    conn.send((elapsed, grown, hits, lookup))
+    conn.close()
+
+
+def bench_coldstart(args):
+    import multiprocessing
+    from array import array
+
+    bot = load_bot()
+    ctx = multiprocessing.get_context("fork")
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        os.chdir(tempfile.mkdtemp())
+        ids = array("Q", sorted(set(rng.randint(10**8, 8 * 10**9) for _ in range(size))))
+        probes = [rng.choice(ids) if i % 2 else rng.randint(10**8, 8 * 10**9) for i in range(10000)]
+
+        # v4 格式的 JSON 文件，用它迁移出二进制文件
+        with open(bot.INTERACTED_FILE, "w", encoding="utf-8") as f:
+            json.dump({str(k): True for k in ids}, f, ensure_ascii=False, indent=2)
+        store = bot.InteractedUserStore()
+        store.close()
+        assert len(bot.InteractedUserStore()) == len(ids)
+        json_mb = os.path.getsize(bot.INTERACTED_FILE) / 2**20
+        bin_mb = os.path.getsize(bot.INTERACTED_SNAPSHOT) / 2**20
+
+        def load_json():
+            with open(bot.INTERACTED_FILE, "r", encoding="utf-8") as f:
+                return {int(k): True for k in json.load(f).keys()}
+
+        def load_mmap():
+            return bot.InteractedUserStore(legacy_json=None)
+
+        print(f"users={len(ids)}  JSON {json_mb:.0f}MB  二进制 {bin_mb:.0f}MB (文件已在页缓存中)")
+        for name, load in (("json.load + int()", load_json), ("mmap + 二分查找", load_mmap)):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_coldstart_child, args=(load, probes, child))
+            proc.start()
+            elapsed, grown, hits, lookup = parent.recv()
+            proc.join()
+            print(
+                f"  {name:18s} 启动 {elapsed * 1000:8.1f}ms  内存增长 {grown:7.1f}MB  "
+                f"查询 {lookup * 1e6:5.2f}us/次 (命中 {hits})"
+            )
+        del ids
+
+
+def bench_expiry(args):
+    bot = load_bot()
+    rng = random.Random(args.seed)
+    day = 86400
+    segments = args.horizon // args.segment + 1
+    print(f"再次联系间隔 {args.horizon} 天，每段 {args.segment} 天，共 {segments} 段")
+
+    # 启动时没有任何文件，之后一直没有私聊: 空段过期时没有文件可删
+    os.chdir(tempfile.mkdtemp())
+    clock = FakeClock(now=1.7e9)
+    store = bot.SegmentedInteractedUsers(args.horizon, args.segment, clock=clock)
+    clock.advance((args.horizon + args.segment) * day)
+    assert 12345 not in store and not store.segments
+    store.close()
+    for size in args.sizes:
+        os.chdir(tempfile.mkdtemp())
+        clock = FakeClock(now=1.7e9)
+        store = bot.SegmentedInteractedUsers(args.horizon, args.segment, clock=clock)
+        per_segment = size // segments
+        stamps = {}  # 对照: 逐个用户记录时间
+        for k in range(segments):
+            if k:
+                clock.advance(args.segment * day)
+            ids = set()
+            while len(ids) < per_segment:
+                ids.add(rng.randint(10**8, 8 * 10**9))
+            index = store._index(clock())
+            # 批量写入一段，避免逐个 add 触发合并
+            segment = store.segments.get(index) or bot.InteractedUserStore(store._path(index), legacy_json=None)
+            segment.delta |= ids
+            segment.writer.mark_dirty()
+            segment.close()
+            store.segments[index] = bot.InteractedUserStore(store._path(index), legacy_json=None)
+            store._next_expiry = min(store._next_expiry, (index + 1) * store.segment_seconds + store.horizon)
+            stamps.update(dict.fromkeys(ids, clock()))
+        probes = [rng.randint(10**8, 8 * 10**9) for _ in range(10000)]
+        live = len(store.segments)
+        start = time.perf_counter()
+        for uid in probes:
+            uid in store
+        lookup = (time.perf_counter() - start) / len(probes)
+
+        # 推进到最早一段刚好整段过期
+        clock.advance(args.segment * day)
+        before = len(store)
+        start = time.perf_counter()
+        dropped = store.expire()
+        segmented = time.perf_counter() - start
+        assert dropped and len(store) == before - dropped
+
+        cutoff = clock() - args.horizon * day
+        start = time.perf_counter()
+        stamps = {uid: t for uid, t in stamps.items() if t > cutoff}
+        scan = time.perf_counter() - start
+        store.close()
+        print(
+            f"  users={before:9d}  整段删除 {dropped:8d} 个用户 {segmented * 1000:7.2f}ms | "
+            f"逐个检查时间 {scan * 1000:8.1f}ms | 查询 {live} 段 {lookup * 1e6:5.2f}us/次"
+        )
+
+
+def bench_shadow(args):
+    bot = load_bot()
+    rng = random.Random(args.seed)
+    bot.KEYWORD_ACTIONS = make_keyword_actions(args.patterns, rng)
+    # 候选匹配器: 不做文本归一化 (规避写法的消息会不一致)；候选解析器: 与当前实现相同
+    candidate = bot.KeywordMatcher(bot.KEYWORD_ACTIONS, bot.TextNormalizer(False))
+    # 第二个监控机器人 (按发送者选择格式) 的通知用另一个解析器，影子比较要带上发送者才能选对
+    alt_sender = 777
+
+    def parse_alt(text):
+        return dict(bot.parse_found_notification(text), format="alt")
+
+    bot.NOTIFICATION_FORMATS = bot.NOTIFICATION_FORMATS + [
+        {"name": "alt", "sender": alt_sender, "parser": parse_alt}
+    ]
+
+    def candidate_parser(text, sender_id):
+        return parse_alt(text) if sender_id == alt_sender else bot.parse_found_notification(text)
+
+    texts = [
+        f'#FOUND (https://t.me/c/1958152252/{i}) "kw" IN group(1958152252) FROM user({2 * 10**9 + i})\n'
+        + (evade(m, rng) if rng.random() < 0.2 else m)
+        for i, m in enumerate(make_messages(args.notifications, rng), 1)
+    ]
+    # 部分通知的 #FOUND 是粗体: 实时路径按原始文本判别格式，markdown 还原后的文本以 ** 开头
+    from telethon.tl import types
+
+    def run(rate):
+        if rate:
+            bot.SHADOW_MATCHER = candidate.match
+            bot.SHADOW_PARSER = candidate_parser
+        instance = make_bot(bot, FakeClient())
+        if rate:
+            instance.shadow.sample_rate = rate
+        instance.cooldown_until = time.time() + 86400  # 只测量匹配，不执行动作
+        live = []
+
+        async def feed():
+            if instance.shadow is not None:
+                instance.shadow.start()
+            for i, text in enumerate(texts, 1):
+                message = make_notification(i, text)
+                message.sender_id = alt_sender if i % 10 == 0 else None
+                if i % 7 == 0:
+                    message.entities = [types.MessageEntityBold(0, len("#FOUND"))]
+                start = time.perf_counter()
+                await instance.process_notification(message)
+                live.append(time.perf_counter() - start)
+                await asyncio.sleep(args.interval)
+            if instance.shadow is not None:
+                instance.shadow.stop()
+
+        asyncio.run(feed())
+        instance.shutdown()
+        print(
+            f"  抽样 {rate:4.0%}: 实时路径 p50={percentile(live, 50) * 1e6:6.0f}us "
+            f"p99={percentile(live, 99) * 1e6:6.0f}us"
+        )
+        if instance.shadow is not None:
+            assert instance.shadow.stats["parser"]["mismatches"] == 0, "解析器影子比较没有使用实时路径选出的解析器"
+            for line in instance.shadow.report().split("\n"):
+                print(f"    {line}")
+            if os.path.exists(bot.SHADOW_MISMATCH_FILE):
+                with open(bot.SHADOW_MISMATCH_FILE, encoding="utf-8") as f:
+                    print(f"    不一致记录 {sum(1 for _ in f)} 条 -> {os.path.abspath(bot.SHADOW_MISMATCH_FILE)}")
+
+    print(f"patterns={len(bot.KEYWORD_ACTIONS)} notifications={args.notifications} 间隔={args.interval * 1000:.0f}ms")
+    for rate in (0, 0.1, 1.0):
+        run(rate)
+
+
+# 默认通知格式的测试语料: (通知文本, 发送者 id, 期望的格式名, 期望的解析结果)
+NOTIFICATION_CORPUS = [
+    (
+        '#FOUND (https://t.me/c/1958152252/4711) "airdrop" IN group(1958152252) FROM Alice(@alice_1)\nfree airdrop',
+        None,
+        "found",
+        {"source_channel": -1001958152252, "source_message_id": 4711, "keyword": "airdrop",
+         "sender_username": "alice_1", "sender_id": None},
+    ),
+    (
+        '#FOUND (https://t.me/cryptochat/88) "usdt" IN group(cryptochat) FROM Bob Smith(5123456789)\nsell usdt',
+        None,
+        "found",
+        {"source_channel": "cryptochat", "source_message_id": 88, "keyword": "usdt",
+         "sender_username": None, "sender_id": 5123456789},
+    ),
+    (
+        '#FOUND (https://t.me/c/1000000001/1) "多 词 关键词" IN group(1000000001) FROM 用户(@u)',
+        None,
+        "found",
+        {"source_channel": -1001000000001, "source_message_id": 1, "keyword": "多 词 关键词",
+         "sender_username": "u", "sender_id": None},
+    ),
+    (
+        "#FOUND (https://t.me/c/1958152252/2) IN group(1958152252)\n没有关键词和发送者",
+        None,
+        "found",
+        {"source_channel": -1001958152252, "source_message_id": 2, "keyword": None,
+         "sender_username": None, "sender_id": None},
+    ),
+    ("#FOUND", None, "found",
+     {"source_channel": None, "source_message_id": None, "keyword": None,
+      "sender_username": None, "sender_id": None}),
+    ("普通频道消息，不是通知", None, None, None),
+    ("  #FOUND (https://t.me/c/1/1) 前面有空格", None, None, None),
+    ("#found (https://t.me/c/1/1) 小写前缀", None, None, None),
+    ("", None, None, None),
+]
+
+
+def make_formats(bot, count):
+    """count 种额外的通知格式: 一半按前缀区分，一半按发送者区分，各自一个正则解析器"""
+    formats = list(bot.NOTIFICATION_FORMATS)
+    texts = []
+    for k in range(count):
+        pattern = re.compile(r"group=(\S+) msg=(\d+) kw=(\S+) user=(\d+)")
+
+        def parse(text, pattern=pattern):
+            m = pattern.search(text)
+            if not m:
+                return None
+            return {
+                "source_channel": m.group(1),
+                "source_message_id": int(m.group(2)),
+                "keyword": m.group(3),
+                "sender_username": None,
+                "sender_id": int(m.group(4)),
+            }
+
+        if k % 2:
+            formats.append({"name": f"sender{k}", "sender": 7 * 10**9 + k, "parser": parse})
+            texts.append((f"alert group=g{k} msg={k} kw=kw user=1\nbody", 7 * 10**9 + k))
+        else:
+            formats.append({"name": f"prefix{k}", "prefix": f"[ALERT{k}]", "parser": parse})
+            texts.append((f"[ALERT{k}] group=g{k} msg={k} kw=kw user=1\nbody", None))
+    return formats, texts
+
+
+def bench_formats(args):
+    bot = load_bot()
+    rng = random.Random(args.seed)
+
+    # 1. 默认格式的语料
+    formats = bot.NotificationFormats(bot.NOTIFICATION_FORMATS)
+    for text, sender, name, expected in NOTIFICATION_CORPUS:
+        entry = formats.select(text, sender)
+        assert (entry and entry[0]) == name, (text, entry)
+        if entry is not None:
+            assert entry[1](text) == expected, (text, entry[1](text), expected)
+    assert formats.unknown == sum(1 for c in NOTIFICATION_CORPUS if c[2] is None)
+    print(f"默认格式语料 {len(NOTIFICATION_CORPUS)} 条通过 | {formats.report()}")
+
+    # 解析器返回 None 的通知只计数，不执行动作
+    bot.KEYWORD_ACTIONS = {"kw": {"action": "reply", "text": "reply"}}
+    bot.NOTIFICATION_FORMATS = [{"name": "none", "prefix": "#NONE", "parser": lambda text: None}]
+    instance = make_bot(bot, FakeClient())
+
+    async def feed():
+        await instance.process_notification(make_notification(1, "#NONE kw"))
+        await instance.drain()
+
+    asyncio.run(feed())
+    instance.shutdown()
+    assert instance.formats.unparsed == 1 and not instance.client.sent
+
+    # 2. 多种格式时: 判别后只用一个解析器 vs 逐个尝试解析
+    for count in args.formats:
+        configured, extra = make_formats(bot, count)
+        formats = bot.NotificationFormats(configured)
+        parsers = [bot.NOTIFICATION_PARSERS.get(f["parser"]) or f["parser"] for f in configured]
+        stream = []
+        for i, text in enumerate(make_messages(args.messages, rng, length=30)):
+            r = rng.random()
+            if r < 0.1:
+                stream.append(("频道里的其它消息 " + text[60:], None))
+            elif r < 0.55 or not extra:
+                stream.append((text, None))
+            else:
+                stream.append(rng.choice(extra))
+
+        def dispatch():
+            for text, sender in stream:
+                entry = formats.select(text, sender)
+                if entry is not None:
+                    entry[1](text)
+
+        def trial():
+            # 按顺序尝试每个解析器，直到得到源群组
+            for text, sender in stream:
+                for parse in parsers:
+                    info = parse(text)
+                    if info and info["source_channel"] is not None:
+                        break
+
+        for text, sender in stream:
+            entry = formats.find(text, sender)
+            if entry is not None:
+                assert entry[1](text)["source_channel"] is not None, text
+        t_dispatch = timeit(dispatch, args.repeat) / len(stream)
+        t_trial = timeit(trial, args.repeat) / len(stream)
+        print(
+            f"  formats={len(configured):3d}  判别 {t_dispatch * 1e6:6.2f}us/条 | "
+            f"逐个尝试 {t_trial * 1e6:7.2f}us/条 | x{t_trial / t_dispatch:5.1f}"
+        )
+
+
+class WriteForbiddenClient(FakeClient):
+    """在 forbidden 里的群组发送时失败 (模拟账号被禁言/封禁)，失败前同样消耗一次 RPC"""
+
+    def __init__(self, forbidden, **kwargs):
+        super().__init__(**kwargs)
+        self.forbidden = forbidden
+        self.failed = 0
+
+    async def send_message(self, entity, text, reply_to=None):
+        if isinstance(entity, int) and entity in self.forbidden:
+            await self._rpc()
+            self.failed += 1
+            raise RuntimeError("CHAT_WRITE_FORBIDDEN")
+        await super().send_message(entity, text, reply_to=reply_to)
+
+
+def bench_policy(args):
+    bot = load_bot()
+    bot.REPLY_COALESCE_WINDOW = 0
+    bot.COOLDOWN_MESSAGE_SENT = 0
+    bot.COOLDOWN_USER_FETCH_FAILED = 0
+    bot.KEYWORD_ACTIONS = {
+        "replykw": {"action": "reply", "text": "reply"},
+        "dmkw": {"action": "dm", "text": "dm"},
+    }
+    rng = random.Random(args.seed)
+    bot.logger.setLevel(logging.CRITICAL)  # 模拟的发送失败不打印
+    groups = [int(f"-100{10**9 + g}") for g in range(args.groups)]
+    rng.shuffle(groups)
+    denied = groups[: int(len(groups) * args.denied)]
+    reply_only = groups[len(denied): len(denied) + int(len(groups) * args.reply_only)]
+    # 策略表同时用数字 ID 和用户名 (这里用 "-100..." 字符串) 两种写法
+    policies = {g: {"deny": True} for g in denied[::2]}
+    policies.update({str(g): {"deny": True} for g in denied[1::2]})
+    policies.update({g: {"actions": ["reply"]} for g in reply_only})
+    texts = []
+    for i in range(1, args.notifications + 1):
+        group = rng.choice(groups)
+        kws = rng.choice((["replykw"], ["dmkw"], ["replykw", "dmkw"]))
+        texts.append(
+            f'#FOUND (https://t.me/c/{str(group)[4:]}/{i}) "{kws[0]}" IN group({group}) '
+            f"FROM user({2 * 10**9 + i})\n" + " ".join(kws)
+        )
+
+    def run(label, table):
+        bot.SOURCE_POLICIES = table
+        client = WriteForbiddenClient(set(denied), latency=args.latency)
+        instance = make_bot(bot, client)
+
+        async def feed():
+            for i, text in enumerate(texts, 1):
+                await instance.process_notification(make_notification(i, text))
+            for lane in instance.lanes.values():
+                await lane.drain()
+
+        start = time.perf_counter()
+        asyncio.run(feed())
+        elapsed = time.perf_counter() - start
+        instance.shutdown()
+        replies = sum(1 for _, _, reply_to, _ in client.sent if reply_to is not None)
+        print(
+            f"  {label}: RPC {client.rpc_count:5d} 次 | 发送失败 {client.failed:4d} 次 | "
+            f"群回复 {replies:4d} 条，私信 {len(client.sent) - replies:4d} 条 | {elapsed:5.2f}s"
+        )
+        if table:
+            print(f"    {instance.source_policies.report()}")
+
+    print(
+        f"groups={args.groups} (禁言 {len(denied)}，只回复 {len(reply_only)}) "
+        f"notifications={args.notifications} rpc_latency={args.latency * 1000:.0f}ms"
+    )
+    run("无策略  ", {})
+    run("策略表  ", policies)
+
+    # 每条通知检查策略的开销
+    table = bot.SourcePolicies(policies)
+    channels = [rng.choice(groups) for _ in range(10000)]
+    matches = ["replykw", "dmkw"]
+
+    def check():
+        for channel in channels:
+            table.filter(channel, matches)
+
+    print(f"  策略检查 {timeit(check, 5) / len(channels) * 1e9:.0f}ns/条 ({len(policies)} 个群组)")
+
+
+class UnreachableClient(FakeClient):
+    """向 forbidden 群组回复、向 privacy / blocked 用户私信时抛出对应的 Telethon 错误"""
+
+    def __init__(self, forbidden, privacy, blocked, **kwargs):
+        super().__init__(**kwargs)
+        self.forbidden = forbidden
+        self.privacy = privacy
+        self.blocked = blocked
+        self.failed = 0
+
+    async def get_input_entity(self, peer):
+        # @u<n> 与 user(2e9 + n) 是同一个用户
+        await self._rpc()
+        return SimpleNamespace(user_id=2 * 10**9 + int(peer[1:]))
+
+    async def send_message(self, entity, text, reply_to=None):
+        from telethon import errors
+
+        error = None
+        if isinstance(entity, int):
+            if entity in self.forbidden:
+                error = errors.ChatWriteForbiddenError(request=None)
+        elif entity.user_id in self.privacy:
+            error = errors.UserPrivacyRestrictedError(request=None)
+        elif entity.user_id in self.blocked:
+            error = errors.UserIsBlockedError(request=None)
+        if error is not None:
+            await self._rpc()
+            self.failed += 1
+            raise error
+        await super().send_message(entity, text, reply_to=reply_to)
+
+
+def bench_negative(args):
+    bot = load_bot()
+    bot.logger.setLevel(logging.CRITICAL)  # 模拟的发送失败不打印
+    bot.REPLY_COALESCE_WINDOW = 0
+    bot.COOLDOWN_USER_FETCH_FAILED = 0
+    bot.KEYWORD_ACTIONS = {
+        "replykw": {"action": "reply", "text": "reply"},
+        "dmkw": {"action": "dm", "text": "dm"},
+    }
+    rng = random.Random(args.seed)
+    groups = [int(f"-100{10**9 + g}") for g in range(args.groups)]
+    forbidden = set(rng.sample(groups, int(len(groups) * args.unreachable)))
+    users = list(range(1, args.users + 1))
+    bad = rng.sample(users, int(len(users) * args.unreachable))
+    privacy = {2 * 10**9 + u for u in bad[::2]}
+    blocked = {2 * 10**9 + u for u in bad[1::2]}
+    texts = []
+    for i in range(1, args.notifications + 1):
+        group = rng.choice(groups)
+        # 消息 id 即发送者: FakeClient.get_messages 返回的 from_id 是 2e9 + 消息 id
+        mid = rng.choice(users)
+        kw = "dmkw" if rng.random() < 0.5 else "replykw"
+        # 一半的通知只带 username
+        sender = f"@u{mid}" if rng.random() < 0.5 else 2 * 10**9 + mid
+        texts.append(
+            f'#FOUND (https://t.me/c/{str(group)[4:]}/{mid}) "{kw}" IN group({group}) '
+            f"FROM user({sender})\n{kw}"
+        )
+    classes = bot.SEND_ERROR_CLASSES
+
+    def run(label, classified, cooldown):
+        # 不分类时所有失败都是 send_error (改动前的行为)
+        bot.SEND_ERROR_CLASSES = classes if classified else []
+        bot.COOLDOWN_MESSAGE_SENT = cooldown
+        clock = FakeClock()
+        client = UnreachableClient(forbidden, privacy, blocked, latency=args.latency)
+        instance = make_bot(bot, client, clock=clock)
+
+        async def feed():
+            for i, text in enumerate(texts, 1):
+                date = datetime.fromtimestamp(clock(), timezone.utc)
+                await instance.process_notification(make_notification(i, text, date))
+                for lane in instance.lanes.values():
+                    await lane.drain()
+                clock.advance(args.gap)
+
+        asyncio.run(feed())
+        instance.shutdown()
+        print(
+            f"  {label}: RPC {client.rpc_count:5d} 次 | 发送失败 {client.failed:4d} 次 | "
+            f"成功发送 {len(client.sent):4d} 条"
+        )
+        if classified:
+            print(f"    {instance.negative_cache.report()}")
+
+    print(
+        f"groups={args.groups} users={args.users} 不可达比例={args.unreachable:.0%} "
+        f"notifications={args.notifications} (每 {args.gap:.0f}s 一条)"
+    )
+    print(" 无冷却:")
+    run("不分类", False, 0)
+    run("负缓存", True, 0)
+    print(f" 冷却 {args.cooldown:.0f}s:")
+    run("不分类", False, args.cooldown)
+    run("负缓存", True, args.cooldown)
+
+
+def bench_pool(args):
+    bot = load_bot()
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    bot.KEYWORD_ACTIONS = make_keyword_actions(args.patterns, rng)
+    texts = make_messages(args.notifications, rng, length=args.length)
+    reference = bot.KeywordMatcher(bot.KEYWORD_ACTIONS)
+    expected = [reference.match(text) for text in texts]
+    print(
+        f"patterns={len(bot.KEYWORD_ACTIONS)} notifications={args.notifications} "
+        f"每条 {args.length} 词 | 构建匹配器 {time.perf_counter() - start:.1f}s | CPU {os.cpu_count()} 核"
+    )
+
+    def run(processes):
+        bot.MATCHER_PROCESSES = processes
+        instance = make_bot(bot, FakeClient())
+        seen = []
+        # 只记录交给动作阶段的结果和顺序
+        instance.dispatch_matches = lambda message, parse, msg, matches: seen.append((message.id, matches))
+        gaps = []
+
+        async def ticker(stop):
+            # 事件循环被占用的时间: 1ms 的定时器实际等了多久
+            last = time.perf_counter()
+            while not stop.is_set():
+                await asyncio.sleep(0.001)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        async def feed():
+            warm = 0.0
+            if instance.matcher_pool is not None:
+                # 等所有工作进程构建好匹配器
+                t0 = time.perf_counter()
+                loop = asyncio.get_running_loop()
+                await asyncio.gather(*(
+                    loop.run_in_executor(instance.matcher_pool.executor, bot._match_in_worker, "")
+                    for _ in range(processes * 4)
+                ))
+                warm = time.perf_counter() - t0
+            stop = asyncio.Event()
+            tick = asyncio.ensure_future(ticker(stop))
+            t0 = time.perf_counter()
+            for i, text in enumerate(texts, 1):
+                await instance.process_notification(make_notification(i, text))
+                await asyncio.sleep(0)
+            if instance.matcher_pool is not None:
+                await instance.matcher_pool.drain()
+            elapsed = time.perf_counter() - t0
+            stop.set()
+            await tick
+            return warm, elapsed
+
+        warm, elapsed = asyncio.run(feed())
+        instance.shutdown()
+        assert [m for _, m in seen] == expected, "结果或顺序不一致"
+        assert [i for i, _ in seen] == list(range(1, len(texts) + 1))
+        assert instance.checkpoint.done == len(texts), instance.checkpoint.done
+        label = "事件循环内" if not processes else f"{processes} 个进程"
+        print(
+            f"  {label:6s}: {len(texts) / elapsed:7.0f} 条/s | 事件循环最长阻塞 {max(gaps) * 1000:7.1f}ms "
+            f"p99 {percentile(gaps, 99) * 1000:6.1f}ms" + (f" | 启动 {warm:.1f}s" if processes else "")
+        )
+
+    for processes in [0] + args.processes:
+        run(processes)
+
+    # 只有增删关键词、修改匹配方式时才换工作进程；换进程时被取消的匹配跳过，不影响后面的消息
+    bot.KEYWORD_ACTIONS = {"kw": {"action": "reply", "text": "reply"}}
+    bot.MATCHER_PROCESSES = 1
+    instance = make_bot(bot, FakeClient())
+    seen = []
+    pool = instance.matcher_pool
+
+    async def edits():
+        for text in ("/kw text kw\n新的文本", "/kw action kw dm", "/kw sticker kw pack 1"):
+            assert (await instance.handle_admin_command(text)).startswith("已"), text
+        assert pool.reloads == 0, pool.reloads
+        assert (await instance.handle_admin_command("/kw add other reply\nhi")).startswith("已")
+        assert pool.reloads == 1, pool.reloads
+        for text in ("kw", "other", "kw other"):
+            pool.submit(text, seen.append)
+        pool.pending[0][0].cancel()
+        await pool.drain()
+
+    asyncio.run(edits())
+    instance.shutdown()
+    assert seen == [["other"], ["kw", "other"]], seen
+    print(f"  关键词管理命令: 修改文本/动作/贴纸不换进程，增加关键词换 {pool.reloads} 次")
+
+    # 回调出错不能卡住后面的结果；旧进程返回的已删除关键词不交给动作阶段
+    instance = make_bot(bot, FakeClient())
+    pool = instance.matcher_pool
+    seen = []
+
+    def broken(matches):
+        raise RuntimeError("boom")
+
+    async def failures():
+        pool.submit("kw", broken)
+        pool.submit("kw other", seen.append)
+        del bot.KEYWORD_ACTIONS["other"]
+        await pool.drain()
+
+    asyncio.run(failures())
+    instance.shutdown()
+    assert seen == [["kw"]], seen
+    assert not pool.pending, len(pool.pending)
+    print("  回调出错不影响后面的结果，已删除的关键词被丢弃")
+
+
+def bench_handoff(args):
+    bot = load_bot()
+    bot.REPLY_COALESCE_WINDOW = 0
+    bot.COOLDOWN_MESSAGE_SENT = 0
+    bot.KEYWORD_ACTIONS = {"replykw": {"action": "reply", "text": "reply"}}
+    bot.HANDOFF_SOCKET = "handoff.sock"
+
+    async def scenario(mode):
+        os.chdir(tempfile.mkdtemp())  # 新旧进程共用同一个目录里的状态文件
+        history = []  # 监控频道
+        arrived, handled = {}, {}
+        duplicates = 0
+
+        def create():
+            client = FakeClient(latency=args.latency)
+            client.monitor_messages = history
+            instance = bot.KeywordMonitorBot(client=client)
+            dispatch = instance.dispatch_matches
+
+            def tracked(message, parse, msg, matches):
+                nonlocal duplicates
+                if message.id in handled:
+                    duplicates += 1
+                handled[message.id] = time.perf_counter()
+                dispatch(message, parse, msg, matches)
+
+            instance.dispatch_matches = tracked
+            return instance
+
+        running = [create()]
+        if mode == "handoff":
+            await running[0].listen_handoff()
+
+        async def produce():
+            for i in range(1, args.notifications + 1):
+                message = make_notification(i, f'#FOUND (https://t.me/c/1958152252/{i}) "replykw"\nreplykw')
+                history.append(message)
+                arrived[i] = time.perf_counter()
+                # 实时更新只推送给还连接着的进程
+                for instance in running:
+                    if not instance.client.disconnected:
+                        asyncio.ensure_future(instance.on_monitor_message(message))
+                await asyncio.sleep(args.interval)
+
+        async def restart():
+            await asyncio.sleep(args.restart_at)
+            old = running[0]
+            if mode == "restart":
+                # 改动前: 旧进程断开并退出，新进程启动 (登录、预加载贴纸) 后补处理
+                await old.client.disconnect()
+                await old.drain()
+                old.shutdown()
+                await asyncio.sleep(args.warmup)
+                new = create()
+                running.append(new)
+                async with new.monitor_lock:
+                    await new.catch_up()
+            else:
+                # 新进程先启动预热，旧进程继续处理；预热完成后交接
+                new = create()
+                await asyncio.sleep(args.warmup)
+                running.append(new)
+                async with new.monitor_lock:
+                    await new.take_over()
+                    await new.catch_up()
+                await new.listen_handoff()
+            return new
+
+        _, new = await asyncio.gather(produce(), restart())
+        await asyncio.sleep(0.2)
+        await new.drain()
+        new.shutdown()
+        if new.handoff_server is not None:
+            new.handoff_server.close()
+
+        lost = args.notifications - len(handled)
+        delays = [handled[i] - arrived[i] for i in handled]
+        times = sorted(handled.values())
+        gap = max(b - a for a, b in zip(times, times[1:]))
+        print(
+            f"  {mode:8s}: 丢失 {lost} 条，重复 {duplicates} 条 | 处理间隔最长 {gap * 1000:6.0f}ms | "
+            f"延迟 p50={percentile(delays, 50) * 1000:5.0f}ms p99={percentile(delays, 99) * 1000:6.0f}ms "
+            f"max={max(delays) * 1000:6.0f}ms"
+        )
+
+    print(
+        f"notifications={args.notifications} 间隔={args.interval * 1000:.0f}ms "
+        f"第 {args.restart_at:.1f}s 重启，新进程启动耗时 {args.warmup:.1f}s"
+    )
+    for mode in ("restart", "handoff"):
+        asyncio.run(scenario(mode))
+
+    # 旧进程取消交接 (连接后直接断开) 时新进程不接手；socket 文件还在但旧进程已经退出时按保存的状态启动
+    async def refused():
+        new = make_bot(bot, FakeClient())  # 在新的临时目录里
+
+        async def cancel(reader, writer):
+            writer.close()
+
+        server = await asyncio.start_unix_server(cancel, path=bot.HANDOFF_SOCKET)
+        alive = new.peer_alive
+        new.peer_alive = lambda: alive(timeout=0.5, interval=0.1)
+        assert not await new.take_over(), "旧进程仍在运行时接手了"
+        server.close()
+        await server.wait_closed()
+        assert os.path.exists(bot.HANDOFF_SOCKET)
+        assert await new.take_over(), "旧进程退出后没有按保存的状态启动"
+        new.shutdown()
+        new.shutdown()
+
+    asyncio.run(refused())
+    print("  交接被取消时不接手，旧进程退出后正常启动")
+
+    # 检查旧进程是否还在运行的连接不会开始交接，也不会记录 "取消交接"
+    async def probe():
+        old = make_bot(bot, FakeClient())
+        await old.listen_handoff()
+        new = bot.KeywordMonitorBot(client=FakeClient())
+        warnings = []
+        handler = logging.Handler(logging.WARNING)
+        handler.emit = warnings.append
+        bot.logger.addHandler(handler)
+        try:
+            assert await new.peer_alive(timeout=0.3, interval=0.1)
+            await asyncio.sleep(0.1)
+        finally:
+            bot.logger.removeHandler(handler)
+        assert not old.handed_off and not old.client.disconnected
+        assert not warnings, [record.getMessage() for record in warnings]
+        old.handoff_server.close()
+        old.shutdown()
+        new.shutdown()
+
+    asyncio.run(probe())
+    print("  探测旧进程不会触发交接")
+
+
+# ---------------- 版本化的基准测试套件 ----------------
+def current_version():
+    """当前代码的版本: git 提交 (工作区有修改时加 -dirty)，不在 git 仓库里时为 dev"""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=BOT_FILE.parent, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "dev"
+
+
+def make_entities(text):
+    """监控机器人通知里常见的格式: 话题标签、链接、加粗的关键词、带链接的发送者名字"""
+    from telethon.tl.types import (
+        MessageEntityBold,
+        MessageEntityHashtag,
+        MessageEntityTextUrl,
+        MessageEntityUrl,
+    )
+
+    first = text.split("\n", 1)[0]
+    entities = [MessageEntityHashtag(0, len("#FOUND"))]
+    start = first.find("https://")
+    entities.append(MessageEntityUrl(start, first.find(")", start) - start))
+    start = first.find('"')
+    entities.append(MessageEntityBold(start, first.find('"', start + 1) + 1 - start))
+    start = first.find("FROM ")
+    entities.append(MessageEntityTextUrl(start + 5, 4, "tg://user?id=1"))
+    # 正文里每隔几个词加粗一个
+    offset = len(first) + 1
+    for i, word in enumerate(text[offset:].split(" ")):
+        if i % 7 == 0 and word:
+            entities.append(MessageEntityBold(offset, len(word)))
+        offset += len(word) + 1
+    return entities
+
+
+def suite_matcher(bot, args, rng, metrics):
+    from telethon.extensions import markdown
+
+    for patterns in (1000, 10000):
+        bot.KEYWORD_ACTIONS = make_keyword_actions(patterns, rng)
+        instance = make_bot(bot, FakeClient())
+        messages = make_messages(args.messages, rng)
+        runs = [timeit(lambda: [instance.check_keywords(m) for m in messages], 1) for _ in range(args.repeat)]
+        metrics[f"check_keywords_{patterns // 1000}k"] = (statistics.median(runs) / len(messages) * 1e6, "us")
+        instance.shutdown()
+
+    runs = [timeit(lambda: [instance.parse_notification_message(m) for m in messages], 1) for _ in range(args.repeat)]
+    metrics["parse_notification"] = (statistics.median(runs) / len(messages) * 1e6, "us")
+
+    entities = [make_entities(m) for m in messages]
+    runs = [
+        timeit(lambda: [markdown.unparse(m, e) for m, e in zip(messages, entities)], 1)
+        for _ in range(args.repeat)
+    ]
+    metrics["markdown_unparse"] = (statistics.median(runs) / len(messages) * 1e6, "us")
+
+
+def suite_interacted(bot, args, rng, metrics):
+    os.chdir(tempfile.mkdtemp())
+    store = bot.InteractedUserStore(legacy_json=None)
+    ids = set()
+    while len(ids) < args.users:
+        ids.add(rng.randint(10**8, 8 * 10**9))
+    store.delta = ids
+    store.writer.mark_dirty()
+    store.close()
+    probes = [rng.randint(10**8, 8 * 10**9) for _ in range(10000)]
+
+    loads, saves, lookups = [], [], []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        store = bot.InteractedUserStore(legacy_json=None)
+        loads.append(time.perf_counter() - start)
+        assert len(store) >= args.users
+        # 第一遍把用到的页映射进来，只计第二遍
+        [p in store for p in probes]
+        lookups.append(timeit(lambda: [p in store for p in probes], 1) / len(probes))
+        # 私信了 100 个新用户后写盘: 合并进数组并写成新文件
+        for _ in range(100):
+            store.add(rng.randint(10**8, 8 * 10**9))
+        start = time.perf_counter()
+        store.writer.flush()
+        saves.append(time.perf_counter() - start)
+        store.close()
+    label = f"{args.users // 1000}k" if args.users < 10**6 else f"{args.users // 10**6}m"
+    metrics[f"interacted_load_{label}"] = (statistics.median(loads) * 1000, "ms")
+    metrics[f"interacted_save_{label}"] = (statistics.median(saves) * 1000, "ms")
+    metrics[f"interacted_lookup_{label}"] = (statistics.median(lookups) * 1e9, "ns")
+
+
+def suite_handler(bot, args, rng, metrics):
+    """端到端: 通知进入 on_monitor_message 到模拟客户端发出第一条回复的延迟"""
+    bot.REPLY_COALESCE_WINDOW = 0
+    bot.COOLDOWN_MESSAGE_SENT = 0
+    bot.KEYWORD_ACTIONS = make_keyword_actions(1000, rng)
+    for cfg in bot.KEYWORD_ACTIONS.values():
+        cfg["text"] = "reply"
+    client = FakeClient()
+    instance = make_bot(bot, client)
+    texts = [
+        f'#FOUND (https://t.me/c/1958152252/{i}) "kw" IN group(1958152252) FROM user({2 * 10**9 + i})\n'
+        + m.split("\n", 1)[1]
+        for i, m in enumerate(make_messages(args.messages * args.repeat, rng), 1)
+    ]
+    received = {}
+
+    async def feed():
+        for i, text in enumerate(texts, 1):
+            received[i] = time.perf_counter()
+            await instance.on_monitor_message(make_notification(i, text))
+            for lane in instance.lanes.values():
+                await lane.drain()
+
+    asyncio.run(feed())
+    instance.shutdown()
+    first = {}
+    for _, _, reply_to, sent_at in client.sent:
+        first.setdefault(reply_to, sent_at)
+    latency = [first[i] - received[i] for i in first]
+    metrics["handler_p50"] = (percentile(latency, 50) * 1e6, "us")
+    metrics["handler_p99"] = (percentile(latency, 99) * 1e6, "us")
+
+
+def run_suite(args):
+    bot = load_bot()
+    metrics = {}
+    for part in (suite_matcher, suite_interacted, suite_handler):
+        part(bot, args, random.Random(args.seed), metrics)
+    return {
+        "version": args.version or current_version(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()} {os.cpu_count()} CPU",
+        "params": {"messages": args.messages, "users": args.users, "repeat": args.repeat, "seed": args.seed},
+        # 所有指标都是越小越好
+        "metrics": {name: {"value": round(value, 3), "unit": unit} for name, (value, unit) in metrics.items()},
+    }
+
+
+def bench_suite(args):
+    result = run_suite(args)
+    print(f"版本 {result['version']} | Python {result['python']} | {result['machine']}")
+    for name, m in result["metrics"].items():
+        print(f"  {name:24s} {m['value']:12.2f} {m['unit']}")
+    if args.save:
+        BASELINE_DIR.mkdir(exist_ok=True)
+        path = BASELINE_DIR / f"{result['version']}.json"
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存: {path}")
+
+
+def load_baseline(name):
+    """版本名 (benchmarks/<版本>.json) 或 JSON 文件路径"""
+    path = Path(name)
+    if not path.exists():
+        path = BASELINE_DIR / f"{name}.json"
+    if not path.exists():
+        sys.exit(f"找不到基线 {name} (也不在 {BASELINE_DIR} 里)")
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def bench_compare(args):
+    if args.baseline:
+        baseline = load_baseline(args.baseline)
+    else:
+        saved = sorted(BASELINE_DIR.glob("*.json"), key=os.path.getmtime)
+        if not saved:
+            # 基线与机器有关，仓库里不提交；没有基线时不算失败
+            print(f"{BASELINE_DIR} 里还没有基线，跳过比较。先在同一台机器上运行 suite --save 保存一个基线")
+            return
+        baseline = load_baseline(str(saved[-1]))
+    current = load_baseline(args.current) if args.current else run_suite(args)
+    if baseline["params"] != current["params"]:
+        print(f"注意: 参数不同 {baseline['params']} vs {current['params']}")
+    if baseline["machine"] != current["machine"]:
+        print(f"注意: 机器不同 {baseline['machine']} vs {current['machine']}")
+
+    print(f"基线 {baseline['version']} -> 当前 {current['version']} (阈值 {args.threshold:.0%})")
+    regressions = []
+    for name, m in current["metrics"].items():
+        old = baseline["metrics"].get(name)
+        if old is None:
+            print(f"  {name:24s} {'':>12s} -> {m['value']:10.2f} {m['unit']:2s}  新增")
+            continue
+        change = m["value"] / old["value"] - 1 if old["value"] else 0.0
+        mark = ""
+        if change > args.threshold:
+            mark = "  回归"
+            regressions.append(name)
+        elif change < -args.threshold:
+            mark = "  提升"
+        print(f"  {name:24s} {old['value']:10.2f} -> {m['value']:10.2f} {m['unit']:2s} {change:+7.1%}{mark}")
+    for name in baseline["metrics"].keys() - current["metrics"].keys():
+        print(f"  {name:24s} 已删除")
+    if regressions:
+        print(f"{len(regressions)} 项超过阈值: {', '.join(regressions)}")
+        sys.exit(1)
+    print("没有超过阈值的回归")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("matcher", help="组合关键词匹配器 vs 逐个匹配")
+    p.add_argument("--patterns", type=int, default=1000)
+    p.add_argument("--messages", type=int, default=200)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_matcher)
+
+    p = sub.add_parser("normalize", help="文本归一化吞吐量")
+    p.add_argument("--messages", type=int, default=500)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_normalize)
+
+    p = sub.add_parser("persist", help="私信突发时事件循环的阻塞时间: 同步写盘 vs 后台写盘")
+    p.add_argument("--users", type=int, default=200000)
+    p.add_argument("--dms", type=int, default=50)
+    p.add_argument("--gap", type=float, default=0.01, help="两次私信间隔 (秒)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_persist)
+
+    p = sub.add_parser("catchup", help="重启后补处理漏掉通知的吞吐量")
+    p.add_argument("--messages", type=int, default=5000)
+    p.add_argument("--stale", type=int, default=1000)
+    p.add_argument("--latency", type=float, default=0.05, help="模拟每次 RPC 的延迟 (秒)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_catchup)
+
+    p = sub.add_parser("lanes", help="群回复/私信分通道执行的延迟分位数")
+    p.add_argument("--notifications", type=int, default=300)
+    p.add_argument("--dm-ratio", type=float, default=0.5)
+    p.add_argument("--interval", type=float, default=0.02, help="通知到达间隔 (秒)")
+    p.add_argument("--latency", type=float, default=0.02, help="模拟每次 RPC 的延迟 (秒)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_lanes)
+
+    p = sub.add_parser("soak", help="模拟时钟下的长时间运行: 内存、状态大小和处理延迟")
+    p.add_argument("--days", type=int, default=28)
+    p.add_argument("--rate", type=float, default=60, help="每小时的通知数")
+    p.add_argument("--match-ratio", type=float, default=0.5)
+    p.add_argument("--no-cooldown", action="store_true", help="关闭冷却，测试状态增长上限")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_soak)
+
+    p = sub.add_parser("loop", help="默认事件循环 vs uvloop 的离线回放吞吐量和延迟")
+    p.add_argument("--notifications", type=int, default=5000)
+    p.add_argument("--latency", type=float, default=0.001, help="模拟每次 RPC 的延迟 (秒)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_loop)
+
+    p = sub.add_parser("coordination", help="多个实例共享 SQLite 协调存储时不会重复动作")
+    p.add_argument("--instances", type=int, default=3)
+    p.add_argument("--notifications", type=int, default=200)
+    p.add_argument("--latency", type=float, default=0.005, help="模拟每次 RPC 的延迟 (秒)")
+    p.set_defaults(func=bench_coordination)
+
+    p = sub.add_parser("filter", help="按代价排序的用户过滤规则节省的 RPC")
+    p.add_argument("--users", type=int, default=10000)
+    p.add_argument("--old-ratio", type=float, default=0.3, help="user_id 低于 MIN_USER_ID 的比例")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_filter)
+
+    p = sub.add_parser("ingest", help="原始更新路径 vs events.NewMessage 的每条更新开销")
+    p.add_argument("--updates", type=int, default=20000)
+    p.add_argument("--monitor-ratio", type=float, default=0.1, help="来自监控频道的更新比例")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_ingest)
+
+    p = sub.add_parser("session", help="Telethon 会话: SQLite 文件 vs 内存 + 定期快照的写盘次数")
+    p.add_argument("--entities", type=int, default=5000)
+    p.add_argument("--updates", type=int, default=1000)
+    p.add_argument("--users-per-update", type=int, default=2)
+    p.add_argument("--rate", type=float, default=500, help="每秒更新数")
+    p.add_argument("--save-interval", type=float, default=0.5, help="保存间隔 (秒)，对应 Telethon 的每分钟保存")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_session)
+
+    p = sub.add_parser("prewarm", help="源群组成员预热后私信动作需要的 RPC")
+    p.add_argument("--groups", type=int, default=5)
+    p.add_argument("--members", type=int, default=2000)
+    p.add_argument("--notifications", type=int, default=500)
+    p.add_argument("--member-ratio", type=float, default=0.9)
+    p.add_argument("--interval", type=float, default=0.05, help="通知到达间隔 (秒)")
+    p.add_argument("--latency", type=float, default=0.005, help="模拟每次 RPC 的延迟 (秒)")
+    p.add_argument("--page-delay", type=float, default=0.01, help="预热每页之后的等待 (秒)")
+    p.add_argument("--busy-page-delay", type=float, default=0.05, help="动作通道有任务时每页之后的等待 (秒)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_prewarm)
+
+    p = sub.add_parser("singleflight", help="同一发送者并发的私信动作共用获取和过滤，且只私信一次")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--dup", type=int, default=3, help="每个发送者几乎同时触发的通知数")
+    p.add_argument("--failures", type=int, default=10, help="第一次发送失败的用户数")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--latency", type=float, default=0.005, help="模拟每次 RPC 的延迟 (秒)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_singleflight)
+
+    p = sub.add_parser("coalesce", help="同一群组短时间内的群回复合并后的发送次数")
+    p.add_argument("--notifications", type=int, default=300)
+    p.add_argument("--groups", type=int, default=5)
+    p.add_argument("--interval", type=float, default=0.01, help="通知到达间隔 (秒)")
+    p.add_argument("--window", type=float, default=0.2, help="合并窗口 (秒)")
+    p.add_argument("--latency", type=float, default=0.005, help="模拟每次 RPC 的延迟 (秒)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_coalesce)
+
+    p = sub.add_parser("admin", help="管理命令增量修改关键词的延迟")
+    p.add_argument("--patterns", type=int, default=10000)
+    p.add_argument("--commands", type=int, default=500)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_admin)
+
+    p = sub.add_parser("coldstart", help="已互动用户文件的启动加载: JSON vs mmap 二进制")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000000, 10000000])
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_coldstart)
+
+    p = sub.add_parser("expiry", help="已互动用户按时间分段过期的开销 vs 逐个用户检查时间")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000, 3000000])
+    p.add_argument("--horizon", type=int, default=180, help="再次联系间隔 (天)")
+    p.add_argument("--segment", type=int, default=30, help="每段天数")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_expiry)
+
+    p = sub.add_parser("shadow", help="影子模式: 候选匹配器/解析器的结果比较和对实时路径的影响")
+    p.add_argument("--patterns", type=int, default=1000)
+    p.add_argument("--notifications", type=int, default=1000)
+    p.add_argument("--interval", type=float, default=0.002, help="通知到达间隔 (秒)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_shadow)
+
+    p = sub.add_parser("formats", help="通知格式: 默认格式语料 + 按前缀/发送者判别 vs 逐个尝试解析")
+    p.add_argument("--formats", type=int, nargs="+", default=[0, 4, 16, 64], help="额外的格式数")
+    p.add_argument("--messages", type=int, default=2000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_formats)
+
+    p = sub.add_parser("policy", help="源群组策略表: 被禁言群组和不允许的动作在发送前丢弃")
+    p.add_argument("--groups", type=int, default=200)
+    p.add_argument("--denied", type=float, default=0.3, help="被禁言 (忽略) 的群组比例")
+    p.add_argument("--reply-only", type=float, default=0.2, help="只回复的群组比例")
+    p.add_argument("--notifications", type=int, default=1000)
+    p.add_argument("--latency", type=float, default=0.005, help="模拟的 RPC 延迟 (秒)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_policy)
+
+    p = sub.add_parser("negative", help="发送失败的负缓存: 不可达的群组/用户跳过，不进入全局冷却")
+    p.add_argument("--groups", type=int, default=100)
+    p.add_argument("--users", type=int, default=300)
+    p.add_argument("--unreachable", type=float, default=0.3, help="不可达的群组/用户比例")
+    p.add_argument("--notifications", type=int, default=2000)
+    p.add_argument("--gap", type=float, default=60, help="通知间隔 (模拟时间，秒)")
+    p.add_argument("--cooldown", type=float, default=600, help="发送后的全局冷却 (秒)")
+    p.add_argument("--latency", type=float, default=0.0, help="模拟的 RPC 延迟 (秒)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_negative)
+
+    p = sub.add_parser("pool", help="多进程匹配: 1 到 N 个进程的吞吐量和事件循环阻塞时间")
+    p.add_argument("--patterns", type=int, default=100000)
+    p.add_argument("--notifications", type=int, default=500)
+    p.add_argument("--length", type=int, default=400, help="每条通知的词数")
+    p.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_pool)
+
+    p = sub.add_parser("handoff", help="无停机重启: 重启期间通知的处理间隔和延迟")
+    p.add_argument("--notifications", type=int, default=200)
+    p.add_argument("--interval", type=float, default=0.05, help="通知到达间隔 (秒)")
+    p.add_argument("--restart-at", type=float, default=3.0, help="开始重启的时间 (秒)")
+    p.add_argument("--warmup", type=float, default=2.0, help="新进程登录和预加载的耗时 (秒)")
+    p.add_argument("--latency", type=float, default=0.2, help="模拟的 RPC 延迟 (秒)")
+    p.set_defaults(func=bench_handoff)
+
+    def suite_args(p):
+        p.add_argument("--version", help="版本名，默认为 git describe")
+        p.add_argument("--messages", type=int, default=200)
+        p.add_argument("--users", type=int, default=1000000, help="已互动用户数")
+        p.add_argument("--repeat", type=int, default=5, help="每项重复次数，取中位数")
+        p.add_argument("--seed", type=int, default=1)
+
+    p = sub.add_parser("suite", help="固定的基准测试套件，--save 保存为当前版本的基线")
+    suite_args(p)
+    p.add_argument("--save", action="store_true", help="保存到 benchmarks/<版本>.json")
+    p.set_defaults(func=bench_suite)
+
+    p = sub.add_parser("compare", help="运行套件 (或读取 --current) 并和基线比较，超过阈值时返回 1")
+    suite_args(p)
+    p.add_argument("--baseline", help="基线的版本名或文件，默认为最近保存的基线")
+    p.add_argument("--current", help="和另一份保存的结果比较，不重新运行")
+    p.add_argument("--threshold", type=float, default=0.15, help="变慢超过这个比例算回归")
+    p.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Telegram关键词监控机器人
+监控指定频道的关键词，并在源群组中自动发送贴纸回复或向用户私信
+每个用户只互动一次，通过 user_id 记录
+关键词支持 子串 / 整词 / 前缀 / 正则 四种匹配方式，合并为一个匹配器一次扫描
+匹配前对消息做归一化 (全角/零宽字符/形近字/字母间插空格)，对抗规避关键词的广告
+状态文件由后台线程合并写盘，不阻塞事件循环
+记录已处理的最后一条通知，重启或断线后先按顺序补处理漏掉的通知
+群回复和私信分通道执行，过时的群回复直接丢弃
+收到 SIGUSR1 时对运行中的事件循环做一次限时性能剖析 (kill -USR1 <pid>)
+安装了 uvloop 时使用 uvloop 事件循环，并持续监测事件循环的调度延迟
+多个实例可以通过共享的协调存储 (SQLite) 抢占用户和冷却，避免重复私信/回复
+可选直接处理原始更新，跳过 NewMessage 事件对象的构建
+支持无停机重启: 新进程预热完成后旧进程才交出进度并退出
+支持多个监控机器人的通知格式，按前缀或发送者为每条通知选出一个解析器
+按源群组的策略表 (忽略 / 只回复 / 只私信 / 关键词子集) 在执行动作前丢弃不允许的通知
+发送失败按原因分类，不可达的群组/用户记入负缓存并在有效期内跳过，只有全局性的失败进入冷却
+关键词很多时可以在多个工作进程中匹配，不阻塞事件循环，结果按通知顺序交给动作阶段
+"""
+
+import re
+import os
+import abc
+import shlex
+import unicodedata
+import json
+import logging
+import asyncio
+import time
+import signal
+import threading
+import cProfile
+import pstats
+import io
+import tracemalloc
+import socket
+import sqlite3
+import tempfile
+import datetime
+import sys
+import mmap
+import zlib
+import struct
+import bisect
+import random
+import importlib
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from telethon import TelegramClient, events, utils, errors
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession, SQLiteSession
+from telethon.tl.types import (
+    InputStickerSetShortName,
+    PeerUser,
+    PeerChat,
+    PeerChannel,
+    Message,
+    UpdateNewChannelMessage,
+)
+from telethon.tl.types.updates import State
+from telethon.extensions import markdown
+
+# 配置日志
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# ============ 配置区 ============
+API_ID = 'YOUR_API_ID'  # 从 https://my.telegram.org 获取
+API_HASH = 'YOUR_API_HASH'  # 从 https://my.telegram.org 获取
+PHONE = 'YOUR_PHONE_NUMBER'  # 你的手机号，格式：+8613800138000
+
+# 监控的频道ID（可以是用户名或数字ID）
+MONITOR_CHANNEL = 'YOUR_MONITOR_CHANNEL'  # 例如：'channel_username' 或 -1001234567890
+
+# 直接订阅原始更新 (UpdateNewChannelMessage)，按频道 ID 整数比较过滤后把消息交给匹配器，
+# 跳过 events.NewMessage 的事件对象构建和实体处理
+RAW_UPDATES = False
+
+# 通知格式: 不同监控机器人的通知格式不同，每种格式声明一个便宜的判别条件，每条通知只选出一个解析器
+# prefix - 通知文本的开头；sender - 发送通知的机器人的 user_id (多个机器人发到同一个监控群时)
+# parser - 内置解析器的名字 (NOTIFICATION_PARSERS)、函数或 "模块名:函数名" 字符串，
+#          参数为通知文本，返回与 parse_notification_message 相同的字典
+# 不符合任何格式的通知只计数，不做关键词匹配，也不逐个尝试解析
+NOTIFICATION_FORMATS = [
+    {"name": "found", "prefix": "#FOUND", "parser": "found"},
+]
+
+# 全局冷却时间 (秒)
+# 当触发一次关键词动作后，在此时间内不再响应任何新消息
+COOLDOWN_USER_FETCH_FAILED = 3600  # 获取用户失败: 1小时
+COOLDOWN_MESSAGE_SENT = 86400  # 发送消息成功或失败: 1天
+
+# 发送失败的负缓存: 只和某个群组/用户有关的失败按类别记录，有效期内直接跳过该目标 (不发任何请求)，
+# 也不进入全局冷却；只有限流 (flood) 和无法分类的失败才进入全局冷却
+NEGATIVE_CACHE_TTL = {
+    "chat_forbidden": 86400,  # 群组: 被禁言/封禁/无权发送/无法访问
+    "privacy": 7 * 86400,  # 用户: 隐私设置不允许私信
+    "user_gone": 30 * 86400,  # 用户: 拉黑了我们、已注销、是机器人
+}
+# slow_mode (群组慢速模式) 和 flood (全局限流) 的有效期使用错误里给出的等待秒数
+
+# NEW: 用户ID最小值限制
+# 不互动telegram的资深用户
+MIN_USER_ID = 2000000000
+
+# 私信前的用户过滤规则
+# action: deny (命中则过滤, 默认) / allow (命中则放行，优先于 deny)
+# type:
+#   id_in    - ids: 用户 ID 列表
+#   id_range - min / max: min <= user_id < max (可省略其中一个)
+#   flag     - flags: User 的布尔属性，任一为真即命中 (bot / scam / fake / premium / verified / deleted ...)
+#   username - pattern: 用户名包含 pattern (不区分大小写)，regex: true 时按正则匹配
+#   name     - pattern: first_name / last_name 包含 pattern
+#   about    - pattern: 个人简介包含 pattern (需要额外的 GetFullUserRequest)
+# 规则按取数据的代价从低到高执行 (ID -> 用户对象 -> 完整资料)，能提前得出结论就不再请求后面的数据
+USER_FILTER_RULES = [
+    {"type": "id_in", "ids": [], "action": "allow"},  # 白名单
+    {"type": "id_range", "max": MIN_USER_ID},
+    {"type": "flag", "flags": ["bot"]},
+    {"type": "name", "pattern": "bot"},
+    {"type": "about", "pattern": "bot"},
+]
+
+# 源群组策略: 解析通知后立即检查，不允许的通知在取贴纸、获取用户和发送之前就丢弃
+# 键为群组的数字 ID (-100...) 或用户名 (不区分大小写，可带 @)，同一个群组的两种写法可以都列出
+#   deny     - True 时忽略该群组的所有通知 (例如账号在群里被禁言或封禁)
+#   actions  - 允许的动作列表，例如 ["reply"] 只回复、["dm"] 只私信
+#   keywords - 允许的关键词列表，不在列表中的关键词不响应
+# SOURCE_POLICY_DEFAULT: 不在表里的群组 "allow" 全部允许 / "deny" 全部忽略 (只处理表里列出的群组)
+SOURCE_POLICIES = {
+    # -1001234567890: {"deny": True},
+    # "some_group": {"actions": ["reply"]},
+}
+SOURCE_POLICY_DEFAULT = "allow"
+
+# KEYWORD_ACTIONS 统一结构：
+# 每个字段都是“可选”的
+# action 必须是 reply / dm
+# match 为关键词的匹配方式 (默认 substring):
+#   substring - 子串匹配 (不区分大小写)
+#   word      - 整词匹配, 'naive' 不会命中 'naively'
+#   prefix    - 词首匹配, 'naive' 命中 'naively' 但不命中 'unnaive'
+#   regex     - 关键词本身是正则表达式 (不区分大小写)；正则里的字面量与消息做同样的归一化 (全角、形近字等)，
+#               字符集里的范围 (如 [а-я]) 不归一化；换行归一化为空格，^ / $ 只匹配整条消息的开头/结尾
+KEYWORD_ACTIONS = {
+    'a9c30dc64998': {
+        'action': 'dm',
+        'text': """这是一条公益信息, 只会向您发送一次.
+This is a public service message and will only be sent to you once.
+本信息是为了告知您, 您在(公开和私有)群组中的发言可以被检索, 并使得您成为广告信息的对象.
+This message is to inform you that your messages in groups (including pubic and private ones) could be searched and you may become the target of spam.
+为了对抗广告信息, 电报用户和群组都应该避免使用username.
+To against spam, Telegram users and groups should avoid using usernames.
+这是一个简单的演示视频 https://youtu.be/2bvV030PgUA
+"""
+    },
+    '三色图': {
+        'action': 'reply',
+        'sticker_pack': 'fuckgfwnewbie',
+        'sticker_index': 0
+    },
+    'naive': {
+        'action': 'dm',
+        'match': 'word',
+        'sticker_pack': 'fuckgfwnewbie',
+        'sticker_index': 1
+    }
+}
+
+# 匹配前是否归一化文本 (NFKC、大小写折叠、去零宽字符、形近字替换、合并逐字符插入的空格)
+# 关闭时只做小写转换
+NORMALIZE_TEXT = True
+
+# 管理命令: 本账号在 ADMIN_CHAT (默认收藏夹 Saved Messages) 中发送，修改立即生效并保存到 KEYWORDS_FILE
+# 启动时如果 KEYWORDS_FILE 存在，以它为准 (代替上面的 KEYWORD_ACTIONS)；含空格的关键词用引号括起来
+#   /kw list [页码]                        每页不超过 ADMIN_REPLY_LIMIT 个字符 (Telegram 单条消息上限 4096)
+#   /kw add <关键词> <reply|dm> [substring|word|prefix|regex]   第二行起为文本
+#   /kw remove <关键词>
+#   /kw action <关键词> <reply|dm>
+#   /kw sticker <关键词> <贴纸包> <序号>   或   /kw sticker <关键词> none
+#   /kw text <关键词>                      第二行起为新的文本，没有则删除文本
+ADMIN_COMMANDS = True
+ADMIN_CHAT = "me"
+ADMIN_PREFIX = "/kw"
+ADMIN_REPLY_LIMIT = 4000
+KEYWORDS_FILE = "keywords.json"
+KEYWORD_DELTA_MAX = 256  # 增量添加的新字面量超过这个数时，在后台线程整体重建匹配器
+
+# 多进程匹配: 关键词非常多 (10 万以上) 时把关键词匹配放到 MATCHER_PROCESSES 个工作进程执行，
+# 不占用事件循环线程；每个工作进程启动时构建一次匹配器，之后只接收消息文本。
+# 匹配结果按通知顺序交给动作阶段。0 表示在事件循环里直接匹配
+MATCHER_PROCESSES = 0
+
+# 互动过的用户 持久化文件: 排好序的 uint64 数组 (二进制)，启动时 mmap，不解析成 Python 对象
+INTERACTED_SNAPSHOT = "interacted_users.bin"
+# 旧版本的 JSON 文件，INTERACTED_SNAPSHOT 不存在时从这里迁移一次
+INTERACTED_FILE = "interacted_users.json"
+# 再次联系的间隔 (天): 私信过的用户超过这个时间后可以再次私信；None 表示永远不再私信 (记录永久保存)
+# 设置后按时间分段保存，每段 INTERACTED_SEGMENT_DAYS 天，一整段都超过间隔后直接删除该段
+# (所以实际保留时间在 RECONTACT_DAYS 到 RECONTACT_DAYS + INTERACTED_SEGMENT_DAYS 天之间)
+RECONTACT_DAYS = None
+INTERACTED_SEGMENT_DAYS = 30
+
+# 动作执行通道: 群回复时效性强，和私信分开排队，互不阻塞
+LANE_CONCURRENCY = {"reply": 4, "dm": 2}  # 每个通道同时执行的动作数
+REPLY_DEADLINE = 30  # 群回复超过这个时间 (秒，从通知发出算起) 还没开始执行就丢弃
+# 同一群组在 REPLY_COALESCE_WINDOW 秒内触发的多个群回复合并成一次: 回复窗口内最新的那条消息，
+# 使用其中最具体 (最长) 的关键词的贴纸/文本；0 表示不合并
+REPLY_COALESCE_WINDOW = 3
+
+# 运行时性能剖析: 收到 SIGUSR1 后采集 PROFILE_SECONDS 秒的 cProfile 和 tracemalloc 内存分配，
+# 连同未完成的 asyncio 任务一起写到 PROFILE_DIR；未触发时没有任何开销
+PROFILE_ON_SIGNAL = True
+PROFILE_SECONDS = 30
+PROFILE_DIR = "profiles"
+PROFILE_TOP_N = 30
+
+# 事件循环: 安装了 uvloop (pip3 install uvloop) 时使用 uvloop，否则使用默认的 asyncio 循环
+USE_UVLOOP = True
+
+# 事件循环延迟监测: 每 LOOP_LAG_INTERVAL 秒检查一次调度延迟，超过 LOOP_LAG_WARN 秒告警
+LOOP_LAG_INTERVAL = 1.0
+LOOP_LAG_WARN = 0.1
+
+# 影子模式: 在真实通知上抽样运行候选的匹配器/解析器，只和当前实现比较结果，不执行候选的输出
+# 候选实现可以是函数，或 "模块名:函数名" 字符串；参数与 check_keywords(text) / parse_notification_message(text, sender_id) 相同
+# None 表示不启用。影子比较在后台任务中执行，实时处理只做一次抽样判断
+SHADOW_MATCHER = None
+SHADOW_PARSER = None
+SHADOW_SAMPLE_RATE = 0.1  # 抽样比例
+SHADOW_MAX_PENDING = 100  # 等待比较的消息上限，超过时丢弃
+SHADOW_CPU_BUDGET = 0.05  # 影子比较最多占用的 CPU 时间比例，超过时暂停抽样
+SHADOW_MISMATCH_FILE = "shadow_mismatches.jsonl"
+SHADOW_MAX_MISMATCHES = 1000  # 最多记录的不一致条数
+
+# 多实例协调: 多台主机同时运行时，发送前在共享存储里原子地抢占 "用户" / "群消息" 和 "全局冷却"
+# None - 单实例，只在本进程内存中协调
+# "sqlite" - 使用 COORDINATION_DB 文件 (同一台机器上的多个实例，或放在共享文件系统上)
+COORDINATION_BACKEND = None
+COORDINATION_DB = "coordination.db"
+
+# 运行状态 持久化文件 (动作都已执行完的最后一条监控频道消息 id，重启后从这里补处理)
+STATE_FILE = "bot_state.json"
+
+# 重启/断线后补处理漏掉的通知
+CATCHUP_BATCH = 100  # 每批处理的消息数
+CATCHUP_MAX_AGE = 3600  # 超过这个时间 (秒) 的通知已经过时，跳过不处理
+
+# 无停机重启: 新进程先完成登录、贴纸预加载、源群组成员预热和状态加载，再通过 HANDOFF_SOCKET 通知旧进程；
+# 旧进程停止处理新通知，等在途的动作执行完、保存状态后交出最后处理的通知 id 并退出，新进程从这里继续。
+# 交接期间到达的通知由新进程补处理，不会丢失。None 表示不启用
+HANDOFF_SOCKET = None  # 例如 "handoff.sock"
+HANDOFF_TIMEOUT = 60  # 每一步等待对方的最长时间 (秒)
+
+# 后台写盘: 距上次写盘满 SAVE_INTERVAL 秒，或累计 SAVE_MAX_PENDING 次修改，合并写一次
+SAVE_INTERVAL = 5
+SAVE_MAX_PENDING = 100
+
+# Telethon 会话存储
+# "sqlite" - Telethon 默认的 .session 文件，实体和更新状态随每次 save() 提交 SQLite 事务
+# "memory" - 会话只保存在内存中，后台线程每 SESSION_SNAPSHOT_INTERVAL 秒把快照原子地写入 SESSION_SNAPSHOT_FILE，
+#            退出时再写一次；首次启动时如果存在旧的 .session 文件会自动迁移
+SESSION_MODE = "sqlite"
+SESSION_SNAPSHOT_FILE = "session_" + PHONE + ".snapshot.json"
+SESSION_SNAPSHOT_INTERVAL = 60
+
+# 源群组成员预热: 后台分页拉取通知中出现过的源群组的成员，私信时直接使用缓存的 access_hash 和用户资料，
+# 不需要再用 get_messages 查询发送者。每页之后等待 PREWARM_PAGE_DELAY 秒，动作通道有任务时等待
+# PREWARM_BUSY_PAGE_DELAY 秒 (持续有通知时也会按这个速度推进)；没有权限查看成员的群组会跳过，直到下次刷新。
+# 成员列表不包含简介: USER_FILTER_RULES 中有 about 规则时，命中预热的私信仍需要一次 GetFullUserRequest
+PREWARM_MEMBERS = False
+PREWARM_PAGE_SIZE = 200  # 与 Telethon 每次 GetParticipants 的上限一致
+PREWARM_PAGE_DELAY = 2
+PREWARM_BUSY_PAGE_DELAY = 10
+PREWARM_MAX_MEMBERS = 10000  # 每个群组最多预热的成员数
+PREWARM_REFRESH = 6 * 3600  # 同一群组重新拉取的间隔 (秒)
+# ================================
+
+MATCH_KINDS = ("substring", "word", "prefix", "regex")
+
+# 常被用来冒充拉丁字母的西里尔/希腊字母 (已是小写折叠后的形式)
+HOMOGLYPHS = {
+    "а": "a", "в": "b", "е": "e", "ё": "e", "к": "k", "м": "m", "н": "h", "о": "o",
+    "р": "p", "с": "c", "т": "t", "у": "y", "х": "x", "ѕ": "s", "і": "i", "ј": "j",
+    "ԁ": "d", "ԛ": "q", "ԝ": "w", "ɡ": "g", "α": "a", "β": "b", "ε": "e", "ι": "i",
+    "κ": "k", "ν": "v", "ο": "o", "ρ": "p", "τ": "t", "υ": "u", "χ": "x",
+}
+
+# 零宽及其它不可见的格式字符
+INVISIBLE_CHARS = "\u00ad\u034f\u061c\u115f\u1160\u180e\u200b\u200c\u200d\u200e\u200f\u2060\u2061\u2062\u2063\u2064\ufeff"
+
+
+# 被空格隔开的单个字符: 3 个及以上 ("n a i v e")，汉字 2 个及以上 ("免 费")
+_SPACED_CHARS = re.compile(
+    r"(?<!\w)\w(?: +\w(?!\w)){2,}|(?<!\w)[\u3400-\u9fff](?: +[\u3400-\u9fff](?!\w))+"
+)
+
+
+class _FoldTable(dict):
+    """
+    str.translate 用的映射表 (键为码位)：预先放入零宽字符和形近字，
+    其余字符首次出现时计算 NFKC + casefold 的结果并缓存
+    """
+
+    def __init__(self, enabled):
+        super().__init__()
+        self.enabled = enabled
+        if enabled:
+            for ch in INVISIBLE_CHARS:
+                self[ord(ch)] = ""
+            for src, dst in HOMOGLYPHS.items():
+                self[ord(src)] = dst
+                self[ord(src.upper())] = dst
+
+    def __missing__(self, code):
+        ch = chr(code)
+        if not self.enabled:
+            rep = ch.lower()
+        elif ch.isspace():
+            rep = " "
+        else:
+            rep = "".join(
+                HOMOGLYPHS.get(c, c)
+                for c in unicodedata.normalize("NFKC", ch).casefold()
+                if unicodedata.category(c) not in ("Mn", "Cf")
+            )
+        self[code] = rep
+        return rep
+
+
+class TextNormalizer:
+    """
+    文本归一化
+    fold() 用预计算的映射表做一次 str.translate (逐字符 NFKC + casefold、去零宽字符、形近字替换、
+    空白统一为空格)，只有出现 "n a i v e" 这种逐字符插空格的写法时才再合并一次。
+    normalize() 得到同样的结果并附带每个输出字符在原文中的下标，用于把匹配位置映射回原文。
+    关键词在加载时用 fold() 做同样的处理
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.table = _FoldTable(enabled)
+
+    def fold(self, text):
+        norm = text.translate(self.table)
+        if self.enabled and _SPACED_CHARS.search(norm):
+            norm = _SPACED_CHARS.sub(lambda m: m.group().replace(" ", ""), norm)
+        return norm
+
+    def normalize(self, text):
+        """返回 (归一化文本, offsets)，offsets[j] 为第 j 个输出字符在原文中的下标"""
+        table = self.table
+        out = []
+        offsets = []
+        for i, ch in enumerate(text):
+            rep = table[ord(ch)]
+            if rep:
+                out.append(rep)
+                offsets.extend([i] * len(rep))
+        norm = "".join(out)
+        if self.enabled and _SPACED_CHARS.search(norm):
+            keep = [True] * len(norm)
+            for m in _SPACED_CHARS.finditer(norm):
+                for j in range(m.start(), m.end()):
+                    if norm[j] == " ":
+                        keep[j] = False
+            norm = "".join(c for c, k in zip(norm, keep) if k)
+            offsets = [o for o, k in zip(offsets, keep) if k]
+        return norm, offsets
+
+    @staticmethod
+    def to_original(offsets, start, end, original_length):
+        """把归一化文本上的 [start, end) 映射回原文的 [start, end)"""
+        if start >= len(offsets):
+            return original_length, original_length
+        return offsets[start], (offsets[end - 1] + 1 if end > start else offsets[start])
+
+_REGEX_META = set(".^$*+?{}[]|()")
+
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch == "_"
+
+
+def _regex_literal_prefix(pattern):
+    """
+    提取正则开头必定出现的字面量 (保守)，用作自动机的触发词
+    含有 | 或以元字符开头的正则返回空串
+    """
+    if "|" in pattern:
+        return ""
+    out = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\":
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                out.append(pattern[i + 1])
+                i += 2
+                continue
+            break
+        if ch in _REGEX_META:
+            # 量词作用于前一个字符，使其变为可选
+            if ch in "*?{" and out:
+                out.pop()
+            break
+        out.append(ch)
+        i += 1
+    return "".join(out).lower()
+
+
+_QUANTIFIER = re.compile(r"\{\d*(?:,\d*)?\}")
+
+
+def _fold_regex(pattern, fold):
+    """
+    把正则里的字面量字符按 fold (逐字符的归一化) 处理，使正则能匹配归一化后的文本
+    转义序列、分组语法 ((?P<name>...)、(?i) 等)、量词 {m,n} 原样保留；
+    字符集里的单个字符额外加入归一化后的字符，范围 (a-z) 原样保留；
+    归一化成多个字符的 (ß -> ss) 包成 (?:ss)，后面的量词仍作用于整体
+    """
+    out = []
+    i, n = 0, len(pattern)
+
+    def literal(ch):
+        rep = fold(ch)
+        if len(rep) == 1:
+            return re.escape(rep) if rep in _REGEX_META or rep == "\\" else rep
+        return f"(?:{re.escape(rep)})" if rep else ""
+
+    while i < n:
+        ch = pattern[i]
+        if ch == "\\":
+            out.append(pattern[i:i + 2])
+            i += 2
+        elif ch == "(" and pattern.startswith("(?", i):
+            # 分组语法的头部原样保留
+            j = i + 2
+            if pattern.startswith("P<", j):
+                j = pattern.find(">", j) + 1
+            elif pattern.startswith("P=", j) or pattern.startswith("#", j) or pattern.startswith("(", j):
+                j = pattern.find(")", j) + 1
+            elif pattern.startswith("<=", j) or pattern.startswith("<!", j):
+                j += 2
+            else:
+                while j < n and (pattern[j].isalpha() or pattern[j] == "-"):
+                    j += 1
+            j = j if j > i else n
+            out.append(pattern[i:j])
+            i = j
+        elif ch == "{" and _QUANTIFIER.match(pattern, i):
+            end = _QUANTIFIER.match(pattern, i).end()
+            out.append(pattern[i:end])
+            i = end
+        elif ch == "[":
+            j = i + 1
+            if j < n and pattern[j] == "^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            body = []
+            k = i + 1
+            while k < j:
+                body.append(pattern[k])
+                k += 1
+            while k < n and pattern[k] != "]":
+                c = pattern[k]
+                if c == "\\":
+                    body.append(pattern[k:k + 2])
+                    k += 2
+                    continue
+                if k + 2 < n and pattern[k + 1] == "-" and pattern[k + 2] != "]":
+                    body.append(pattern[k:k + 3])
+                    k += 3
+                    continue
+                body.append(c)
+                rep = fold(c)
+                if len(rep) == 1 and rep != c:
+                    body.append(re.escape(rep))
+                k += 1
+            out.append("[" + "".join(body) + "]")
+            i = k + 1
+        elif ch in _REGEX_META:
+            out.append(ch)
+            i += 1
+        else:
+            out.append(literal(ch))
+            i += 1
+    return "".join(out)
+
+
+class KeywordMatcher:
+    """
+    组合关键词匹配器
+    消息先经过 TextNormalizer 归一化，关键词在加载时做同样的归一化；正则里的字面量字符也在加载时归一化
+    (_fold_regex)，作用于归一化后的文本。归一化把换行统一为空格，(?m) 下的 ^ / $ 只匹配整条消息的开头/结尾。
+    所有字面量关键词 (子串/整词/前缀) 和正则关键词的字面量前缀放进同一个 Aho-Corasick 自动机，
+    对消息只扫描一次；自动机命中后再按各自的匹配方式校验 (单词边界 / 正则 match)。
+    提取不出字面量前缀的正则合并为一个前瞻正则，单独扫描一次 (带分组或全局标志、无法合并的逐个扫描)。
+    返回结果保持 KEYWORD_ACTIONS 中的顺序
+
+    支持不重建自动机的增量修改 (add / remove):
+    每个字面量的候选列表在自动机各状态间共享引用，删除关键词或给已有字面量增加关键词只修改这个列表；
+    全新的字面量放进一个小的增量自动机，只重建增量部分，增量过大时 (delta_size) 由调用方整体重建
+    """
+
+    def __init__(self, keyword_actions, normalizer=None):
+        self.normalizer = normalizer or TextNormalizer(NORMALIZE_TEXT)
+        self.order = {}
+        self._next_order = 0
+        self.entries = {}  # keyword -> (所在的候选列表, 条目)
+        self.triggers = {}  # 归一化后的字面量 -> [(keyword, kind, compiled regex 或 None)]
+        self.delta = {}  # 自动机建立之后新增的字面量，结构同 triggers
+        self.fallback = []  # [(keyword, compiled)]
+        for kw, cfg in keyword_actions.items():
+            self._add_entry(kw, cfg, self.triggers)
+
+        self.automata = [self._build_automaton(self.triggers)]
+        self._build_fallback()
+
+    def _add_entry(self, kw, cfg, triggers, order=None):
+        kind = (cfg or {}).get("match", "substring")
+        if kind not in MATCH_KINDS:
+            raise ValueError(f"关键词 {kw!r} 的匹配方式无效: {kind}")
+        rx = self._compile_regex(kw) if kind == "regex" else None
+        literal = self.normalizer.fold(_regex_literal_prefix(rx.pattern) if rx else kw)
+        if order is None:
+            order = self._next_order
+            self._next_order += 1
+        self.order[kw] = order
+        entry = (kw, kind, rx)
+        if literal:
+            # 自动机中已有的字面量直接追加到共享的候选列表
+            target = self.triggers.get(literal)
+            if target is None:
+                target = triggers.setdefault(literal, [])
+            target.append(entry)
+            self.entries[kw] = (target, entry)
+        elif rx:
+            self.fallback.append((kw, rx))
+            self.entries[kw] = (self.fallback, (kw, rx))
+        else:
+            self.entries[kw] = (None, None)
+
+    def _compile_regex(self, kw):
+        folded = _fold_regex(kw, lambda ch: ch.translate(self.normalizer.table))
+        try:
+            return re.compile(folded, re.IGNORECASE)
+        except re.error:
+            # 归一化后无法编译时 (很少见) 报告原始正则的错误
+            re.compile(kw, re.IGNORECASE)
+            raise
+
+    def _build_fallback(self):
+        self.fallback_pattern, self.fallback_combined, self.fallback_solo = self._compile_fallback(self.fallback)
+
+    @staticmethod
+    def _compile_fallback(fallback):
+        """返回 (合并的前瞻正则或 None, 合并的 [(keyword, rx)], 逐个扫描的 [(keyword, rx)])"""
+        # 带分组的正则合并后组名会重复、编号会错位，(?i) 这类全局标志只能出现在开头，这些正则逐个扫描
+        combined, solo = [], []
+        for kw, rx in fallback:
+            try:
+                if rx.groups:
+                    raise re.error("带分组")
+                re.compile(f"(?:{rx.pattern})")
+                combined.append((kw, rx))
+            except re.error:
+                solo.append((kw, rx))
+        pattern = None
+        if combined:
+            # 零宽前瞻，保证重叠的命中位置都能被访问到
+            pattern = re.compile(
+                "(?=" + "|".join(f"(?:{rx.pattern})" for _, rx in combined) + ")",
+                re.IGNORECASE,
+            )
+        return pattern, combined, solo
+
+    def add(self, kw, cfg):
+        """增加 (或替换，保持原来的顺序) 一个关键词；配置无效时抛出异常，不修改匹配器"""
+        kind = (cfg or {}).get("match", "substring")
+        if kind not in MATCH_KINDS:
+            raise ValueError(f"关键词 {kw!r} 的匹配方式无效: {kind}")
+        fallback = None
+        if kind == "regex":
+            rx = self._compile_regex(kw)
+            if not self.normalizer.fold(_regex_literal_prefix(rx.pattern)):
+                # 先建好新的合并正则，失败时匹配器保持原样
+                fallback = self._compile_fallback(
+                    [entry for entry in self.fallback if entry[0] != kw] + [(kw, rx)]
+                )
+        order = self.order.get(kw)
+        if order is not None:
+            self.remove(kw)
+        delta_before = len(self.delta)
+        self._add_entry(kw, cfg, self.delta, order)
+        if len(self.delta) != delta_before:
+            self.automata[1:] = [self._build_automaton(self.delta)]
+        if fallback is not None:
+            self.fallback_pattern, self.fallback_combined, self.fallback_solo = fallback
+
+    def remove(self, kw):
+        """删除一个关键词，不存在时返回 False"""
+        if kw not in self.order:
+            return False
+        del self.order[kw]
+        target, entry = self.entries.pop(kw)
+        if target is None:
+            return True
+        target.remove(entry)
+        if target is self.fallback:
+            self._build_fallback()
+        elif not target:
+            for literal, entries in list(self.delta.items()):
+                if entries is target:
+                    del self.delta[literal]
+                    self.automata[1:] = [self._build_automaton(self.delta)] if self.delta else []
+                    break
+        return True
+
+    @property
+    def delta_size(self):
+        return len(self.delta)
+
+    @staticmethod
+    def _build_automaton(triggers):
+        goto = [{}]
+        out = [()]
+        for lit, entries in triggers.items():
+            state = 0
+            for ch in lit:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    out.append(())
+                state = nxt
+            # 保存列表本身 (不复制)，增量修改对所有后缀状态立即生效
+            out[state] = ((len(lit), entries),)
+
+        # BFS 计算失败指针，并把后缀状态的输出合并进来
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for ch, nxt in goto[state].items():
+                if state:
+                    f = fail[state]
+                    while f and ch not in goto[f]:
+                        f = fail[f]
+                    fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+                queue.append(nxt)
+
+        return goto, fail, out
+
+    def _verify(self, text, start, end, entries, found):
+        for kw, kind, rx in entries:
+            if kw in found:
+                continue
+            if kind == "substring":
+                found[kw] = (start, end)
+            elif kind == "regex":
+                m = rx.match(text, start)
+                if m:
+                    found[kw] = m.span()
+            else:
+                if start > 0 and _is_word_char(text[start - 1]):
+                    continue
+                if kind == "word" and end < len(text) and _is_word_char(text[end]):
+                    continue
+                found[kw] = (start, end)
+
+    def _scan(self, norm):
+        """扫描归一化文本，返回 {keyword: (start, end)} (归一化文本上的首次命中位置)"""
+        found = {}
+
+        for goto, fail, out in self.automata:
+            state = 0
+            for i, ch in enumerate(norm):
+                while True:
+                    nxt = goto[state].get(ch)
+                    if nxt is not None:
+                        state = nxt
+                        break
+                    if state == 0:
+                        break
+                    state = fail[state]
+                if out[state]:
+                    end = i + 1
+                    for length, entries in out[state]:
+                        self._verify(norm, end - length, end, entries, found)
+
+        if self.fallback_pattern is not None:
+            pending = {kw for kw, _ in self.fallback_combined}
+            for m in self.fallback_pattern.finditer(norm):
+                # 命中位置上其它正则也可能匹配，逐个确认
+                for kw, rx in self.fallback_combined:
+                    if kw in pending:
+                        hit = rx.match(norm, m.start())
+                        if hit:
+                            pending.discard(kw)
+                            found[kw] = hit.span()
+                if not pending:
+                    break
+        for kw, rx in self.fallback_solo:
+            m = rx.search(norm)
+            if m:
+                found[kw] = m.span()
+        return found
+
+    def match(self, text):
+        """返回命中的关键词列表"""
+        if not text:
+            return []
+        found = self._scan(self.normalizer.fold(text))
+        return sorted(found, key=self.order.__getitem__)
+
+    def search(self, text):
+        """返回 [(keyword, start, end)]，位置为原文中的下标"""
+        if not text:
+            return []
+        norm, offsets = self.normalizer.normalize(text)
+        found = self._scan(norm)
+        return [
+            (kw, *TextNormalizer.to_original(offsets, *found[kw], len(text)))
+            for kw in sorted(found, key=self.order.__getitem__)
+        ]
+
+
+# ---------------- 多进程匹配 ----------------
+# 工作进程里的匹配器，由 _init_match_worker 在进程启动时构建一次
+_worker_matcher = None
+
+
+def _init_match_worker(keyword_actions):
+    global _worker_matcher
+    _worker_matcher = KeywordMatcher(keyword_actions)
+
+
+def _match_in_worker(text):
+    return _worker_matcher.match(text)
+
+
+class MatcherPool:
+    """
+    多进程关键词匹配
+    submit() 把消息文本交给进程池后立即返回，不等待结果；多条消息同时在不同进程中匹配。
+    结果按提交顺序交给 on_result: 队首的结果出来之前，后面先完成的结果等待；
+    匹配失败或被取消的消息调用 on_skip (如果有)
+    """
+
+    def __init__(self, keyword_actions, processes):
+        self.processes = processes
+        self.executor = self._create(keyword_actions)
+        self.pending = deque()  # [(future, on_result, on_skip)]，按提交顺序
+        self.submitted = 0
+        self.reloads = 0
+
+    def _create(self, keyword_actions):
+        return ProcessPoolExecutor(
+            self.processes, initializer=_init_match_worker, initargs=(dict(keyword_actions),)
+        )
+
+    def submit(self, text, on_result, on_skip=None):
+        future = asyncio.get_running_loop().run_in_executor(self.executor, _match_in_worker, text)
+        self.pending.append((future, on_result, on_skip))
+        self.submitted += 1
+        future.add_done_callback(self._deliver)
+
+    def _deliver(self, _):
+        while self.pending and self.pending[0][0].done():
+            future, on_result, on_skip = self.pending.popleft()
+            try:
+                matches = future.result()
+            except asyncio.CancelledError:
+                logger.warning("多进程匹配被取消 (工作进程已关闭)，跳过这条消息")
+                matches = None
+            except Exception as e:
+                logger.error(f"多进程匹配失败: {e}")
+                matches = None
+            try:
+                if matches is None:
+                    if on_skip is not None:
+                        on_skip()
+                    continue
+                # 重建前的工作进程可能返回已经删除的关键词
+                on_result([kw for kw in matches if kw in KEYWORD_ACTIONS])
+            except Exception as e:
+                # 不能让异常离开回调，否则后面已完成的结果会一直留在队列里
+                logger.error(f"处理多进程匹配结果失败: {e}")
+
+    def reload(self, keyword_actions):
+        """关键词修改后换一组工作进程；旧进程处理完已提交的消息后退出"""
+        old, self.executor = self.executor, self._create(keyword_actions)
+        old.shutdown(wait=False)
+        self.reloads += 1
+
+    async def drain(self):
+        while self.pending:
+            await asyncio.wait([future for future, _, _ in self.pending])
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def report(self):
+        return f"多进程匹配: {self.processes} 个进程，匹配 {self.submitted} 条，重建 {self.reloads} 次"
+
+
+# 规则需要的数据层级: 0 - 只要 user_id，1 - 用户对象 (get_entity)，2 - 完整资料 (GetFullUserRequest)
+_RULE_TIERS = {"id_in": 0, "id_range": 0, "flag": 1, "username": 1, "name": 1, "about": 2}
+
+
+def _text_predicate(rule):
+    pattern = rule["pattern"]
+    if rule.get("regex"):
+        rx = re.compile(pattern, re.IGNORECASE)
+        return lambda value: bool(value) and rx.search(value) is not None
+    needle = pattern.lower()
+    return lambda value: bool(value) and needle in value.lower()
+
+
+class UserFilter:
+    """
+    声明式用户过滤规则
+    规则按数据层级编译成执行计划，从最便宜的数据开始判断，能得出结论就停止:
+    - allow 命中立即放行
+    - deny 命中时，如果更高层级没有 allow 规则就立即过滤，否则只为检查那些 allow 规则才继续取数据
+    decide() 返回 (是否过滤, 原因, 本次 RPC 次数)
+    """
+
+    def __init__(self, rules):
+        self.plan = [([], []) for _ in range(3)]  # 每层 (allow 规则, deny 规则)
+        for rule in rules:
+            kind = rule["type"]
+            if kind not in _RULE_TIERS:
+                raise ValueError(f"未知的用户过滤规则: {kind}")
+            action = rule.get("action", "deny")
+            if action not in ("allow", "deny"):
+                raise ValueError(f"用户过滤规则 action 无效: {action}")
+            check = self._compile(rule)
+            self.plan[_RULE_TIERS[kind]][0 if action == "allow" else 1].append(check)
+        # 每层之后是否还有 allow 规则
+        self.allow_after = [
+            any(self.plan[t][0] for t in range(tier + 1, 3)) for tier in range(3)
+        ]
+        # 先取全部数据再判断时每次需要的 RPC 数，report() 以它为对比基准 (不是 v4 的判断顺序)
+        self.full_cost = sum(1 for tier in (1, 2) if any(self.plan[tier]))
+        self.decisions = 0
+        self.rpcs = 0
+
+    @staticmethod
+    def _compile(rule):
+        kind = rule["type"]
+        if kind == "id_in":
+            ids = set(rule.get("ids", ()))
+            return lambda ctx: ctx["id"] in ids and f"user_id {ctx['id']} 在列表中"
+        if kind == "id_range":
+            lo, hi = rule.get("min"), rule.get("max")
+
+            def check(ctx):
+                uid = ctx["id"]
+                if (lo is None or uid >= lo) and (hi is None or uid < hi):
+                    return f"user_id ({uid}) 在 [{lo}, {hi}) 范围内"
+                return None
+            return check
+        if kind == "flag":
+            flags = tuple(rule["flags"])
+
+            def check(ctx):
+                for flag in flags:
+                    if getattr(ctx["user"], flag, False):
+                        return f"用户标记 {flag}"
+                return None
+            return check
+        match = _text_predicate(rule)
+        if kind == "username":
+            return lambda ctx: match(getattr(ctx["user"], "username", None)) and (
+                f"username 匹配 {rule['pattern']!r}: {ctx['user'].username}"
+            )
+        if kind == "name":
+            def check(ctx):
+                for field in ("first_name", "last_name"):
+                    value = getattr(ctx["user"], field, None)
+                    if match(value):
+                        return f"用户 {field} 匹配 {rule['pattern']!r}: {value}"
+                return None
+            return check
+        return lambda ctx: match(ctx["about"]) and f"用户 about 匹配 {rule['pattern']!r}: {ctx['about']}"
+
+    async def decide(self, user_id, fetch_user, fetch_about, user=None):
+        """
+        fetch_user / fetch_about 是取数据的协程函数，只在需要时调用；为 None 或取数据失败时，
+        跳过依赖这些数据的规则。已经有用户对象 (user) 时不再调用 fetch_user
+        """
+        self.decisions += 1
+        ctx = {"id": user_id, "user": user, "about": None}
+        rpcs = 0
+        denied = None
+        for tier, (allows, denies) in enumerate(self.plan):
+            if not allows and not (denies and denied is None):
+                continue
+            if tier == 1 and user is not None:
+                pass
+            elif tier and (fetch_user if tier == 1 else fetch_about) is None:
+                break
+            elif tier == 1:
+                try:
+                    ctx["user"] = await fetch_user()
+                except Exception as e:
+                    logger.warning(f"获取用户对象失败: {e}")
+                    break
+                finally:
+                    rpcs += 1
+            elif tier == 2:
+                try:
+                    ctx["about"] = await fetch_about()
+                except Exception as e:
+                    logger.debug(f"获取用户完整信息失败: {e}")
+                    break
+                finally:
+                    rpcs += 1
+
+            for check in allows:
+                if check(ctx):
+                    self.rpcs += rpcs
+                    return False, "", rpcs
+            if denied is None:
+                for check in denies:
+                    reason = check(ctx)
+                    if reason:
+                        denied = reason
+                        break
+            if denied is not None and not self.allow_after[tier]:
+                break
+
+        self.rpcs += rpcs
+        return denied is not None, denied or "", rpcs
+
+    def report(self):
+        avoided = self.decisions * self.full_cost - self.rpcs
+        per = avoided / self.decisions if self.decisions else 0.0
+        return (
+            f"用户过滤: 判断 {self.decisions} 次，RPC {self.rpcs} 次 | "
+            f"对比每次先取全部数据 ({self.full_cost} 次 RPC) 少 {avoided} 次 (平均每次 {per:.2f})"
+        )
+
+
+class SourcePolicies:
+    """
+    源群组策略表
+    群组 ID 和用户名统一成字典键，每条通知只做一次哈希查找；
+    filter() 返回允许执行的关键词 (按原顺序)，没有时返回空列表
+    """
+
+    def __init__(self, policies, default="allow"):
+        if default not in ("allow", "deny"):
+            raise ValueError(f"源群组默认策略无效: {default}")
+        self.table = {}
+        for channel, policy in policies.items():
+            actions = policy.get("actions")
+            if actions is not None and not set(actions) <= {"reply", "dm"}:
+                raise ValueError(f"源群组 {channel} 的 actions 无效: {actions}")
+            keywords = policy.get("keywords")
+            self.table[self.key(channel)] = (
+                bool(policy.get("deny")),
+                frozenset(actions) if actions is not None else None,
+                frozenset(keywords) if keywords is not None else None,
+            )
+        self.default = None if default == "allow" else (True, None, None)
+        self.dropped = 0  # 整条丢弃的通知
+        self.filtered = 0  # 被去掉的关键词动作
+
+    @staticmethod
+    def key(channel):
+        """-1001234567890 / "-1001234567890" / "@Name" / "name" 统一成 int 或小写用户名"""
+        if isinstance(channel, str):
+            channel = channel.lstrip("@").lower()
+            if channel.lstrip("-").isdigit():
+                return int(channel)
+        return channel
+
+    def filter(self, channel, matches):
+        policy = self.table.get(self.key(channel), self.default) if channel is not None else self.default
+        if policy is None:
+            return matches
+        deny, actions, keywords = policy
+        if deny:
+            allowed = []
+        else:
+            allowed = [
+                kw for kw in matches
+                if (keywords is None or kw in keywords)
+                and (actions is None or KEYWORD_ACTIONS.get(kw, {}).get("action") in actions)
+            ]
+        if not allowed:
+            self.dropped += 1
+        self.filtered += len(matches) - len(allowed)
+        return allowed
+
+    def report(self):
+        return f"源群组策略: {len(self.table)} 个群组，丢弃通知 {self.dropped} 条，去掉关键词动作 {self.filtered} 个"
+
+
+class WriteBehindFile:
+    """
+    后台线程合并写盘
+    事件循环里只调用 mark_dirty() 记录有修改，真正的序列化和写文件在后台线程完成；
+    多次修改按时间 (interval) 或次数 (max_pending) 合并成一次写盘。
+    写入先写临时文件再 os.replace，避免写到一半时进程退出导致文件损坏；临时文件名每次唯一，
+    多个进程 (交接时的新旧进程) 同时写同一个文件也不会互相覆盖临时文件。
+    binary=True 时 snapshot 返回 bytes，原样写入；on_written 在新文件替换完成后 (后台线程) 调用
+    """
+
+    def __init__(
+        self, path, snapshot, interval=SAVE_INTERVAL, max_pending=SAVE_MAX_PENDING, binary=False, on_written=None
+    ):
+        # 后台线程写盘时不受之后 chdir 的影响
+        self.path = os.path.abspath(path)
+        self.snapshot = snapshot  # 返回要写入的对象，在后台线程调用
+        self.binary = binary
+        self.on_written = on_written
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = 0
+        self.writes = 0
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"write-behind:{path}", daemon=True)
+        self._thread.start()
+
+    def mark_dirty(self):
+        with self._cond:
+            self.pending += 1
+            if self.pending >= self.max_pending:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed or self.pending >= self.max_pending, timeout=self.interval
+                )
+                if not self.pending:
+                    if self._closed:
+                        return
+                    continue
+                self.pending = 0
+                closed = self._closed
+            self._write()
+            if closed:
+                # 关闭前最后一次写盘期间可能又有修改
+                with self._cond:
+                    if not self.pending:
+                        return
+
+    def _write(self):
+        tmp = None
+        try:
+            with self._write_lock:
+                data = self.snapshot()
+                fd, tmp = tempfile.mkstemp(
+                    dir=os.path.dirname(self.path), prefix=os.path.basename(self.path) + ".", suffix=".tmp"
+                )
+                with os.fdopen(fd, "wb" if self.binary else "w", encoding=None if self.binary else "utf-8") as f:
+                    if self.binary:
+                        f.write(data)
+                    else:
+                        json.dump(data, f, ensure_ascii=False, indent=2)
+                    # 先落盘再替换，断电时旧文件或新文件总有一个是完整的
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+                tmp = None
+                self.writes += 1
+                if self.on_written:
+                    self.on_written()
+        except Exception as e:
+            logger.error(f"保存文件 {self.path} 失败: {e}")
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def flush(self):
+        """在调用线程立即写入未保存的修改 (用于很少发生但不能丢的修改)"""
+        with self._cond:
+            if not self.pending:
+                return
+            self.pending = 0
+        self._write()
+
+    def close(self):
+        """写入剩余的修改并停止后台线程"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+
+class InteractedUserStore:
+    """
+    已互动用户集合
+    磁盘上是文件头 + 排好序的 uint64 数组，启动时 mmap 进来，在映射的内存上二分查找，不创建 Python 对象；
+    新增的用户放在内存中的 delta 集合，由 WriteBehindFile 在后台线程把 delta 合并进数组、写成新文件，
+    替换完成后重新 mmap 新文件，再从 delta 中去掉已合并的用户
+    """
+
+    # 魔数 (最后一个字节是字节序 L/B)、用户数、数据部分的 CRC32，补齐到 32 字节
+    HEADER = struct.Struct("<8sQI12x")
+    MAGIC = b"TGKWIU1" + (b"L" if sys.byteorder == "little" else b"B")
+
+    def __init__(self, path=INTERACTED_SNAPSHOT, legacy_json=INTERACTED_FILE, interval=SAVE_INTERVAL):
+        self.path = os.path.abspath(path)  # _swap 在后台线程重新打开
+        self.delta = set()
+        self._merging = set()
+        self._raw = memoryview(b"")  # 数据部分的字节
+        self.base = self._raw.cast("Q")
+        if os.path.exists(path):
+            try:
+                self._open()
+            except Exception as e:
+                logger.warning(f"加载已互动用户文件失败: {e}，原文件改名为 {path}.bad")
+                os.replace(path, path + ".bad")
+        elif legacy_json and os.path.exists(legacy_json):
+            try:
+                with open(legacy_json, "r", encoding="utf-8") as f:
+                    self.delta = {int(k) for k in json.load(f)}
+                logger.info(f"从 {legacy_json} 迁移 {len(self.delta)} 个已互动用户")
+            except Exception as e:
+                logger.warning(f"加载已互动用户文件失败: {e}")
+        self.writer = WriteBehindFile(
+            path, self._merged, interval=interval, binary=True, on_written=self._swap
+        )
+        if self.delta:
+            self.writer.mark_dirty()
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, crc = self.HEADER.unpack_from(mm)
+        if magic[:7] != self.MAGIC[:7] or len(mm) != self.HEADER.size + count * 8:
+            raise ValueError("文件格式不正确")
+        raw = memoryview(mm)[self.HEADER.size:]
+        if zlib.crc32(raw) != crc:
+            raise ValueError("校验和不一致")
+        if magic != self.MAGIC:
+            # 其它字节序的机器写的文件，转换后放在内存中
+            data = array("Q", raw)
+            data.byteswap()
+            raw = memoryview(data).cast("B")
+        self._raw = raw
+        self.base = raw.cast("Q")
+
+    def __contains__(self, user_id):
+        if user_id in self.delta:
+            return True
+        base = self.base
+        i = bisect.bisect_left(base, user_id)
+        return i < len(base) and base[i] == user_id
+
+    def __len__(self):
+        return len(self.base) + len(self.delta)
+
+    def __iter__(self):
+        yield from self.base
+        yield from list(self.delta)
+
+    def add(self, user_id):
+        if user_id not in self:
+            self.delta.add(user_id)
+            self.writer.mark_dirty()
+
+    def _merged(self):
+        """后台线程: 把 delta 插入到数组中，生成新文件的内容 (只复制字节段，不遍历数组)"""
+        self._merging = set(self.delta)
+        base, raw = self.base, self._raw
+        out = bytearray(self.HEADER.size)
+        prev = 0
+        for user_id in sorted(self._merging):
+            pos = bisect.bisect_left(base, user_id)
+            if pos < len(base) and base[pos] == user_id:
+                continue
+            out += raw[prev * 8:pos * 8]
+            out += struct.pack("=Q", user_id)
+            prev = pos
+        out += raw[prev * 8:]
+        count = (len(out) - self.HEADER.size) // 8
+        crc = zlib.crc32(memoryview(out)[self.HEADER.size:])
+        self.HEADER.pack_into(out, 0, self.MAGIC, count, crc)
+        return out
+
+    def _swap(self):
+        # 先换上新数组再从 delta 中去掉已合并的用户，任何时刻查询都不会漏掉
+        self._open()
+        self.delta -= self._merging
+
+    def close(self):
+        self.writer.close()
+
+
+class SegmentedInteractedUsers:
+    """
+    按时间分段的已互动用户
+    每段是一个 InteractedUserStore 文件，段编号 = 记录时间 // 段长；新用户只写入当前段。
+    过期时整段关闭并删除文件，不需要逐个用户检查时间；查询依次检查各段，
+    段数由 horizon / segment 决定，与用户数无关
+    """
+
+    def __init__(self, horizon_days, segment_days=INTERACTED_SEGMENT_DAYS, clock=time.time, path=INTERACTED_SNAPSHOT):
+        self.horizon = horizon_days * 86400
+        self.segment_seconds = segment_days * 86400
+        self.clock = clock
+        self.prefix = os.path.splitext(path)[0]
+        self.segments = {}  # 段编号 -> InteractedUserStore
+        self.expired = 0
+        directory = os.path.dirname(self.prefix) or "."
+        name = os.path.basename(self.prefix) + ".seg"
+        for filename in os.listdir(directory):
+            if filename.startswith(name) and filename.endswith(".bin"):
+                index = filename[len(name):-len(".bin")]
+                if index.isdigit():
+                    self.segments[int(index)] = InteractedUserStore(
+                        os.path.join(directory, filename), legacy_json=None
+                    )
+        if not self.segments:
+            # 从不分段的文件迁移: 没有记录时间，全部算作当前段
+            current = self._path(self._index(self.clock()))
+            if os.path.exists(path):
+                os.replace(path, current)
+            self.segments[self._index(self.clock())] = InteractedUserStore(current)
+        self.expire()
+
+    def _index(self, now):
+        return int(now // self.segment_seconds)
+
+    def _path(self, index):
+        return f"{self.prefix}.seg{index}.bin"
+
+    def expire(self):
+        """删除整段都已超过再次联系间隔的段，返回删除的用户数"""
+        cutoff = self.clock() - self.horizon
+        dropped = 0
+        for index in sorted(self.segments):
+            if (index + 1) * self.segment_seconds > cutoff:
+                # 下一次有段过期的时间，之前的查询不需要再检查
+                self._next_expiry = (index + 1) * self.segment_seconds + self.horizon
+                break
+            store = self.segments.pop(index)
+            dropped += len(store)
+            store.close()
+            # 没有写入过用户的段 (如启动时建的空段) 没有文件
+            if os.path.exists(store.path):
+                os.remove(store.path)
+            logger.info(f"已互动用户段 {index} 过期，删除 {len(store)} 个用户")
+        else:
+            self._next_expiry = float("inf")
+        self.expired += dropped
+        return dropped
+
+    def __contains__(self, user_id):
+        if self.clock() >= self._next_expiry:
+            self.expire()
+        return any(user_id in store for store in self.segments.values())
+
+    def __len__(self):
+        return sum(len(store) for store in self.segments.values())
+
+    def __iter__(self):
+        for store in list(self.segments.values()):
+            yield from store
+
+    def add(self, user_id):
+        if user_id in self:
+            return
+        index = self._index(self.clock())
+        store = self.segments.get(index)
+        if store is None:
+            store = self.segments[index] = InteractedUserStore(self._path(index), legacy_json=None)
+        store.add(user_id)
+        self._next_expiry = min(self._next_expiry, (index + 1) * self.segment_seconds + self.horizon)
+
+    def close(self):
+        for store in self.segments.values():
+            store.close()
+
+
+def create_interacted_users(clock=time.time):
+    if RECONTACT_DAYS is None:
+        return InteractedUserStore()
+    return SegmentedInteractedUsers(RECONTACT_DAYS, clock=clock)
+
+
+class SnapshotSession(MemorySession):
+    """
+    内存中的 Telethon 会话
+    实体、更新状态都只在内存中修改，由 WriteBehindFile 在后台线程定期把整个会话写成 JSON 快照；
+    授权密钥和数据中心变化很少发生但丢了就要重新登录，所以立即写盘。
+    实体按 id 和用户名建立字典索引，查找不需要遍历
+    """
+
+    def __init__(self, path, interval=SESSION_SNAPSHOT_INTERVAL, migrate_from=None):
+        super().__init__()
+        self.path = path
+        self._entities = {}  # id -> (id, hash, username, phone, name)
+        self._by_username = {}
+        if os.path.exists(path):
+            self.load()
+        elif migrate_from and os.path.exists(migrate_from + ".session"):
+            self.migrate(migrate_from)
+        # 快照只按时间合并，不按修改次数
+        self.writer = WriteBehindFile(path, self.snapshot, interval=interval, max_pending=float("inf"))
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.warning(f"加载会话快照失败: {e}")
+            return
+        self._dc_id = data.get("dc_id", 0)
+        self._server_address = data.get("server_address")
+        self._port = data.get("port")
+        if data.get("auth_key"):
+            self._auth_key = AuthKey(bytes.fromhex(data["auth_key"]))
+        self._takeout_id = data.get("takeout_id")
+        self._add_rows(tuple(row) for row in data.get("entities", []))
+        for entity_id, (pts, qts, date, seq) in data.get("update_states", {}).items():
+            self._update_states[int(entity_id)] = State(
+                pts, qts, datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc), seq, unread_count=0
+            )
+        logger.info(f"已加载会话快照: {len(self._entities)} 个实体")
+
+    def migrate(self, name):
+        """从 Telethon 的 SQLite 会话文件迁移"""
+        old = SQLiteSession(name)
+        try:
+            self._dc_id = old.dc_id
+            self._server_address = old.server_address
+            self._port = old.port
+            self._auth_key = old.auth_key
+            self._takeout_id = old.takeout_id
+            c = old._cursor()
+            try:
+                self._add_rows(c.execute("select id, hash, username, phone, name from entities").fetchall())
+            finally:
+                c.close()
+            self._update_states.update(old.get_update_states())
+        finally:
+            old.close()
+        logger.info(f"已从 {name}.session 迁移会话: {len(self._entities)} 个实体")
+
+    def snapshot(self):
+        # 在后台线程调用: 先在一次 C 层调用里复制容器，避免遍历时被事件循环修改
+        entities = list(self._entities.values())
+        states = list(self._update_states.items())
+        return {
+            "dc_id": self._dc_id,
+            "server_address": self._server_address,
+            "port": self._port,
+            "auth_key": self._auth_key.key.hex() if self._auth_key else None,
+            "takeout_id": self._takeout_id,
+            "entities": entities,
+            "update_states": {
+                str(entity_id): [s.pts, s.qts, s.date.timestamp(), s.seq] for entity_id, s in states
+            },
+        }
+
+    def _add_rows(self, rows):
+        for row in rows:
+            old = self._entities.get(row[0])
+            if old and old[2] and self._by_username.get(old[2]) == row[0]:
+                del self._by_username[old[2]]
+            self._entities[row[0]] = row
+            if row[2]:
+                self._by_username[row[2]] = row[0]
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self.writer.mark_dirty()
+        self.writer.flush()
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self.writer.mark_dirty()
+        self.writer.flush()
+
+    def set_update_state(self, entity_id, state):
+        self._update_states[entity_id] = state
+        self.writer.mark_dirty()
+
+    def process_entities(self, tlo):
+        rows = self._entities_to_rows(tlo)
+        if rows:
+            self._add_rows(rows)
+            self.writer.mark_dirty()
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        ids = (id,) if exact else (
+            utils.get_peer_id(PeerUser(id)),
+            utils.get_peer_id(PeerChat(id)),
+            utils.get_peer_id(PeerChannel(id)),
+        )
+        for found_id in ids:
+            row = self._entities.get(found_id)
+            if row:
+                return row[0], row[1]
+
+    def get_entity_rows_by_username(self, username):
+        row = self._entities.get(self._by_username.get(username))
+        if row:
+            return row[0], row[1]
+
+    def get_entity_rows_by_phone(self, phone):
+        return next(((row[0], row[1]) for row in self._entities.values() if row[3] == phone), None)
+
+    def get_entity_rows_by_name(self, name):
+        return next(((row[0], row[1]) for row in self._entities.values() if row[4] == name), None)
+
+    def save(self):
+        # Telethon 每分钟和断开连接时调用；修改在发生时已经标记过，由后台线程按间隔写盘
+        pass
+
+    def close(self):
+        # Telethon 断开连接时调用，之后还可能重连，所以只写盘不停止后台线程
+        self.writer.flush()
+
+
+def create_session():
+    if SESSION_MODE == "memory":
+        return SnapshotSession(SESSION_SNAPSHOT_FILE, migrate_from="session_" + PHONE)
+    return "session_" + PHONE
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class ActionLane:
+    """
+    动作执行通道
+    每个通道有独立的并发上限；设置了 deadline 的通道在动作真正开始执行时检查是否已过时，过时则丢弃。
+    记录排队等待和总耗时，用于统计延迟分位数
+    """
+
+    def __init__(self, name, concurrency, deadline=None, samples=1000, clock=time.time):
+        self.name = name
+        self.deadline = deadline
+        self.clock = clock
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = {}  # 未完成的任务 -> 提交时间 (perf_counter)
+        self.waits = deque(maxlen=samples)
+        self.totals = deque(maxlen=samples)
+        self.done = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def submit(self, job, created_at=None):
+        """job 是返回协程的函数；created_at 为通知发出的时间，用于判断是否过时"""
+        enqueued_at = time.perf_counter()
+        task = asyncio.ensure_future(self._run(job, enqueued_at, self.clock(), created_at))
+        self.tasks[task] = enqueued_at
+        task.add_done_callback(lambda t: self.tasks.pop(t, None))
+        return task
+
+    async def _run(self, job, enqueued_at, submitted_at, created_at):
+        async with self.semaphore:
+            self.waits.append(time.perf_counter() - enqueued_at)
+            age = self.clock() - (created_at or submitted_at)
+            if self.deadline is not None and age > self.deadline:
+                self.dropped += 1
+                logger.info(f"[{self.name}] 动作已过时 ({age:.1f}s)，丢弃")
+                return None
+            try:
+                return await job()
+            except Exception as e:
+                # 没有人等待这个任务的结果，异常不在这里记录就会丢失
+                self.failed += 1
+                logger.error(f"[{self.name}] 动作执行失败: {e!r}")
+                return None
+            finally:
+                self.done += 1
+                self.totals.append(time.perf_counter() - enqueued_at)
+
+    async def drain(self):
+        """等待所有已提交的动作完成"""
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+    def stats(self):
+        return {
+            "done": self.done,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "pending": len(self.tasks),
+            "wait_p50": _percentile(self.waits, 50),
+            "wait_p99": _percentile(self.waits, 99),
+            "total_p50": _percentile(self.totals, 50),
+            "total_p90": _percentile(self.totals, 90),
+            "total_p99": _percentile(self.totals, 99),
+        }
+
+    def report(self):
+        st = self.stats()
+        return (
+            f"[{self.name}] 完成 {st['done']} 丢弃 {st['dropped']} 失败 {st['failed']} 排队中 {st['pending']} | "
+            f"等待 p50={st['wait_p50'] * 1000:.0f}ms p99={st['wait_p99'] * 1000:.0f}ms | "
+            f"总耗时 p50={st['total_p50'] * 1000:.0f}ms p90={st['total_p90'] * 1000:.0f}ms "
+            f"p99={st['total_p99'] * 1000:.0f}ms"
+        )
+
+
+class ReplyCoalescer:
+    """
+    群回复合并
+    同一群组第一次 add() 后开始计时，window 秒内的回复动作都并入同一批；到时只把一个动作交给 submit，
+    回复批内最新的消息，关键词取最长的 (更具体)，长度相同取后到的
+    """
+
+    def __init__(self, window, submit):
+        self.window = window
+        self.submit = submit  # submit(keyword, info, created_at, batch)，batch 是并入这次发送的全部动作
+        self.pending = {}  # 群组 -> [(keyword, info, created_at)]
+        self._timers = {}
+        self.actions = 0
+        self.sends = 0
+
+    @property
+    def merged(self):
+        """合并掉的回复动作数 (少发送的次数)"""
+        return self.actions - self.sends - sum(len(batch) for batch in self.pending.values())
+
+    def add(self, keyword, info, created_at=None):
+        self.actions += 1
+        group = info.get("source_channel")
+        if self.window <= 0 or group is None:
+            self.sends += 1
+            self.submit(keyword, info, created_at, [(keyword, info, created_at)])
+            return
+        batch = self.pending.setdefault(group, [])
+        batch.append((keyword, info, created_at))
+        if len(batch) == 1:
+            self._timers[group] = asyncio.get_running_loop().call_later(self.window, self.flush, group)
+
+    def flush(self, group):
+        batch = self.pending.pop(group, None)
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        if not batch:
+            return
+        _, info, created_at = max(batch, key=lambda item: item[1].get("source_message_id") or 0)
+        keyword = max(enumerate(batch), key=lambda item: (len(item[1][0]), item[0]))[1][0]
+        if len(batch) > 1:
+            logger.info(f"群组 {group} 合并 {len(batch)} 个回复动作，使用关键词 '{keyword}'")
+        self.sends += 1
+        self.submit(keyword, info, created_at, batch)
+
+    def flush_all(self):
+        for group in list(self.pending):
+            self.flush(group)
+
+    def report(self):
+        return f"群回复合并: 回复动作 {self.actions} 个，发送 {self.sends} 次，合并掉 {self.merged} 次"
+
+
+class NotificationCheckpoint:
+    """
+    通知处理进度
+    每条通知从收到到它的动作全部执行完之间 hold，多进程匹配、回复合并和执行通道各自 hold/release；
+    done 是它和更早的通知都已处理完的最大 id，只有 done 写入状态文件。
+    进程在动作执行前崩溃时，重启后从 done 之后补处理，不会跳过排队中的通知
+    """
+
+    def __init__(self, done=0, on_advance=None):
+        self.done = done
+        self.received = done
+        self.holds = {}  # 通知 id -> 未完成的阶段数；按 id 递增的顺序加入
+        self.on_advance = on_advance
+
+    def hold(self, notification_id):
+        self.holds[notification_id] = self.holds.get(notification_id, 0) + 1
+        self.received = max(self.received, notification_id)
+
+    def release(self, notification_id):
+        count = self.holds[notification_id] - 1
+        if count:
+            self.holds[notification_id] = count
+            return
+        del self.holds[notification_id]
+        self._advance()
+
+    def skip(self, notification_id):
+        """不需要处理的通知 (过期、交接时已由旧进程处理)，更早的通知处理完后直接算作完成"""
+        self.received = max(self.received, notification_id)
+        self._advance()
+
+    def _advance(self):
+        # 通知按 id 顺序收到，holds 中第一个就是最早的未完成通知
+        done = next(iter(self.holds)) - 1 if self.holds else self.received
+        if done > self.done:
+            self.done = done
+            if self.on_advance is not None:
+                self.on_advance()
+
+
+class LoopLagMonitor:
+    """
+    事件循环延迟探针
+    定时 sleep(interval)，实际唤醒时间比预期晚多少就是这段时间里事件循环被阻塞的时长；
+    超过 warn 时告警，说明有处理函数在事件循环里做了同步的耗时操作
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, warn=LOOP_LAG_WARN, samples=3600):
+        self.interval = interval
+        self.warn = warn
+        self.lags = deque(maxlen=samples)
+        self.max_lag = 0.0
+        self.warnings = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.warn:
+                self.warnings += 1
+                logger.warning(f"事件循环被阻塞 {lag * 1000:.0f}ms")
+
+    def report(self):
+        return (
+            f"事件循环延迟 p50={_percentile(self.lags, 50) * 1000:.1f}ms "
+            f"p99={_percentile(self.lags, 99) * 1000:.1f}ms max={self.max_lag * 1000:.1f}ms "
+            f"告警 {self.warnings} 次"
+        )
+
+
+def run_event_loop(coro):
+    """运行主协程，优先使用 uvloop"""
+    if USE_UVLOOP:
+        try:
+            import uvloop
+
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.info("使用 uvloop 事件循环")
+        except ImportError:
+            logger.info("未安装 uvloop，使用默认事件循环")
+    return asyncio.run(coro)
+
+
+class RuntimeProfiler:
+    """
+    按需对运行中的事件循环做性能剖析
+    trigger() 后在事件循环线程上开启 cProfile 和 tracemalloc，持续 seconds 秒后停止，
+    把函数耗时、内存分配 Top N 和未完成的 asyncio 任务 (已知提交时间的显示等待时长) 写到 out_dir。
+    平时不安装任何钩子，没有开销
+    """
+
+    def __init__(self, out_dir=PROFILE_DIR, seconds=PROFILE_SECONDS, top_n=PROFILE_TOP_N, task_ages=None):
+        self.out_dir = out_dir
+        self.seconds = seconds
+        self.top_n = top_n
+        self.task_ages = task_ages or (lambda: {})  # 返回 {task: 提交时间 perf_counter}
+        self.active = False
+
+    def trigger(self):
+        if self.active:
+            logger.info("性能剖析正在进行中，忽略本次触发")
+            return None
+        self.active = True
+        return asyncio.ensure_future(self.capture())
+
+    async def capture(self):
+        logger.info(f"开始性能剖析，持续 {self.seconds} 秒")
+        profile = cProfile.Profile()
+        tracemalloc.start()
+        profile.enable()
+        try:
+            await asyncio.sleep(self.seconds)
+        finally:
+            profile.disable()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self.active = False
+
+        tasks = self.describe_tasks()
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(None, self.write, profile, snapshot, tasks)
+        logger.info(f"性能剖析已保存: {path}")
+        return path
+
+    def describe_tasks(self):
+        ages = self.task_ages()
+        now = time.perf_counter()
+        lines = []
+        for task in asyncio.all_tasks():
+            coro = task.get_coro()
+            name = getattr(coro, "__qualname__", repr(coro))
+            where = ""
+            stack = task.get_stack(limit=1)
+            if stack:
+                where = f" @ {stack[0].f_code.co_filename}:{stack[0].f_lineno}"
+            age = f"{now - ages[task]:8.2f}s" if task in ages else "       ?"
+            lines.append((ages.get(task, now), f"{age}  {task.get_name()}  {name}{where}"))
+        lines.sort()
+        return [line for _, line in lines]
+
+    def write(self, profile, snapshot, tasks):
+        os.makedirs(self.out_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        base = os.path.join(self.out_dir, f"profile-{stamp}")
+        profile.dump_stats(base + ".pstats")
+
+        out = io.StringIO()
+        out.write(f"# cProfile ({self.seconds}s, 按累计耗时)\n")
+        pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(self.top_n)
+        out.write(f"\n# tracemalloc Top {self.top_n}\n")
+        for stat in snapshot.statistics("lineno")[: self.top_n]:
+            out.write(f"{stat}\n")
+        out.write(f"\n# 未完成的 asyncio 任务 ({len(tasks)})\n")
+        for line in tasks:
+            out.write(line + "\n")
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(out.getvalue())
+        return base + ".txt"
+
+
+def _load_callable(spec):
+    """函数原样返回，"模块名:函数名" 字符串导入后返回"""
+    if spec is None or callable(spec):
+        return spec
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+class ShadowRunner:
+    """
+    影子模式
+    offer() 在实时路径上只做抽样判断并把 (消息, 发送者 id, 实时路径选出的解析器) 放进有界队列；后台任务逐条取出，
+    对每个引擎用实时路径相同的输入依次运行当前实现 (active(text, sender_id, parse)) 和候选实现 (candidate(text, sender_id))，用线程 CPU 时间计时，结果不一致时把消息写进 mismatch_file。
+    影子比较累计的 CPU 时间超过 cpu_budget (占运行时间的比例) 时暂停抽样
+    """
+
+    def __init__(
+        self,
+        engines,
+        sample_rate=SHADOW_SAMPLE_RATE,
+        max_pending=SHADOW_MAX_PENDING,
+        cpu_budget=SHADOW_CPU_BUDGET,
+        mismatch_file=SHADOW_MISMATCH_FILE,
+        max_mismatches=SHADOW_MAX_MISMATCHES,
+    ):
+        self.engines = engines  # name -> (当前实现, 候选实现)
+        self.sample_rate = sample_rate
+        self.cpu_budget = cpu_budget
+        self.mismatch_file = mismatch_file
+        self.max_mismatches = max_mismatches
+        self.queue = deque(maxlen=max_pending)
+        self.stats = {name: {"compared": 0, "mismatches": 0, "active": 0.0, "candidate": 0.0} for name in engines}
+        self.offered = 0
+        self.dropped = 0
+        self.cpu = 0.0
+        self.started_at = time.perf_counter()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def offer(self, text, sender_id=None, parse=None):
+        self.offered += 1
+        if random.random() >= self.sample_rate:
+            return
+        if self.cpu > self.cpu_budget * (time.perf_counter() - self.started_at) or len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+            return
+        self.queue.append((text, sender_id, parse))
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self.started_at = time.perf_counter()
+            self._task = asyncio.ensure_future(self._run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self.compare(*self.queue.popleft())
+            # 每条之间让出事件循环
+            await asyncio.sleep(0)
+
+    def compare(self, text, sender_id=None, parse=None):
+        for name, (active, candidate) in self.engines.items():
+            stats = self.stats[name]
+            t0 = time.thread_time()
+            expected = active(text, sender_id, parse)
+            t1 = time.thread_time()
+            try:
+                actual = candidate(text, sender_id)
+            except Exception as e:
+                actual = f"异常: {e!r}"
+            t2 = time.thread_time()
+            stats["compared"] += 1
+            stats["active"] += t1 - t0
+            stats["candidate"] += t2 - t1
+            self.cpu += t2 - t0
+            if actual != expected:
+                stats["mismatches"] += 1
+                self.record(name, text, sender_id, expected, actual)
+
+    def record(self, name, text, sender_id, expected, actual):
+        if sum(st["mismatches"] for st in self.stats.values()) > self.max_mismatches:
+            return
+        try:
+            with open(self.mismatch_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(
+                    {
+                        "time": time.time(), "engine": name, "message": text, "sender_id": sender_id,
+                        "active": expected, "candidate": actual,
+                    },
+                    ensure_ascii=False, default=repr,
+                ) + "\n")
+        except Exception as e:
+            logger.warning(f"写入影子模式不一致记录失败: {e}")
+
+    def report(self):
+        lines = [f"影子模式: 通知 {self.offered}，丢弃 {self.dropped}，CPU {self.cpu * 1000:.0f}ms"]
+        for name, st in self.stats.items():
+            n = st["compared"] or 1
+            lines.append(
+                f"  [{name}] 比较 {st['compared']} 次，不一致 {st['mismatches']} 次 | "
+                f"当前实现 {st['active'] / n * 1e6:.1f}us/次，候选实现 {st['candidate'] / n * 1e6:.1f}us/次"
+            )
+        return "\n".join(lines)
+
+
+class CoordinationStore(abc.ABC):
+    """
+    多实例协调存储的接口
+    claim() 在一次往返里原子地完成: 检查冷却 -> 检查用户/群消息是否已被抢占 -> 抢占并设置冷却。
+    token 标识一条通知，同一条通知触发的多个动作可以共用同一个冷却和同一条群消息；
+    群消息的抢占保留 message_ttl 秒 (超过 CATCHUP_MAX_AGE 的通知不会再执行动作)
+    """
+
+    @abc.abstractmethod
+    async def claim(self, token, now, user_id=None, cooldown_key=None, cooldown_seconds=0, message_key=None):
+        """返回 (是否成功, 失败原因)"""
+
+    @abc.abstractmethod
+    async def release_user(self, user_id):
+        """发送失败时释放抢占的用户，以后还可以再私信"""
+
+    @abc.abstractmethod
+    async def extend_cooldown(self, cooldown_key, until, token=None):
+        """把冷却延长到 until (不会缩短)"""
+
+    @abc.abstractmethod
+    async def release_cooldown(self, cooldown_key, token):
+        """撤销 token 抢占时设置的冷却 (发送没有发生时)，冷却已属于其它 token 时不变"""
+
+    def close(self):
+        pass
+
+
+class MemoryCoordinationStore(CoordinationStore):
+    """单实例默认实现，状态只在本进程内存中"""
+
+    def __init__(self, user_ttl=None, message_ttl=CATCHUP_MAX_AGE):
+        self.user_ttl = user_ttl  # 用户抢占的有效期 (秒)，None 表示永久
+        self.message_ttl = message_ttl
+        self.users = {}  # user_id -> 抢占时间
+        self.claims = deque()  # (抢占时间, user_id)，按时间排序，用于删除过期的抢占
+        self.messages = {}  # 群消息 -> (抢占时间, token)
+        self.message_claims = deque()  # (抢占时间, 群消息)
+        self.cooldowns = {}  # key -> (until, token)
+
+    def _prune(self, now):
+        # 从最早的抢占开始删除过期的用户；释放或重新抢占过的用户时间对不上，只出队
+        while self.claims and now - self.claims[0][0] >= self.user_ttl:
+            at, user_id = self.claims.popleft()
+            if self.users.get(user_id) == at:
+                del self.users[user_id]
+
+    def _claim(self, token, now, user_id, cooldown_key, cooldown_seconds, message_key):
+        if cooldown_key is not None:
+            until, owner = self.cooldowns.get(cooldown_key, (0, None))
+            if now < until and owner != token:
+                return False, f"冷却中 (剩余 {int(until - now)}s)"
+        if message_key is not None:
+            while self.message_claims and now - self.message_claims[0][0] >= self.message_ttl:
+                at, key = self.message_claims.popleft()
+                if self.messages.get(key, (None,))[0] == at:
+                    del self.messages[key]
+            owner = self.messages.get(message_key, (None, None))[1]
+            if owner is not None and owner != token:
+                return False, "群消息已被抢占"
+            if owner is None:
+                self.messages[message_key] = (now, token)
+                self.message_claims.append((now, message_key))
+        if user_id is not None:
+            if self.user_ttl is not None:
+                self._prune(now)
+            if user_id in self.users:
+                return False, "用户已被抢占"
+            self.users[user_id] = now
+            if self.user_ttl is not None:
+                self.claims.append((now, user_id))
+        if cooldown_key is not None and cooldown_seconds > 0:
+            until, owner = self.cooldowns.get(cooldown_key, (0, None))
+            self.cooldowns[cooldown_key] = (max(until, now + cooldown_seconds), token)
+        return True, ""
+
+    async def claim(self, token, now, user_id=None, cooldown_key=None, cooldown_seconds=0, message_key=None):
+        return self._claim(token, now, user_id, cooldown_key, cooldown_seconds, message_key)
+
+    async def release_user(self, user_id):
+        self.users.pop(user_id, None)
+
+    async def extend_cooldown(self, cooldown_key, until, token=None):
+        old, owner = self.cooldowns.get(cooldown_key, (0, None))
+        if until > old:
+            self.cooldowns[cooldown_key] = (until, token)
+
+    async def release_cooldown(self, cooldown_key, token):
+        if self.cooldowns.get(cooldown_key, (0, None))[1] == token:
+            del self.cooldowns[cooldown_key]
+
+
+class SQLiteCoordinationStore(CoordinationStore):
+    """
+    基于 SQLite 的协调存储，不依赖外部服务
+    每次 claim 是一个 BEGIN IMMEDIATE 事务 (SQLite 的写锁保证多个进程之间互斥)，
+    在单独的线程里执行，不阻塞事件循环
+    """
+
+    def __init__(self, path=COORDINATION_DB, timeout=5.0, user_ttl=None, message_ttl=CATCHUP_MAX_AGE):
+        self.path = path
+        self.user_ttl = user_ttl
+        self.message_ttl = message_ttl
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS claimed_users (user_id INTEGER PRIMARY KEY, owner TEXT, at REAL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cooldowns (key TEXT PRIMARY KEY, until REAL, token TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS claimed_messages (key TEXT PRIMARY KEY, owner TEXT, at REAL)"
+        )
+        self.lock = threading.Lock()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _transaction(self, func, *args):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+                self.conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _claim(self, token, now, user_id, cooldown_key, cooldown_seconds, message_key):
+        conn = self.conn
+        if cooldown_key is not None:
+            row = conn.execute("SELECT until, token FROM cooldowns WHERE key = ?", (cooldown_key,)).fetchone()
+            if row and now < row[0] and row[1] != token:
+                return False, f"冷却中 (剩余 {int(row[0] - now)}s)"
+        if message_key is not None:
+            # 同一条通知 (同一个 token) 的多个动作可以重复抢占，过期的记录可以被覆盖
+            cur = conn.execute(
+                "INSERT INTO claimed_messages (key, owner, at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, at = excluded.at "
+                "WHERE claimed_messages.owner = excluded.owner OR claimed_messages.at <= ?",
+                (message_key, token, now, now - self.message_ttl),
+            )
+            if cur.rowcount == 0:
+                return False, "群消息已被抢占"
+            conn.execute("DELETE FROM claimed_messages WHERE at <= ?", (now - self.message_ttl,))
+        if user_id is not None:
+            if self.user_ttl is None:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO claimed_users (user_id, owner, at) VALUES (?, ?, ?)",
+                    (user_id, token, now),
+                )
+            else:
+                # 超过有效期的抢占记录可以被覆盖
+                cur = conn.execute(
+                    "INSERT INTO claimed_users (user_id, owner, at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET owner = excluded.owner, at = excluded.at "
+                    "WHERE claimed_users.at <= ?",
+                    (user_id, token, now, now - self.user_ttl),
+                )
+            if cur.rowcount == 0:
+                return False, "用户已被抢占"
+        if cooldown_key is not None and cooldown_seconds > 0:
+            self._extend(cooldown_key, now + cooldown_seconds, token)
+        return True, ""
+
+    def _extend(self, cooldown_key, until, token):
+        self.conn.execute(
+            "INSERT INTO cooldowns (key, until, token) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET until = excluded.until, token = excluded.token "
+            "WHERE excluded.until > cooldowns.until",
+            (cooldown_key, until, token),
+        )
+
+    async def claim(self, token, now, user_id=None, cooldown_key=None, cooldown_seconds=0, message_key=None):
+        return await self._run(
+            self._transaction, self._claim, token, now, user_id, cooldown_key, cooldown_seconds, message_key
+        )
+
+    async def release_user(self, user_id):
+        await self._run(
+            self._transaction,
+            lambda: self.conn.execute("DELETE FROM claimed_users WHERE user_id = ?", (user_id,)),
+        )
+
+    async def extend_cooldown(self, cooldown_key, until, token=None):
+        await self._run(self._transaction, self._extend, cooldown_key, until, token)
+
+    async def release_cooldown(self, cooldown_key, token):
+        await self._run(
+            self._transaction,
+            lambda: self.conn.execute(
+                "DELETE FROM cooldowns WHERE key = ? AND token = ?", (cooldown_key, token)
+            ),
+        )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def create_coordination_store():
+    # 设置了再次联系间隔时，用户的抢占记录也在同样的时间后失效
+    user_ttl = RECONTACT_DAYS * 86400 if RECONTACT_DAYS is not None else None
+    if COORDINATION_BACKEND == "sqlite":
+        return SQLiteCoordinationStore(COORDINATION_DB, user_ttl=user_ttl)
+    if COORDINATION_BACKEND is not None:
+        raise ValueError(f"未知的协调存储: {COORDINATION_BACKEND}")
+    return MemoryCoordinationStore(user_ttl=user_ttl)
+
+
+# ---------------- 发送失败分类 ----------------
+# (类别, 作用范围, 错误类型)；作用范围 chat / user 只影响该目标，global 进入全局冷却
+SEND_ERROR_CLASSES = [
+    ("slow_mode", "chat", (errors.SlowModeWaitError,)),
+    ("chat_forbidden", "chat", (
+        errors.ChatWriteForbiddenError,
+        errors.UserBannedInChannelError,
+        errors.ChannelPrivateError,
+        errors.ChannelInvalidError,
+        errors.ChatAdminRequiredError,
+        errors.ChatRestrictedError,
+        errors.ChatGuestSendForbiddenError,
+        errors.ChatSendPlainForbiddenError,
+        errors.ChatSendMediaForbiddenError,
+        errors.ChatSendStickersForbiddenError,
+    )),
+    ("privacy", "user", (errors.UserPrivacyRestrictedError,)),
+    ("user_gone", "user", (
+        errors.UserIsBlockedError,
+        errors.YouBlockedUserError,
+        errors.InputUserDeactivatedError,
+        errors.UserIsBotError,
+    )),
+    ("flood", "global", (errors.FloodWaitError, errors.PeerFloodError)),
+]
+
+
+def classify_send_error(error):
+    """返回 (类别, 作用范围)，无法分类时返回 ("other", "global")"""
+    for kind, scope, types in SEND_ERROR_CLASSES:
+        if isinstance(error, types):
+            return kind, scope
+    return "other", "global"
+
+
+class NegativeCache:
+    """
+    发送失败的负缓存
+    record() 对失败分类，群组/用户范围的失败记录 (范围, 目标) -> 到期时间，用户同时按 id 和 username 记录；
+    blocked() 是一次字典查找，在任何 RPC 之前调用，过期的记录在查找时删除
+    """
+
+    def __init__(self, ttl=NEGATIVE_CACHE_TTL, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}  # (范围, 目标) -> (到期时间, 类别)
+        self.errors = {}  # 类别 -> 失败次数
+        self.skipped = {}  # 类别 -> 跳过的动作数
+
+    @staticmethod
+    def target(scope, key):
+        if scope == "chat":
+            return scope, SourcePolicies.key(key)
+        if scope == "username":
+            return scope, key.lower()
+        return scope, key
+
+    def blocked(self, scope, key):
+        """目标在负缓存中时返回类别，否则返回 None"""
+        if key is None or not self.entries:
+            return None
+        target = self.target(scope, key)
+        entry = self.entries.get(target)
+        if entry is None:
+            return None
+        until, kind = entry
+        if self.clock() >= until:
+            del self.entries[target]
+            return None
+        self.skipped[kind] = self.skipped.get(kind, 0) + 1
+        return kind
+
+    def record(self, error, chat=None, user=None, username=None):
+        """返回 (类别, 作用范围, 有效期秒数)"""
+        kind, scope = classify_send_error(error)
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+        # 慢速模式和限流错误带有需要等待的秒数
+        ttl = getattr(error, "seconds", None) or self.ttl.get(kind, 0)
+        key = chat if scope == "chat" else user if scope == "user" else None
+        if key is not None and ttl:
+            self.entries[self.target(scope, key)] = (self.clock() + ttl, kind)
+            # 只有 username 的通知不需要解析出 id 就能跳过
+            if scope == "user" and username:
+                self.entries[self.target("username", username)] = (self.clock() + ttl, kind)
+        return kind, scope, ttl
+
+    def report(self):
+        kinds = sorted(set(self.errors) | set(self.skipped))
+        detail = "，".join(
+            f"{kind} 失败 {self.errors.get(kind, 0)} / 跳过 {self.skipped.get(kind, 0)}" for kind in kinds
+        )
+        return f"负缓存: {len(self.entries)} 个目标" + (f" | {detail}" if detail else "")
+
+
+class MemberPrewarmer:
+    """
+    源群组成员预热
+    note_group() 登记通知中出现的源群组，后台任务按页 iter_participants 拉取成员，
+    建立 user_id / username -> 用户对象的映射 (用户对象带 access_hash，也可直接用于用户过滤)。
+    每页之后等待 page_delay 秒，idle() 返回 False 时 (动作通道有任务) 等待 busy_page_delay 秒，
+    把大部分 RPC 配额留给动作，但不会因为一直有任务而停止预热
+    """
+
+    def __init__(
+        self,
+        client,
+        idle=lambda: True,
+        page_size=PREWARM_PAGE_SIZE,
+        page_delay=PREWARM_PAGE_DELAY,
+        busy_page_delay=PREWARM_BUSY_PAGE_DELAY,
+        max_members=PREWARM_MAX_MEMBERS,
+        refresh=PREWARM_REFRESH,
+        clock=time.time,
+    ):
+        self.client = client
+        self.idle = idle
+        self.page_size = page_size
+        self.page_delay = page_delay
+        self.busy_page_delay = busy_page_delay
+        self.max_members = max_members
+        self.refresh = refresh
+        self.clock = clock
+        self.users = {}  # user_id -> User
+        self.by_username = {}
+        self.groups = {}  # 群组 -> (预热时间, 拉到的成员数, 群组总人数)
+        self.pages = 0
+        self.lookups = 0
+        self.hits = 0
+        self._queue = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def note_group(self, group):
+        if group is None or group in self._queue:
+            return
+        warmed = self.groups.get(group)
+        if warmed and self.clock() - warmed[0] < self.refresh:
+            return
+        self._queue.append(group)
+        self._wakeup.set()
+
+    def lookup(self, user_id=None, username=None):
+        """按 user_id 或 username 查预热的用户对象，未命中返回 None"""
+        if user_id is None and username is None:
+            return None
+        self.lookups += 1
+        user = self.users.get(user_id)
+        if user is None and username:
+            user = self.by_username.get(username.lower())
+        if user is not None:
+            self.hits += 1
+        return user
+
+    def add(self, user):
+        if not getattr(user, "access_hash", None):
+            return
+        self.users[user.id] = user
+        if getattr(user, "username", None):
+            self.by_username[user.username.lower()] = user
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # 拉取完成后才出队，期间再次登记同一群组不会重复排队
+            await self.warm(self._queue[0])
+            self._queue.popleft()
+
+    async def warm(self, group):
+        count = 0
+        total = None
+        try:
+            participants = self.client.iter_participants(group, limit=self.max_members)
+            async for user in participants:
+                self.add(user)
+                count += 1
+                if count % self.page_size == 0:
+                    await self._pace()
+            total = getattr(participants, "total", None)
+            self.pages += -(-count // self.page_size) or 1
+            logger.info(f"预热群组 {group} 成员 {count}/{total if total is not None else '?'}")
+        except Exception as e:
+            logger.warning(f"预热群组 {group} 成员失败: {e}")
+        self.groups[group] = (self.clock(), count, total if total is not None else count)
+
+    async def _pace(self):
+        # 每页之后等待，动作通道有任务时等更久 (限速而不是等到空闲，持续有通知时也能推进)
+        await asyncio.sleep(self.page_delay if self.idle() else self.busy_page_delay)
+
+    def coverage(self):
+        fetched = sum(count for _, count, _ in self.groups.values())
+        total = sum(total for _, _, total in self.groups.values())
+        return fetched / total if total else 0.0
+
+    def report(self):
+        hit_rate = self.hits / self.lookups if self.lookups else 0.0
+        return (
+            f"成员预热: 群组 {len(self.groups)} 个，用户 {len(self.users)}，覆盖率 {self.coverage():.0%}，"
+            f"私信查询 {self.lookups} 次，命中率 {hit_rate:.0%}"
+        )
+
+
+# ---------------- 通知格式 ----------------
+# 内置的通知解析器，NOTIFICATION_FORMATS 里用名字引用
+NOTIFICATION_PARSERS = {}
+
+
+def notification_parser(name):
+    """注册一个内置的通知解析器"""
+    def register(func):
+        NOTIFICATION_PARSERS[name] = func
+        return func
+    return register
+
+
+@notification_parser("found")
+def parse_found_notification(text):
+    """
+    第一行形如:
+    #FOUND (https://t.me/c/1958152252/123) "关键词" IN group(1958152252) FROM name(@user)
+    """
+    result = {
+        "source_channel": None,
+        "source_message_id": None,
+        "keyword": None,
+        "sender_username": None,
+        "sender_id": None,
+    }
+
+    lines = text.split("\n")
+    if not lines:
+        return result
+
+    first = lines[0]
+
+    # 1. 私有频道 t.me/c
+    m = re.search(r"https://t\.me/c/(\d+)/(\d+)", first)
+    if m:
+        cid = int("-100" + m.group(1))
+        mid = int(m.group(2))
+        result["source_channel"] = cid
+        result["source_message_id"] = mid
+    else:
+        # 2. 公共频道 t.me/xxx
+        m = re.search(r"https://t\.me/([^/\s]+)/(\d+)", first)
+        if m:
+            result["source_channel"] = m.group(1)
+            result["source_message_id"] = int(m.group(2))
+
+    # 3. 关键词
+    m = re.search(r'"([^"]+)"', first)
+    if m:
+        result["keyword"] = m.group(1)
+
+    # 4. 发送者
+    m = re.search(r"FROM\s+([^(]+)\((@?[\w_]+)\)", first)
+    if m:
+        sid = m.group(2)
+        if sid.startswith("@"):
+            result["sender_username"] = sid[1:]
+        else:
+            try:
+                result["sender_id"] = int(sid)
+            except:
+                pass
+
+    return result
+
+
+class NotificationFormats:
+    """
+    通知格式注册表
+    先按发送者 id 查字典，再按前缀查字典 (从最长的前缀开始，每种长度切片一次)，
+    每条通知最多选出一个解析器；都不符合时返回 None，select() 同时按格式计数
+    """
+
+    def __init__(self, formats):
+        self.by_sender = {}
+        self.by_prefix = {}
+        for fmt in formats:
+            name = fmt.get("name") or fmt.get("prefix") or str(fmt.get("sender"))
+            parser = fmt.get("parser")
+            parser = NOTIFICATION_PARSERS.get(parser) or _load_callable(parser)
+            if parser is None:
+                raise ValueError(f"通知格式 {name} 没有解析器")
+            entry = (name, parser)
+            if fmt.get("sender") is not None:
+                if fmt["sender"] in self.by_sender:
+                    raise ValueError(f"通知格式 {name} 的发送者和其它格式重复: {fmt['sender']}")
+                self.by_sender[fmt["sender"]] = entry
+            elif fmt.get("prefix"):
+                if fmt["prefix"] in self.by_prefix:
+                    raise ValueError(f"通知格式 {name} 的前缀和其它格式重复: {fmt['prefix']}")
+                self.by_prefix[fmt["prefix"]] = entry
+            else:
+                raise ValueError(f"通知格式 {name} 需要 prefix 或 sender")
+        self.prefix_lengths = sorted({len(p) for p in self.by_prefix}, reverse=True)
+        self.counts = {entry[0]: 0 for entry in (*self.by_sender.values(), *self.by_prefix.values())}
+        self.unknown = 0
+        self.unparsed = 0  # 符合格式但解析器返回 None
+
+    def find(self, text, sender_id=None):
+        """返回 (格式名, 解析器)，不符合任何格式时返回 None"""
+        entry = self.by_sender.get(sender_id) if self.by_sender else None
+        if entry is None:
+            for length in self.prefix_lengths:
+                entry = self.by_prefix.get(text[:length])
+                if entry is not None:
+                    break
+        return entry
+
+    def select(self, text, sender_id=None):
+        """同 find()，并按格式计数"""
+        entry = self.find(text, sender_id)
+        if entry is None:
+            self.unknown += 1
+            return None
+        self.counts[entry[0]] += 1
+        return entry
+
+    def report(self):
+        counts = "，".join(f"{name} {count}" for name, count in self.counts.items())
+        return f"通知格式: {counts}，未知格式 {self.unknown}，解析失败 {self.unparsed}"
+
+
+def monitor_message_from_update(update, channel_id):
+    """原始更新路径的过滤: 只接受指定频道的普通消息 (不含 MessageService)"""
+    message = update.message
+    if getattr(message.peer_id, "channel_id", None) != channel_id:
+        return None
+    return message if isinstance(message, Message) else None
+
+
+class KeywordMonitorBot:
+    def __init__(self, client=None, clock=time.time, coordination=None):
+        self.client = client or TelegramClient(create_session(), API_ID, API_HASH)
+        # 时间来源，测试时可以替换成模拟时钟
+        self.clock = clock
+        self.sticker_cache = {}
+        self.load_keyword_actions()
+        self.matcher = KeywordMatcher(KEYWORD_ACTIONS)
+        self.matcher_pool = MatcherPool(KEYWORD_ACTIONS, MATCHER_PROCESSES) if MATCHER_PROCESSES else None
+        self.keyword_version = 0
+        self._rebuilding = False
+        self.keywords_writer = WriteBehindFile(KEYWORDS_FILE, lambda: dict(KEYWORD_ACTIONS))
+        self.user_filter = UserFilter(USER_FILTER_RULES)
+        self.formats = NotificationFormats(NOTIFICATION_FORMATS)
+        self.source_policies = SourcePolicies(SOURCE_POLICIES, SOURCE_POLICY_DEFAULT)
+        self.negative_cache = NegativeCache(clock=clock)
+        self.interacted_users = create_interacted_users(clock)
+        # 使用冷却结束时间，而不是最后触发时间
+        self.cooldown_until = 0
+
+        # 已收到的最后一条监控频道消息 id，补处理和实时处理互斥；
+        # 写入状态文件的是 checkpoint.done (动作都已执行完的通知)
+        self.last_monitor_id = self.load_state().get("last_monitor_id", 0)
+        self.checkpoint = NotificationCheckpoint(
+            self.last_monitor_id, on_advance=lambda: self.state_writer.mark_dirty()
+        )
+        self.state_writer = WriteBehindFile(
+            STATE_FILE, lambda: {"last_monitor_id": self.checkpoint.done}
+        )
+        self.monitor_lock = asyncio.Lock()
+
+        # 动作执行通道
+        self.lanes = {
+            "reply": ActionLane(
+                "reply", LANE_CONCURRENCY["reply"], deadline=REPLY_DEADLINE, clock=clock
+            ),
+            "dm": ActionLane("dm", LANE_CONCURRENCY["dm"], clock=clock),
+        }
+        self.reply_coalescer = ReplyCoalescer(REPLY_COALESCE_WINDOW, self.submit_reply)
+        self.profiler = RuntimeProfiler(task_ages=self.pending_task_ages)
+
+        # 多实例协调
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.coordination = coordination or create_coordination_store()
+        # 发送失败时撤销过全局冷却的通知 (最近的若干条)，其它动作成功后需要重新写入
+        self.released_cooldowns = deque(maxlen=256)
+        self.loop_lag = LoopLagMonitor()
+        self.shadow = self.create_shadow()
+        # 私信单飞: 进行中的获取/过滤任务，和正在私信的用户
+        self.inflight = {}
+        self.dm_reserved = set()
+        self.prewarmer = MemberPrewarmer(
+            self.client, idle=lambda: not self.pending_task_ages(), clock=clock
+        )
+        # 无停机重启: 交接给新进程后不再处理任何通知
+        self.handoff_server = None
+        self.handed_off = False
+        self.closed = False  # shutdown() 已经执行过
+
+    # ---------------- 状态持久化 ----------------
+    def create_shadow(self):
+        engines = {}
+        # 候选实现按 (text, sender_id) 调用；当前实现还拿到实时路径选出的解析器 (它按原始文本判别格式，
+        # markdown 还原后的文本可能以 ** 等标记开头，重新判别会选错)。匹配器不需要发送者
+        matcher = _load_callable(SHADOW_MATCHER)
+        if matcher is not None:
+            engines["matcher"] = (
+                lambda text, sender_id, parse: self.check_keywords(text),
+                lambda text, sender_id: matcher(text),
+            )
+        parser = _load_callable(SHADOW_PARSER)
+        if parser is not None:
+            engines["parser"] = (
+                lambda text, sender_id, parse: (
+                    parse(text) if parse is not None else self.parse_notification_message(text, sender_id)
+                ),
+                parser,
+            )
+        return ShadowRunner(engines) if engines else None
+
+    def pending_task_ages(self):
+        ages = {}
+        for lane in self.lanes.values():
+            ages.update(lane.tasks)
+        return ages
+
+    def load_state(self):
+        if os.path.exists(STATE_FILE):
+            try:
+                with open(STATE_FILE, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except Exception as e:
+                logger.warning(f"加载状态文件失败: {e}")
+        return {}
+
+    def shutdown(self):
+        """退出前写入所有未保存的状态 (交接时已经调用过的话什么也不做)"""
+        if self.closed:
+            return
+        self.closed = True
+        self.interacted_users.close()
+        self.state_writer.close()
+        self.keywords_writer.close()
+        self.coordination.close()
+        if self.matcher_pool is not None:
+            self.matcher_pool.close()
+        if isinstance(getattr(self.client, "session", None), SnapshotSession):
+            self.client.session.writer.close()
+        logger.info("状态已保存")
+
+    async def should_filter_user(self, user_id, entity=None, user=None):
+        """
+        按 USER_FILTER_RULES 检查用户是否应该被过滤 (user 为已有的用户对象，例如预热缓存)
+        返回 (should_filter: bool, reason: str)
+        """
+
+        async def fetch_user():
+            return await self.client.get_entity(entity)
+
+        async def fetch_about():
+            from telethon import functions
+            full_user = await self.client(functions.users.GetFullUserRequest(entity))
+            return getattr(getattr(full_user, "full_user", None), "about", None)
+
+        if entity is None:
+            # 没有实体时只能执行只需要 user_id 的规则
+            fetch_user = fetch_about = None
+
+        should_filter, reason, rpcs = await self.user_filter.decide(user_id, fetch_user, fetch_about, user=user)
+        logger.debug(f"用户 {user_id} 过滤判断使用 {rpcs} 次 RPC (先取全部数据需要 {self.user_filter.full_cost} 次)")
+        return should_filter, reason
+
+    # ---------------- 管理命令 ----------------
+    def load_keyword_actions(self):
+        """管理命令保存过的关键词配置代替脚本中的 KEYWORD_ACTIONS (原地替换，其它地方引用的是同一个字典)"""
+        if os.path.exists(KEYWORDS_FILE):
+            try:
+                with open(KEYWORDS_FILE, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                KEYWORD_ACTIONS.clear()
+                KEYWORD_ACTIONS.update(data)
+                logger.info(f"已从 {KEYWORDS_FILE} 加载 {len(data)} 个关键词")
+            except Exception as e:
+                logger.warning(f"加载关键词文件失败: {e}")
+
+    def set_keyword(self, keyword, cfg):
+        """增加或修改一个关键词，只在匹配方式变化时更新匹配器"""
+        old = KEYWORD_ACTIONS.get(keyword)
+        matcher_changed = old is None or old.get("match", "substring") != cfg.get("match", "substring")
+        if matcher_changed:
+            self.matcher.add(keyword, cfg)
+        # 整体替换配置字典，后台写盘线程不会读到改了一半的配置
+        KEYWORD_ACTIONS[keyword] = cfg
+        self.keywords_changed(matcher_changed)
+
+    def remove_keyword(self, keyword):
+        if keyword not in KEYWORD_ACTIONS:
+            return False
+        self.matcher.remove(keyword)
+        del KEYWORD_ACTIONS[keyword]
+        self.keywords_changed()
+        return True
+
+    def keywords_changed(self, matcher_changed=True):
+        self.keyword_version += 1
+        self.keywords_writer.mark_dirty()
+        # 工作进程只负责匹配，动作、文本和贴纸的修改不需要换进程
+        if self.matcher_pool is not None and matcher_changed:
+            self.matcher_pool.reload(KEYWORD_ACTIONS)
+        if self.matcher.delta_size > KEYWORD_DELTA_MAX and not self._rebuilding:
+            asyncio.ensure_future(self.rebuild_matcher())
+
+    async def rebuild_matcher(self):
+        """在后台线程整体重建匹配器；重建期间关键词又有修改时放弃这次结果，等下次修改再重建"""
+        self._rebuilding = True
+        version = self.keyword_version
+        try:
+            matcher = await asyncio.get_running_loop().run_in_executor(
+                None, KeywordMatcher, dict(KEYWORD_ACTIONS), self.matcher.normalizer
+            )
+            if version == self.keyword_version:
+                self.matcher = matcher
+                logger.info(f"关键词匹配器已重建: {len(KEYWORD_ACTIONS)} 个关键词")
+        finally:
+            self._rebuilding = False
+
+    @staticmethod
+    def describe_keyword(keyword, cfg):
+        parts = [cfg.get("action", "?"), cfg.get("match", "substring")]
+        if cfg.get("sticker_pack") is not None:
+            parts.append(f"贴纸 {cfg['sticker_pack']}[{cfg.get('sticker_index')}]")
+        if cfg.get("text"):
+            text = cfg["text"].strip().split("\n")[0]
+            parts.append(f"文本 {text[:20]}{'...' if len(text) > 20 else ''}")
+        return f"{keyword}: " + ", ".join(parts)
+
+    def list_keywords(self, page):
+        """按页列出关键词，每页 (含页头) 不超过 ADMIN_REPLY_LIMIT 个字符"""
+        if not KEYWORD_ACTIONS:
+            return "没有关键词"
+        pages, lines, size = [], [], 0
+        for kw, cfg in KEYWORD_ACTIONS.items():
+            line = self.describe_keyword(kw, cfg)[:ADMIN_REPLY_LIMIT - 100]
+            if lines and size + len(line) + 1 > ADMIN_REPLY_LIMIT - 100:
+                pages.append(lines)
+                lines, size = [], 0
+            lines.append(line)
+            size += len(line) + 1
+        pages.append(lines)
+        page = min(max(page, 1), len(pages))
+        header = f"关键词 {len(KEYWORD_ACTIONS)} 个，第 {page}/{len(pages)} 页"
+        if page < len(pages):
+            header += f" (下一页: {ADMIN_PREFIX} list {page + 1})"
+        return header + "\n" + "\n".join(pages[page - 1])
+
+    async def handle_admin_command(self, text):
+        """执行一条管理命令，返回回复内容"""
+        first, _, body = text.partition("\n")
+        body = body.strip()
+        usage = f"用法: {ADMIN_PREFIX} list [页码] | add <关键词> <reply|dm> [匹配方式] | remove <关键词> | " \
+                f"action <关键词> <reply|dm> | sticker <关键词> <贴纸包> <序号>|none | text <关键词>"
+        try:
+            args = shlex.split(first)[1:]
+        except ValueError as e:
+            return f"命令格式错误: {e}"
+        if not args:
+            return usage
+        cmd, args = args[0], args[1:]
+
+        if cmd == "list":
+            return self.list_keywords(int(args[0]) if args and args[0].isdigit() else 1)
+        if not args:
+            return usage
+        keyword = args[0]
+        cfg = KEYWORD_ACTIONS.get(keyword)
+        if cmd != "add" and cfg is None:
+            return f"关键词 '{keyword}' 不存在"
+
+        start = time.perf_counter()
+        if cmd == "add":
+            if len(args) < 2 or args[1] not in self.lanes:
+                return usage
+            cfg = {"action": args[1]}
+            if len(args) > 2 and args[2] != "substring":
+                if args[2] not in MATCH_KINDS:
+                    return f"匹配方式无效: {args[2]}"
+                cfg["match"] = args[2]
+            if body:
+                cfg["text"] = body
+        elif cmd == "remove":
+            self.remove_keyword(keyword)
+            return f"已删除关键词 '{keyword}' (匹配器更新 {(time.perf_counter() - start) * 1e6:.0f}us)"
+        elif cmd == "action":
+            if len(args) < 2 or args[1] not in self.lanes:
+                return usage
+            cfg = {**cfg, "action": args[1]}
+        elif cmd == "sticker":
+            if len(args) == 2 and args[1] == "none":
+                cfg = {k: v for k, v in cfg.items() if k not in ("sticker_pack", "sticker_index")}
+            else:
+                try:
+                    pack, index = args[1], int(args[2])
+                except (IndexError, ValueError):
+                    return usage
+                if await self.get_sticker(pack, index) is None:
+                    return f"获取贴纸 {pack}[{index}] 失败"
+                start = time.perf_counter()
+                cfg = {**cfg, "sticker_pack": pack, "sticker_index": index}
+        elif cmd == "text":
+            cfg = {k: v for k, v in cfg.items() if k != "text"}
+            if body:
+                cfg["text"] = body
+        else:
+            return usage
+
+        try:
+            self.set_keyword(keyword, cfg)
+        except (ValueError, re.error) as e:
+            return f"关键词 '{keyword}' 无效: {e}"
+        elapsed = time.perf_counter() - start
+        logger.info(f"管理命令 {cmd} '{keyword}' 已生效，耗时 {elapsed * 1e6:.0f}us")
+        return f"已更新 {self.describe_keyword(keyword, cfg)} (耗时 {elapsed * 1e6:.0f}us)"
+
+    # ---------------- 获取贴纸 ----------------
+    async def get_sticker(self, pack_name, index):
+        """安全获取指定贴纸包的某个贴纸（index=0 也正确处理）"""
+        cache_key = (pack_name, index)
+
+        if cache_key in self.sticker_cache:
+            return self.sticker_cache[cache_key]
+
+        if pack_name is None or index is None:
+            return None
+
+        try:
+            from telethon import functions
+
+            sticker_set = await self.client(
+                functions.messages.GetStickerSetRequest(
+                    stickerset=InputStickerSetShortName(short_name=pack_name), hash=0
+                )
+            )
+
+            docs = sticker_set.documents or []
+            if index < 0 or index >= len(docs):
+                logger.error(f"贴纸包 {pack_name} 不存在 index={index} 的贴纸")
+                return None
+
+            self.sticker_cache[cache_key] = docs[index]
+            logger.info(f"预加载贴纸：{pack_name}[{index}]")
+            return docs[index]
+
+        except Exception as e:
+            logger.error(f"获取贴纸 {pack_name}[{index}] 失败: {e}")
+            return None
+
+    # ---------------- 解析监控频道的通知 ----------------
+    def parse_notification_message(self, text, sender_id=None):
+        """按通知格式选出解析器并解析；不符合任何格式时返回 None"""
+        entry = self.formats.find(text, sender_id)
+        return entry[1](text) if entry is not None else None
+
+    # ---------------- 匹配关键词 ----------------
+    def check_keywords(self, text):
+        return self.matcher.match(text)
+
+    # ---------------- 处理匹配动作 ----------------
+    async def handle_keyword_match(self, keyword, info):
+        """
+        返回值:
+        - "success": 消息发送成功
+        - "send_error": 消息发送失败 (限流或无法分类的失败)
+        - "target_error": 目标群组/用户不可用 (记入负缓存，不进入冷却)
+        - "fetch_error": 获取用户失败
+        - "skip": 跳过（用户已互动或被过滤）
+        """
+        # 排队期间关键词可能已经被 /kw remove 删除
+        cfg = KEYWORD_ACTIONS.get(keyword)
+        if cfg is None:
+            logger.info(f"关键词 '{keyword}' 已删除，跳过")
+            return "skip"
+
+        action = cfg.get("action")
+        text = cfg.get("text")
+        pack = cfg.get("sticker_pack")
+        index = cfg.get("sticker_index")
+
+        source_channel = info.get("source_channel")
+        source_message_id = info.get("source_message_id")
+        token = f"{self.instance_id}:{info.get('notification_id')}"
+
+        # 0. 已知发送会失败的群组/用户直接跳过
+        if action == "reply":
+            kind = self.negative_cache.blocked("chat", source_channel)
+            if kind is not None:
+                logger.info(f"群组 {source_channel} 在负缓存中 ({kind})，跳过回复")
+                return "skip"
+        elif action == "dm":
+            sender = info.get("sender_id") or info.get("sender_username")
+            if (
+                self.negative_cache.blocked("user", info.get("sender_id")) is not None
+                or self.negative_cache.blocked("username", info.get("sender_username")) is not None
+            ):
+                logger.info(f"用户 {sender} 在负缓存中，跳过私信")
+                return "skip"
+            if info.get("sender_id") and info["sender_id"] in self.interacted_users:
+                logger.info(f"用户 {sender} 已互动过，跳过")
+                return "skip"
+
+        # 1. 尝试取贴纸
+        sticker = None
+        if pack is not None and index is not None:
+            sticker = await self.get_sticker(pack, index)
+
+        # 2. 执行动作
+        # 群回复
+        if action == "reply":
+            if source_channel and source_message_id:
+                # 发送前抢占这条群消息和全局冷却，多个实例只有一个会回复 (群消息的键与实例无关)
+                ok, reason = await self.coordination.claim(
+                    token,
+                    self.clock(),
+                    cooldown_key="global",
+                    cooldown_seconds=COOLDOWN_MESSAGE_SENT,
+                    message_key=f"{SourcePolicies.key(source_channel)}:{source_message_id}",
+                )
+                if not ok:
+                    logger.info(f"回复 {source_channel} 未抢占成功: {reason}")
+                    return "skip"
+                try:
+                    if sticker:
+                        await self.client.send_file(
+                            source_channel, sticker, reply_to=source_message_id
+                        )
+                    if text:
+                        await self.client.send_message(
+                            source_channel, text, reply_to=source_message_id
+                        )
+                    return "success"
+                except Exception as e:
+                    logger.error(f"发送回复失败: {e}")
+                    return await self.send_failed(e, token, chat=source_channel)
+            return "success"
+
+        # 私信
+        if action == "dm":
+            # 2.1 获取用户实体 (同一发送者并发的多个私信动作共用一次获取)
+            target = await self.single_flight(
+                self.dm_target_key(info), lambda: self.resolve_dm_target(info)
+            )
+
+            # 2.2 最终检查是否拿到 entity (获取失败返回 fetch_error)
+            if target is None:
+                logger.warning("无法获取用户实体，无法私信")
+                return "fetch_error"
+            entity, final_user_id, cached_user = target
+
+            # 2.3 检查是否已知无法私信或已互动 (不进入冷却)，在需要 RPC 的过滤之前
+            kind = self.negative_cache.blocked("user", final_user_id)
+            if kind is not None:
+                logger.info(f"用户 {final_user_id} 在负缓存中 ({kind})，跳过")
+                return "skip"
+            if final_user_id in self.interacted_users:
+                logger.info(f"用户 {final_user_id} 已互动过，跳过")
+                return "skip"
+
+            # 2.4 检查用户是否应该被过滤 (被过滤不进入冷却，同一用户并发的判断共用一次结果)
+            should_filter, filter_reason = await self.single_flight(
+                ("filter", final_user_id),
+                lambda: self.should_filter_user(final_user_id, entity, cached_user),
+            )
+            if should_filter:
+                logger.info(f"用户 {final_user_id} 被过滤: {filter_reason}")
+                return "skip"
+
+            # 3. 检查是否正在私信 (不进入冷却)
+            if final_user_id in self.dm_reserved:
+                logger.info(f"用户 {final_user_id} 正在私信中，跳过")
+                return "skip"
+
+            # 3.1 在本进程内预留用户 (检查和预留之间没有 await，是原子的)，发送结束后释放
+            self.dm_reserved.add(final_user_id)
+            try:
+                return await self.send_dm(
+                    entity, final_user_id, token, sticker, text, info.get("sender_username")
+                )
+            finally:
+                self.dm_reserved.discard(final_user_id)
+
+        return "skip"
+
+    def dm_target_key(self, info):
+        """同一发送者的单飞键: 优先用通知里的 user_id / username，否则只能按源消息区分"""
+        if info.get("sender_id"):
+            return ("id", info["sender_id"])
+        if info.get("sender_username"):
+            return ("username", info["sender_username"].lower())
+        return ("message", info.get("source_channel"), info.get("source_message_id"))
+
+    async def single_flight(self, key, factory):
+        """
+        同一个 key 同时只执行一次 factory()，并发的调用者等待同一个结果。
+        shield 保证某个调用者被取消时不会取消其它调用者在等的任务
+        """
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def resolve_dm_target(self, info):
+        """返回 (entity, user_id, 预热缓存的用户对象或 None)，获取失败返回 None"""
+        sender_username = info.get("sender_username")
+        source_channel = info.get("source_channel")
+        source_message_id = info.get("source_message_id")
+
+        # 先查预热的源群组成员，命中时不需要 RPC
+        cached_user = self.prewarmer.lookup(info.get("sender_id"), sender_username)
+        if cached_user is not None:
+            return utils.get_input_peer(cached_user), cached_user.id, cached_user
+
+        # 如果有 username → 直接获取对象
+        if sender_username:
+            try:
+                entity = await self.client.get_input_entity(sender_username)
+                logger.info(f"通过 username 获取到用户实体: {sender_username}")
+                return entity, entity.user_id, None
+            except Exception as e:
+                logger.warning(f"通过 username 获取用户实体失败: {e}")
+
+        # 如果 username 不存在或失败 → 再通过群消息获取 from_id
+        if source_channel and source_message_id:
+            try:
+                msg = await self.client.get_messages(
+                    source_channel, ids=source_message_id
+                )
+                if msg and msg.from_id:
+                    logger.info(f"通过群消息获取到用户 ID: {msg.from_id.user_id}")
+                    return PeerUser(msg.from_id.user_id), msg.from_id.user_id, None
+            except Exception as e:
+                logger.warning(f"通过群消息获取用户实体失败: {e}")
+        return None
+
+    async def send_dm(self, entity, final_user_id, token, sticker, text, username=None):
+        # 发送前原子地抢占用户和全局冷却，多个实例只有一个会私信
+        ok, reason = await self.coordination.claim(
+            token,
+            self.clock(),
+            user_id=final_user_id,
+            cooldown_key="global",
+            cooldown_seconds=COOLDOWN_MESSAGE_SENT,
+        )
+        if not ok:
+            logger.info(f"私信用户 {final_user_id} 未抢占成功: {reason}")
+            return "skip"
+
+        # 发送贴纸 (只有全局性的失败返回 send_error 进入冷却)
+        if sticker:
+            try:
+                await self.client.send_file(entity, sticker)
+            except Exception as e:
+                logger.error(f"发送贴纸私信失败: {e}")
+                await self.coordination.release_user(final_user_id)
+                return await self.send_failed(e, token, user=final_user_id, username=username)
+
+        # 发送文本 (只有全局性的失败返回 send_error 进入冷却)
+        if text:
+            try:
+                await self.client.send_message(entity, text)
+            except Exception as e:
+                logger.error(f"发送文本私信失败: {e}")
+                await self.coordination.release_user(final_user_id)
+                return await self.send_failed(e, token, user=final_user_id, username=username)
+
+        # 记录已互动用户
+        self.interacted_users.add(final_user_id)
+
+        return "success"
+
+    async def send_failed(self, error, token, chat=None, user=None, username=None):
+        """发送失败: 分类并记入负缓存，返回 run_action 使用的结果"""
+        kind, scope, ttl = self.negative_cache.record(error, chat=chat, user=user, username=username)
+        if scope != "global":
+            # 发送没有发生: 撤销抢占时写入的全局冷却 (同一条通知的其它动作已经成功时保留)
+            if self.clock() >= self.cooldown_until:
+                # 先记录再 await，撤销期间成功的其它动作也能看到
+                self.released_cooldowns.append(token)
+                await self.coordination.release_cooldown("global", token)
+            logger.warning(f"{chat or user} 不可用 ({kind})，{ttl}秒内跳过")
+            return "target_error"
+        if kind == "flood" and ttl > COOLDOWN_MESSAGE_SENT:
+            # 限流等待比发送冷却更长时按限流时间冷却
+            self.cooldown_until = max(self.cooldown_until, self.clock() + ttl)
+            await self.coordination.extend_cooldown("global", self.cooldown_until, token)
+        return "send_error"
+
+    # ---------------- 处理监控频道的通知 ----------------
+    async def process_notification(self, message):
+        """处理监控频道的一条通知；它的动作都执行完后才计入保存的进度"""
+        self.last_monitor_id = max(self.last_monitor_id, message.id)
+
+        # 用原始文本判别格式 (不受 markdown 标记影响)，未知格式的通知不匹配也不解析
+        entry = self.formats.select(message.message or "", getattr(message, "sender_id", None))
+        if entry is None:
+            self.checkpoint.skip(message.id)
+            return
+
+        msg = markdown.unparse(message.message, message.entities)
+        self.checkpoint.hold(message.id)
+        if self.matcher_pool is not None:
+            # 在工作进程中匹配，不等待结果；结果按通知顺序交给动作阶段
+
+            def on_result(matches):
+                try:
+                    self.dispatch_matches(message, entry[1], msg, matches)
+                finally:
+                    self.checkpoint.release(message.id)
+
+            self.matcher_pool.submit(msg, on_result, lambda: self.checkpoint.release(message.id))
+            return
+        try:
+            self.dispatch_matches(message, entry[1], msg, self.check_keywords(msg))
+        finally:
+            self.checkpoint.release(message.id)
+
+    def dispatch_matches(self, message, parse, msg, matches):
+        """动作阶段: 检查冷却、解析通知、检查源群组策略，把动作分发到执行通道"""
+        if self.shadow is not None:
+            self.shadow.offer(msg, getattr(message, "sender_id", None), parse)
+
+        if not matches:
+            return
+        
+        # 检查冷却期
+        current_time = self.clock()
+        if current_time < self.cooldown_until:
+            remaining = int(self.cooldown_until - current_time)
+            logger.info(f"处于冷却期 (剩余 {remaining}s，跳过处理: {matches}")
+            return
+
+        info = parse(msg)
+        if info is None:
+            # 解析器认不出这条通知，与未知格式一样只计数
+            self.formats.unparsed += 1
+            logger.info(f"通知 {message.id} 解析失败，跳过: {matches}")
+            return
+        # 源群组策略: 被忽略的群组和不允许的动作在这里就丢弃，不会请求贴纸、用户或发送
+        allowed = self.source_policies.filter(info["source_channel"], matches)
+        if len(allowed) < len(matches):
+            logger.info(f"源群组 {info['source_channel']} 的策略不允许: {[kw for kw in matches if kw not in allowed]}")
+            if not allowed:
+                return
+            matches = allowed
+        info["notification_id"] = message.id
+        if PREWARM_MEMBERS:
+            self.prewarmer.note_group(info["source_channel"])
+        created_at = message.date.timestamp() if message.date else None
+
+        # 按动作类型分发到各自的执行通道，群回复不会被私信的慢请求拖住
+        for kw in matches:
+            action = KEYWORD_ACTIONS.get(kw, {}).get("action")
+            lane = self.lanes.get(action)
+            if lane is None:
+                logger.info(f"关键词 '{kw}' 动作无效，跳过")
+                continue
+            self.checkpoint.hold(message.id)
+            if action == "reply":
+                # 同一群组短时间内的回复先合并
+                self.reply_coalescer.add(kw, info, created_at)
+                continue
+            task = lane.submit(lambda kw=kw: self.run_action(kw, info), created_at)
+            task.add_done_callback(lambda _: self.checkpoint.release(message.id))
+
+    def submit_reply(self, keyword, info, created_at, batch):
+        """合并后的群回复交给执行通道；发送完成后并入这次发送的通知才算处理完"""
+        task = self.lanes["reply"].submit(lambda: self.run_action(keyword, info), created_at)
+        for _, merged, _ in batch:
+            task.add_done_callback(lambda _, nid=merged["notification_id"]: self.checkpoint.release(nid))
+
+    async def run_action(self, keyword, info):
+        """执行一个关键词动作，并根据结果设置冷却时间"""
+        # 排队期间其它动作可能已经触发了冷却
+        if self.clock() < self.cooldown_until:
+            logger.info(f"处于冷却期，跳过关键词 '{keyword}'")
+            return "skip"
+
+        result = await self.handle_keyword_match(keyword, info)
+
+        # 根据不同的结果设置不同的冷却时间
+        cooldown_duration = 0
+        if result == "fetch_error":
+            # 获取用户失败: 冷却1小时
+            cooldown_duration = COOLDOWN_USER_FETCH_FAILED
+            logger.warning(f"关键词 '{keyword}' 获取用户失败，进入{COOLDOWN_USER_FETCH_FAILED}秒冷却")
+        elif result in ("success", "send_error"):
+            # 发送消息成功或失败: 冷却1天
+            cooldown_duration = COOLDOWN_MESSAGE_SENT
+            if result == "success":
+                logger.info(f"关键词 '{keyword}' 处理成功，进入{COOLDOWN_MESSAGE_SENT}秒冷却")
+            else:
+                logger.warning(f"关键词 '{keyword}' 发送失败，进入{COOLDOWN_MESSAGE_SENT}秒冷却")
+        elif result == "target_error":
+            logger.info(f"关键词 '{keyword}' 的目标不可用，不进入冷却")
+        elif result == "skip":
+            logger.info(f"关键词 '{keyword}' 被跳过，不进入冷却")
+
+        # 应用冷却 - 设置冷却结束时间 (多个通道并发时取最晚的)
+        if cooldown_duration > 0:
+            self.cooldown_until = max(self.cooldown_until, self.clock() + cooldown_duration)
+            if result == "fetch_error":
+                # 发送成功/失败的冷却已在抢占时写入共享存储，这里只需同步获取失败的冷却
+                await self.coordination.extend_cooldown("global", self.cooldown_until)
+            elif result == "success":
+                # 冷却已在抢占时写入；只有同一条通知的其它动作失败撤销过时才重新写入
+                token = f"{self.instance_id}:{info.get('notification_id')}"
+                if token in self.released_cooldowns:
+                    await self.coordination.extend_cooldown("global", self.cooldown_until, token)
+            logger.info(f"进入冷却期 ({cooldown_duration}秒，约{cooldown_duration/3600:.1f}小时)")
+        return result
+
+    async def on_monitor_message(self, message):
+        """实时收到监控频道的新消息"""
+        async with self.monitor_lock:
+            if self.handed_off:
+                # 已经交接给新进程
+                return
+            if message.id <= self.last_monitor_id:
+                # 已经在补处理中处理过
+                return
+            if self.last_monitor_id and message.id > self.last_monitor_id + 1:
+                # 中间有空缺 (断线期间的通知)，先按顺序补上
+                await self.catch_up(max_id=message.id)
+            await self.process_notification(message)
+
+    # ---------------- 补处理离线期间的通知 ----------------
+    async def catch_up(self, max_id=0):
+        """
+        按消息 id 顺序分批补处理 last_monitor_id 之后的通知 (max_id 为 0 表示直到最新一条)
+        超过 CATCHUP_MAX_AGE 的通知只推进进度，不执行动作
+        """
+        if not self.last_monitor_id:
+            # 第一次运行没有进度记录，从实时消息开始
+            return
+
+        start = time.perf_counter()
+        cutoff = self.clock() - CATCHUP_MAX_AGE
+        processed = stale = 0
+        batch = []
+
+        async def flush(batch):
+            nonlocal processed, stale
+            for message in batch:
+                if message.date and message.date.timestamp() < cutoff:
+                    self.last_monitor_id = max(self.last_monitor_id, message.id)
+                    self.checkpoint.skip(message.id)
+                    stale += 1
+                    continue
+                await self.process_notification(message)
+                processed += 1
+
+        try:
+            async for message in self.client.iter_messages(
+                MONITOR_CHANNEL, min_id=self.last_monitor_id, max_id=max_id, reverse=True
+            ):
+                batch.append(message)
+                if len(batch) >= CATCHUP_BATCH:
+                    await flush(batch)
+                    batch = []
+            await flush(batch)
+        except Exception as e:
+            logger.error(f"补处理通知失败: {e}")
+
+        total = processed + stale
+        if total:
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"补处理完成: {total} 条 (处理 {processed}，过期跳过 {stale})，"
+                f"耗时 {elapsed:.2f}s，{total / elapsed:.1f} 条/秒"
+            )
+
+    # ---------------- 无停机重启 ----------------
+    async def drain(self):
+        """等待匹配中的通知，发出等待合并的回复，并等待执行中的动作完成"""
+        if self.matcher_pool is not None:
+            await self.matcher_pool.drain()
+        self.reply_coalescer.flush_all()
+        for lane in self.lanes.values():
+            await lane.drain()
+
+    def handoff_state(self):
+        """交给新进程的状态 (已互动用户已经写入文件，新进程重新加载)"""
+        now = self.clock()
+        return {
+            "last_monitor_id": self.checkpoint.done,
+            "cooldown_until": self.cooldown_until,
+            "negative": [
+                [scope, key, until, kind]
+                for (scope, key), (until, kind) in self.negative_cache.entries.items()
+                if until > now
+            ],
+        }
+
+    async def listen_handoff(self):
+        # 旧进程退出前不会删除 socket 文件，这里先删掉再监听
+        if os.path.exists(HANDOFF_SOCKET):
+            os.remove(HANDOFF_SOCKET)
+        self.handoff_server = await asyncio.start_unix_server(self.serve_handoff, path=HANDOFF_SOCKET)
+
+    async def serve_handoff(self, reader, writer):
+        """
+        旧进程: 新进程连接后先发出需要预热的源群组，新进程预热完回复 ready；
+        然后停止处理新通知，等在途的动作完成、保存状态，发出最后处理的通知 id 后断开连接退出。
+        回复 probe 的连接只是检查旧进程是否还在运行 (peer_alive)，不交接
+        """
+        try:
+            groups = list(self.prewarmer.groups) if PREWARM_MEMBERS else []
+            writer.write(json.dumps({"groups": groups}).encode() + b"\n")
+            await writer.drain()
+            line = (await asyncio.wait_for(reader.readline(), HANDOFF_TIMEOUT)).strip()
+            if line == b"probe":
+                return
+            if line != b"ready":
+                logger.warning("新进程没有完成预热，取消交接")
+                return
+            start = time.perf_counter()
+            async with self.monitor_lock:
+                self.handed_off = True
+                await self.drain()
+                self.shutdown()
+                writer.write(json.dumps(self.handoff_state()).encode() + b"\n")
+                await writer.drain()
+            logger.info(
+                f"已交接给新进程: 最后处理的通知 {self.last_monitor_id}，"
+                f"停止处理 {time.perf_counter() - start:.2f}s"
+            )
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.warning(f"交接失败: {e!r}")
+            if not self.handed_off:
+                return
+            # 状态已经保存，新进程会从文件加载
+        finally:
+            writer.close()
+        await self.client.disconnect()
+
+    async def take_over(self):
+        """
+        新进程: 连接正在运行的旧进程，预热它用到的源群组成员，等它交出进度后接手。
+        返回 True 表示交接完成或没有旧进程 (按文件里的状态启动)；
+        没有拿到进度而旧进程仍在运行时返回 False，这时不能开始处理通知
+        """
+        try:
+            reader, writer = await asyncio.open_unix_connection(HANDOFF_SOCKET)
+        except (FileNotFoundError, ConnectionRefusedError):
+            logger.info("没有正在运行的旧进程，直接启动")
+            return True
+        start = time.perf_counter()
+        line = b""
+        try:
+            hello = json.loads(await asyncio.wait_for(reader.readline(), HANDOFF_TIMEOUT))
+            if hello["groups"]:
+                try:
+                    await asyncio.wait_for(
+                        asyncio.gather(*(self.prewarmer.warm(group) for group in hello["groups"])),
+                        HANDOFF_TIMEOUT,
+                    )
+                except asyncio.TimeoutError:
+                    logger.warning("预热源群组成员超时，继续交接")
+            writer.write(b"ready\n")
+            await writer.drain()
+            waiting = time.perf_counter()
+            # 旧进程收到 ready 后已经停止处理，正在等在途的动作完成；超时也继续等，直到交出进度或断开
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), HANDOFF_TIMEOUT)
+                    break
+                except asyncio.TimeoutError:
+                    logger.warning(f"旧进程 {time.perf_counter() - waiting:.0f}s 内没有交出进度，继续等待")
+        except (asyncio.TimeoutError, ConnectionError, ValueError, KeyError) as e:
+            logger.warning(f"交接失败: {e!r}")
+        finally:
+            writer.close()
+        if not line:
+            # 没有拿到进度: 旧进程已经退出时按它保存的状态启动，还在运行时 (取消了交接) 不能接手
+            if await self.peer_alive():
+                logger.error("旧进程仍在运行，放弃接手")
+                return False
+            logger.info("旧进程已经退出，按保存的状态启动")
+        # 旧进程在交出进度前保存了状态，重新加载
+        self.interacted_users.close()
+        self.interacted_users = create_interacted_users(self.clock)
+        self.last_monitor_id = max(self.last_monitor_id, self.load_state().get("last_monitor_id", 0))
+        self.checkpoint.skip(self.last_monitor_id)
+        if not line:
+            return True
+        state = json.loads(line)
+        self.last_monitor_id = max(self.last_monitor_id, state["last_monitor_id"])
+        self.checkpoint.skip(self.last_monitor_id)
+        self.cooldown_until = max(self.cooldown_until, state["cooldown_until"])
+        for scope, key, until, kind in state["negative"]:
+            self.negative_cache.entries[(scope, key)] = (until, kind)
+        logger.info(
+            f"已从旧进程接手: 最后处理的通知 {self.last_monitor_id}，"
+            f"交接 {time.perf_counter() - start:.2f}s (等待旧进程停止 {time.perf_counter() - waiting:.2f}s)"
+        )
+        return True
+
+    async def peer_alive(self, timeout=HANDOFF_TIMEOUT, interval=1):
+        """
+        旧进程是否还在监听交接 socket (退出时它在断开连接之后才关闭 socket，等到 timeout 为止)
+        连接后回复 probe，旧进程不会把它当作一次交接
+        """
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(HANDOFF_SOCKET)
+            except (FileNotFoundError, ConnectionRefusedError):
+                return False
+            try:
+                await asyncio.wait_for(reader.readline(), interval)
+                writer.write(b"probe\n")
+                await writer.drain()
+            except (asyncio.TimeoutError, ConnectionError):
+                # 能连上就说明还在监听，没有完成问答不影响判断
+                pass
+            finally:
+                writer.close()
+            if time.perf_counter() >= deadline:
+                return True
+            await asyncio.sleep(interval)
+
+    # ---------------- 启动机器人 ----------------
+    async def start(self):
+        await self.client.start(phone=PHONE)
+        logger.info("机器人已启动")
+        self.loop_lag.start()
+        if PREWARM_MEMBERS:
+            self.prewarmer.start()
+        if self.shadow is not None:
+            self.shadow.start()
+
+        # 预加载贴纸
+        for kw, cfg in KEYWORD_ACTIONS.items():
+            if (
+                cfg.get("sticker_pack") is not None
+                and cfg.get("sticker_index") is not None
+            ):
+                await self.get_sticker(cfg["sticker_pack"], cfg["sticker_index"])
+
+        if ADMIN_COMMANDS:
+            # 只接受本账号自己发出的命令
+            @self.client.on(
+                events.NewMessage(
+                    chats=ADMIN_CHAT, outgoing=True, pattern=rf"^{re.escape(ADMIN_PREFIX)}\b"
+                )
+            )
+            async def admin_handler(event):
+                await event.reply(await self.handle_admin_command(event.raw_text))
+
+        if RAW_UPDATES:
+            # 原始更新路径: 只比较整数频道 ID，不构建事件对象
+            channel_id, _ = utils.resolve_id(await self.client.get_peer_id(MONITOR_CHANNEL))
+
+            @self.client.on(events.Raw(UpdateNewChannelMessage))
+            async def raw_handler(update):
+                message = monitor_message_from_update(update, channel_id)
+                if message is not None:
+                    await self.on_monitor_message(message)
+        else:
+            @self.client.on(events.NewMessage(chats=MONITOR_CHANNEL))
+            async def handler(event):
+                await self.on_monitor_message(event.message)
+
+        # 启动时先补处理离线期间的通知，完成前实时消息在锁上等待
+        # (无停机重启时先等旧进程交出进度，交接期间的通知也由补处理完成)
+        async with self.monitor_lock:
+            if HANDOFF_SOCKET and not await self.take_over():
+                # 旧进程没有交出进度，两个进程同时处理会重复发送；退出前不写入任何状态
+                await self.client.disconnect()
+                raise RuntimeError("旧进程仍在运行，交接失败")
+            await self.catch_up()
+        if HANDOFF_SOCKET:
+            await self.listen_handoff()
+
+        # SIGTERM 时断开连接，让 run_until_disconnected 正常返回
+        # SIGUSR1 触发一次性能剖析
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(
+                signal.SIGTERM, lambda: asyncio.ensure_future(self.client.disconnect())
+            )
+            if PROFILE_ON_SIGNAL and hasattr(signal, "SIGUSR1"):
+                loop.add_signal_handler(signal.SIGUSR1, self.profiler.trigger)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+        try:
+            await self.client.run_until_disconnected()
+            # 正常断开时等待匹配中的通知，发出等待合并的回复，并等待执行中的动作完成
+            await self.drain()
+        finally:
+            if self.handoff_server is not None:
+                self.handoff_server.close()
+            self.loop_lag.stop()
+            self.prewarmer.stop()
+            logger.info(self.loop_lag.report())
+            logger.info(self.formats.report())
+            logger.info(self.source_policies.report())
+            logger.info(self.negative_cache.report())
+            logger.info(self.user_filter.report())
+            if PREWARM_MEMBERS:
+                logger.info(self.prewarmer.report())
+            for lane in self.lanes.values():
+                logger.info(lane.report())
+            logger.info(self.reply_coalescer.report())
+            if self.shadow is not None:
+                self.shadow.stop()
+                logger.info(self.shadow.report())
+            if self.matcher_pool is not None:
+                logger.info(self.matcher_pool.report())
+            self.shutdown()
+
+
+async def main():
+    bot = KeywordMonitorBot()
+    await bot.start()
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    try:
+        run_event_loop(main())
+    except KeyboardInterrupt:
+        logger.info("机器人已停止")